@@ -0,0 +1,418 @@
+import json, multiprocessing, os, platform, socket, subprocess, sys, threading, time;
+sModulePath = os.path.dirname(os.path.abspath(__file__));
+sMainFolderPath = os.path.dirname(sModulePath);
+sParentFolderPath = os.path.dirname(sMainFolderPath);
+sys.path = [sModulePath, sParentFolderPath, os.path.join(sMainFolderPath, "modules")] + [
+  sPath for sPath in sys.path if sPath.lower() != sModulePath.lower()
+];
+
+try:
+  import resource;
+except ModuleNotFoundError: # Not available on Windows
+  resource = None;
+
+from mHTTPProtocol import cURL;
+from mHTTPConnection import (
+  cConnection,
+  cConnectionsToServerPool,
+  cMultiProcessServer,
+  cServer,
+);
+
+# Benchmarks for the hot paths in this module. Messages are parsed and
+# serialized over a connected pair of loopback TCP sockets (cConnection
+# expects a TCP socket), with a thread on the other side that writes or reads
+# raw bytes. The connections pool is benchmarked against a cServer in this
+# process. The multi-process server is benchmarked against client processes
+# that each use a pool, so the client is not limited to one CPU core either.
+# Results are output as JSON, so runs can be compared across commits.
+# Each benchmark is run in a separate process, so the peak RSS reported for it
+# is not affected by the benchmarks that ran before it.
+# Usage: Benchmarks.py [--quick] [--output=<file path>] [<benchmark name> ...]
+
+sbSmallGETRequest = b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n";
+sbSmallResponse = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nOK";
+def fsbCreateLargeContentLengthResponse(uBodySize):
+  return b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % uBodySize + b"A" * uBodySize;
+def fsbCreateManyChunksResponse(uNumberOfChunks, uChunkSize):
+  return (
+    b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+    + (b"%X\r\n" % uChunkSize + b"A" * uChunkSize + b"\r\n") * uNumberOfChunks
+    + b"0\r\n\r\n"
+  );
+def fsbCreateHeaderHeavyRequest(uNumberOfHeaders):
+  return (
+    b"GET / HTTP/1.1\r\nHost: localhost\r\n"
+    + b"".join(b"X-Header-%d: %s\r\n" % (uIndex, b"V" * 64) for uIndex in range(uNumberOfHeaders))
+    + b"\r\n"
+  );
+
+def ftoCreateSocketPair():
+  oListeningSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM);
+  try:
+    oListeningSocket.bind(("127.0.0.1", 0));
+    oListeningSocket.listen(1);
+    oClientSocket = socket.create_connection(oListeningSocket.getsockname());
+    (oServerSocket, txAddress) = oListeningSocket.accept();
+  finally:
+    oListeningSocket.close();
+  for oSocket in (oClientSocket, oServerSocket):
+    oSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1);
+  return (oClientSocket, oServerSocket);
+
+def fu0GetPeakRSSInBytes():
+  # This is the high-water mark of the entire process.
+  if resource is None:
+    return None;
+  uMaxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss;
+  # Linux reports this in kilobytes, macOS in bytes.
+  return uMaxRSS if sys.platform == "darwin" else uMaxRSS * 1024;
+
+def fdxGetResults(sName, uNumberOfRequests, nDurationInSeconds, anLatenciesInSeconds, uNumberOfBytes):
+  anSortedLatenciesInSeconds = sorted(anLatenciesInSeconds);
+  def fnGetPercentileInMilliseconds(uPercentile):
+    uIndex = min(len(anSortedLatenciesInSeconds) - 1, len(anSortedLatenciesInSeconds) * uPercentile // 100);
+    return round(anSortedLatenciesInSeconds[uIndex] * 1000, 4);
+  return {
+    "sName": sName,
+    "uNumberOfRequests": uNumberOfRequests,
+    "nDurationInSeconds": round(nDurationInSeconds, 4),
+    "nRequestsPerSecond": round(uNumberOfRequests / nDurationInSeconds, 1),
+    "nMegabytesPerSecond": round(uNumberOfBytes / nDurationInSeconds / 1000 / 1000, 2),
+    "nP50LatencyInMilliseconds": fnGetPercentileInMilliseconds(50),
+    "nP99LatencyInMilliseconds": fnGetPercentileInMilliseconds(99),
+    "u0PeakRSSInBytes": fu0GetPeakRSSInBytes(),
+  };
+
+def fdxBenchmarkReceivingMessages(sName, sbMessage, bResponse, uNumberOfMessages):
+  # Measure how fast a cConnection parses messages written by the other side.
+  (oRawSocket, oConnectionSocket) = ftoCreateSocketPair();
+  oConnection = cConnection(oConnectionSocket, bCreatedLocally = not bResponse);
+  def fWriteMessages():
+    for uIndex in range(uNumberOfMessages):
+      oRawSocket.sendall(sbMessage);
+  oWriterThread = threading.Thread(target = fWriteMessages, daemon = True);
+  anLatenciesInSeconds = [];
+  nStartTime = time.perf_counter();
+  oWriterThread.start();
+  for uIndex in range(uNumberOfMessages):
+    nRequestStartTime = time.perf_counter();
+    oConnection.fStartTransaction(n0TimeoutInSeconds = None);
+    if bResponse:
+      oConnection.foReceiveResponse();
+    else:
+      oConnection.foReceiveRequest();
+    oConnection.fEndTransaction();
+    anLatenciesInSeconds.append(time.perf_counter() - nRequestStartTime);
+  nDurationInSeconds = time.perf_counter() - nStartTime;
+  oWriterThread.join();
+  oConnection.fTerminate();
+  oRawSocket.close();
+  return fdxGetResults(sName, uNumberOfMessages, nDurationInSeconds, anLatenciesInSeconds, len(sbMessage) * uNumberOfMessages);
+
+def foParseMessage(sbMessage, bResponse):
+  # Create a message object by parsing it, so we do not depend on the
+  # constructor arguments of the mHTTPProtocol message classes.
+  (oRawSocket, oConnectionSocket) = ftoCreateSocketPair();
+  oConnection = cConnection(oConnectionSocket, bCreatedLocally = not bResponse);
+  # Large messages do not fit in the socket buffers, so write from a thread.
+  oWriterThread = threading.Thread(target = oRawSocket.sendall, args = (sbMessage,), daemon = True);
+  oWriterThread.start();
+  try:
+    oConnection.fStartTransaction(n0TimeoutInSeconds = None);
+    oMessage = oConnection.foReceiveResponse() if bResponse else oConnection.foReceiveRequest();
+    oConnection.fEndTransaction();
+  finally:
+    oWriterThread.join();
+    oConnection.fTerminate();
+    oRawSocket.close();
+  return oMessage;
+
+def fdxBenchmarkSendingMessages(sName, sbMessage, bResponse, uNumberOfMessages):
+  # Measure how fast a cConnection serializes and writes messages, while the
+  # other side reads them.
+  oMessage = foParseMessage(sbMessage, bResponse);
+  (oRawSocket, oConnectionSocket) = ftoCreateSocketPair();
+  oConnection = cConnection(oConnectionSocket, bCreatedLocally = bResponse);
+  auNumberOfBytesRead = [0];
+  def fReadMessages():
+    while 1:
+      sbBytes = oRawSocket.recv(1024 * 1024);
+      if not sbBytes:
+        return;
+      auNumberOfBytesRead[0] += len(sbBytes);
+  oReaderThread = threading.Thread(target = fReadMessages, daemon = True);
+  oReaderThread.start();
+  anLatenciesInSeconds = [];
+  nStartTime = time.perf_counter();
+  for uIndex in range(uNumberOfMessages):
+    nRequestStartTime = time.perf_counter();
+    oConnection.fStartTransaction(n0TimeoutInSeconds = None);
+    if bResponse:
+      oConnection.fSendResponse(oMessage);
+    else:
+      oConnection.fSendRequest(oMessage);
+    oConnection.fEndTransaction();
+    anLatenciesInSeconds.append(time.perf_counter() - nRequestStartTime);
+  nDurationInSeconds = time.perf_counter() - nStartTime;
+  oConnection.fTerminate();
+  oReaderThread.join();
+  oRawSocket.close();
+  return fdxGetResults(sName, uNumberOfMessages, nDurationInSeconds, anLatenciesInSeconds, auNumberOfBytesRead[0]);
+
+def ftxSendRequestsUsingPool(uPortNumber, uNumberOfThreads, uNumberOfRequestsPerThread, fCallbackBeforeSendingRequests = None):
+  # Send requests from a number of threads that share a pool with fewer
+  # connections than threads. Returns the time it took to send them all and
+  # the latency of each request.
+  oRequest = foParseMessage(sbSmallGETRequest, bResponse = False);
+  oPool = cConnectionsToServerPool(
+    cURL(b"http", b"127.0.0.1", uPortNumber),
+    u0zMaxNumberOfConnectionsToServer = 8,
+    bWaitForFreeConnection = True,
+  );
+  aanLatenciesInSeconds = [[] for uIndex in range(uNumberOfThreads)];
+  def fSendRequests(anLatenciesInSeconds):
+    for uIndex in range(uNumberOfRequestsPerThread):
+      nRequestStartTime = time.perf_counter();
+      oPool.fo0SendRequestAndReceiveResponse(oRequest);
+      anLatenciesInSeconds.append(time.perf_counter() - nRequestStartTime);
+  aoThreads = [
+    threading.Thread(target = fSendRequests, args = (anLatenciesInSeconds,), daemon = True)
+    for anLatenciesInSeconds in aanLatenciesInSeconds
+  ];
+  if fCallbackBeforeSendingRequests is not None:
+    fCallbackBeforeSendingRequests();
+  nStartTime = time.perf_counter();
+  for oThread in aoThreads:
+    oThread.start();
+  for oThread in aoThreads:
+    oThread.join();
+  nDurationInSeconds = time.perf_counter() - nStartTime;
+  oPool.fTerminate();
+  oPool.fbWait(None);
+  return (
+    nDurationInSeconds,
+    [nLatencyInSeconds for anLatenciesInSeconds in aanLatenciesInSeconds for nLatencyInSeconds in anLatenciesInSeconds],
+  );
+
+def fdxBenchmarkConnectionsToServerPool(sName, uNumberOfThreads, uNumberOfRequestsPerThread):
+  # Measure requests/second and latency for a number of threads that share a
+  # pool with fewer connections than threads, against a server in this process.
+  oResponse = foParseMessage(sbSmallResponse, bResponse = True);
+  oListeningSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM);
+  oListeningSocket.bind(("127.0.0.1", 0));
+  oListeningSocket.listen();
+  uPortNumber = oListeningSocket.getsockname()[1];
+  oServer = cServer(
+    lambda oServer, oConnection, oRequest: oResponse,
+    o0ListeningPythonSocket = oListeningSocket,
+    uzMaxNumberOfWorkerThreads = 8,
+  );
+  (nDurationInSeconds, anLatenciesInSeconds) = ftxSendRequestsUsingPool(uPortNumber, uNumberOfThreads, uNumberOfRequestsPerThread);
+  oServer.fTerminate();
+  oServer.fbWait(None);
+  uNumberOfRequests = uNumberOfThreads * uNumberOfRequestsPerThread;
+  return fdxGetResults(
+    sName,
+    uNumberOfRequests,
+    nDurationInSeconds,
+    anLatenciesInSeconds,
+    (len(sbSmallGETRequest) + len(sbSmallResponse)) * uNumberOfRequests,
+  );
+
+# The multi-process server calls this in its worker processes, so it must be
+# defined at module level. Each response has a header with the id of the
+# process that handled the request, so we can tell when they are all running.
+go0MultiProcessServerResponse = None;
+def foHandleRequestInMultiProcessServer(oServer, oConnection, oRequest):
+  global go0MultiProcessServerResponse;
+  if go0MultiProcessServerResponse is None:
+    go0MultiProcessServerResponse = foParseMessage(
+      b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nX-Process-Id: %d\r\n\r\nOK" % os.getpid(),
+      bResponse = True,
+    );
+  return go0MultiProcessServerResponse;
+
+def fu0GetMultiProcessServerProcessId(uPortNumber):
+  # Send a request on a new connection, so the OS can pass it to any of the
+  # worker processes, and return the id of the process that handled it, or
+  # None if no worker process is accepting connections yet.
+  try:
+    oSocket = socket.create_connection(("127.0.0.1", uPortNumber), timeout = 1);
+  except OSError:
+    return None;
+  try:
+    oSocket.sendall(sbSmallGETRequest);
+    sbResponse = b"";
+    while b"\r\n\r\n" not in sbResponse:
+      sbBytes = oSocket.recv(1024);
+      if not sbBytes:
+        return None;
+      sbResponse += sbBytes;
+  except OSError:
+    return None;
+  finally:
+    oSocket.close();
+  for sbHeaderLine in sbResponse.split(b"\r\n\r\n", 1)[0].split(b"\r\n")[1:]:
+    (sbName, sbValue) = (sbHeaderLine.split(b":", 1) + [b""])[:2];
+    if sbName.strip().lower() == b"x-process-id":
+      return int(sbValue);
+  return None;
+
+def fSendRequestsFromClientProcess(uPortNumber, uNumberOfThreads, uNumberOfRequestsPerThread, oStartBarrier, oResultsQueue):
+  # This runs in a client process; all client processes start sending requests
+  # at the same time, after they have been started and imported this module.
+  oResultsQueue.put(ftxSendRequestsUsingPool(
+    uPortNumber,
+    uNumberOfThreads,
+    uNumberOfRequestsPerThread,
+    fCallbackBeforeSendingRequests = oStartBarrier.wait,
+  ));
+
+def fdxBenchmarkMultiProcessServer(sName, uNumberOfProcesses, uNumberOfRequestsPerThread):
+  # Measure requests/second and latency for a multi-process server with the
+  # given number of worker processes, against one client process per CPU core
+  # with a few threads each. Comparing the results for different numbers of
+  # worker processes shows how well the server scales across CPU cores.
+  uNumberOfClientProcesses = os.cpu_count() or 1;
+  uNumberOfThreadsPerClientProcess = 4;
+  oServer = cMultiProcessServer(
+    foHandleRequestInMultiProcessServer,
+    uzPortNumber = 0,
+    uzNumberOfProcesses = uNumberOfProcesses,
+    uzMaxNumberOfWorkerThreads = 8,
+  );
+  # Wait until requests have been handled by all worker processes, so none of
+  # them starts while we are measuring.
+  nTimeoutTime = time.time() + 60;
+  auProcessIds = set();
+  while len(auProcessIds) < uNumberOfProcesses:
+    assert time.time() < nTimeoutTime, \
+        "Only %d/%d worker processes handled requests within 60 seconds" % (len(auProcessIds), uNumberOfProcesses);
+    u0ProcessId = fu0GetMultiProcessServerProcessId(oServer.uPortNumber);
+    if u0ProcessId is None:
+      time.sleep(0.1);
+    else:
+      auProcessIds.add(u0ProcessId);
+  oMultiProcessingContext = multiprocessing.get_context("spawn");
+  oStartBarrier = oMultiProcessingContext.Barrier(uNumberOfClientProcesses + 1);
+  oResultsQueue = oMultiProcessingContext.Queue();
+  aoClientProcesses = [
+    oMultiProcessingContext.Process(
+      target = fSendRequestsFromClientProcess,
+      args = (oServer.uPortNumber, uNumberOfThreadsPerClientProcess, uNumberOfRequestsPerThread, oStartBarrier, oResultsQueue),
+      daemon = True,
+    )
+    for uIndex in range(uNumberOfClientProcesses)
+  ];
+  for oClientProcess in aoClientProcesses:
+    oClientProcess.start();
+  oStartBarrier.wait();
+  # The client processes started sending requests at the same time, so the
+  # slowest one determines how long it took to send them all.
+  nDurationInSeconds = 0;
+  anLatenciesInSeconds = [];
+  for oClientProcess in aoClientProcesses:
+    (nClientDurationInSeconds, anClientLatenciesInSeconds) = oResultsQueue.get();
+    nDurationInSeconds = max(nDurationInSeconds, nClientDurationInSeconds);
+    anLatenciesInSeconds += anClientLatenciesInSeconds;
+  for oClientProcess in aoClientProcesses:
+    oClientProcess.join();
+  oServer.fStop();
+  oServer.fbWait(None);
+  uNumberOfRequests = uNumberOfClientProcesses * uNumberOfThreadsPerClientProcess * uNumberOfRequestsPerThread;
+  dxResults = fdxGetResults(
+    sName,
+    uNumberOfRequests,
+    nDurationInSeconds,
+    anLatenciesInSeconds,
+    (len(sbSmallGETRequest) + len(sbSmallResponse)) * uNumberOfRequests,
+  );
+  # The peak RSS is that of this process only, not the worker processes.
+  dxResults["uNumberOfProcesses"] = uNumberOfProcesses;
+  dxResults["uNumberOfClientProcesses"] = uNumberOfClientProcesses;
+  return dxResults;
+
+def fatxGetBenchmarks(uScale):
+  # Returns the name, function and a function that creates the arguments of
+  # all benchmarks, so only the messages for benchmarks that are run are
+  # created; uScale divides the number of iterations (for quick runs).
+  return [
+    ("receive small GET request", fdxBenchmarkReceivingMessages, lambda: (sbSmallGETRequest, False, 20000 // uScale)),
+    ("receive header-heavy request", fdxBenchmarkReceivingMessages, lambda: (fsbCreateHeaderHeavyRequest(100), False, 2000 // uScale)),
+    ("receive large Content-Length response", fdxBenchmarkReceivingMessages, lambda: (fsbCreateLargeContentLengthResponse(10 * 1000 * 1000), True, 20 // uScale)),
+    ("receive many-chunks response", fdxBenchmarkReceivingMessages, lambda: (fsbCreateManyChunksResponse(10000, 16), True, 20 // uScale)),
+  ] + [
+    # Receiving a chunked body should take time linear in the number of chunks,
+    # so nMegabytesPerSecond should be about the same for all of these.
+    ("receive %d chunks response" % uNumberOfChunks, fdxBenchmarkReceivingMessages, lambda uNumberOfChunks = uNumberOfChunks: (
+      fsbCreateManyChunksResponse(uNumberOfChunks, 16), True, max(1, 100000 // uNumberOfChunks // uScale),
+    ))
+    for uNumberOfChunks in (10, 100, 1000, 10000, 100000, 1000000)
+  ] + [
+    ("send small GET request", fdxBenchmarkSendingMessages, lambda: (sbSmallGETRequest, False, 20000 // uScale)),
+    ("send header-heavy request", fdxBenchmarkSendingMessages, lambda: (fsbCreateHeaderHeavyRequest(100), False, 2000 // uScale)),
+    ("send large Content-Length response", fdxBenchmarkSendingMessages, lambda: (fsbCreateLargeContentLengthResponse(10 * 1000 * 1000), True, 20 // uScale)),
+    ("send 1KB Content-Length response", fdxBenchmarkSendingMessages, lambda: (fsbCreateLargeContentLengthResponse(1000), True, 20000 // uScale)),
+    ("send 1MB Content-Length response", fdxBenchmarkSendingMessages, lambda: (fsbCreateLargeContentLengthResponse(1000 * 1000), True, 200 // uScale)),
+    ("send 100MB Content-Length response", fdxBenchmarkSendingMessages, lambda: (fsbCreateLargeContentLengthResponse(100 * 1000 * 1000), True, max(1, 2 // uScale))),
+    ("pool with 1 thread", fdxBenchmarkConnectionsToServerPool, lambda: (1, 2000 // uScale)),
+    ("pool with 8 threads", fdxBenchmarkConnectionsToServerPool, lambda: (8, 500 // uScale)),
+    ("pool with 64 threads", fdxBenchmarkConnectionsToServerPool, lambda: (64, 100 // uScale)),
+  ] + [
+    # nRequestsPerSecond should grow with the number of worker processes, up
+    # to the number of CPU cores (which are shared with the client processes).
+    ("%d-process server" % uNumberOfProcesses, fdxBenchmarkMultiProcessServer, lambda uNumberOfProcesses = uNumberOfProcesses: (
+      uNumberOfProcesses, 500 // uScale,
+    ))
+    for uNumberOfProcesses in sorted(set([1, 2, os.cpu_count() or 1]))
+  ];
+
+def fdxRunBenchmarkInChildProcess(sName, bQuick):
+  # The child process outputs the result as JSON on the last line of stdout.
+  oProcess = subprocess.run(
+    [sys.executable, os.path.abspath(__file__), "--run-in-this-process=%s" % sName] + (["--quick"] if bQuick else []),
+    stdout = subprocess.PIPE,
+    check = True,
+  );
+  return json.loads(oProcess.stdout.decode("utf-8").rstrip("\n").rsplit("\n", 1)[-1]);
+
+if __name__ == "__main__":
+  bQuick = "--quick" in sys.argv[1:];
+  s0OutputFilePath = None;
+  s0RunInThisProcessBenchmarkName = None;
+  asBenchmarkNames = [];
+  for sArgument in sys.argv[1:]:
+    if sArgument.startswith("--output="):
+      s0OutputFilePath = sArgument[len("--output="):];
+    elif sArgument.startswith("--run-in-this-process="):
+      s0RunInThisProcessBenchmarkName = sArgument[len("--run-in-this-process="):];
+    elif sArgument != "--quick":
+      asBenchmarkNames.append(sArgument);
+  if s0RunInThisProcessBenchmarkName is not None:
+    for (sName, fdxBenchmark, ftxGetArguments) in fatxGetBenchmarks(uScale = 10 if bQuick else 1):
+      if sName == s0RunInThisProcessBenchmarkName:
+        print(json.dumps(fdxBenchmark(sName, *ftxGetArguments())));
+        sys.exit(0);
+    print("Unknown benchmark %s" % repr(s0RunInThisProcessBenchmarkName), file = sys.stderr);
+    sys.exit(1);
+  adxResults = [];
+  for (sName, fdxBenchmark, ftxGetArguments) in fatxGetBenchmarks(uScale = 10 if bQuick else 1):
+    if asBenchmarkNames and sName not in asBenchmarkNames:
+      continue;
+    print("* %s..." % sName, file = sys.stderr);
+    adxResults.append(fdxRunBenchmarkInChildProcess(sName, bQuick));
+  sResults = json.dumps({
+    "sPythonVersion": platform.python_version(),
+    "sPlatform": platform.platform(),
+    "bQuick": bQuick,
+    "adxResults": adxResults,
+  }, indent = 2);
+  if s0OutputFilePath is None:
+    print(sResults);
+  else:
+    oOutputFile = open(s0OutputFilePath, "w");
+    try:
+      oOutputFile.write(sResults);
+    finally:
+      oOutputFile.close();
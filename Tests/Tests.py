@@ -38,8 +38,9 @@ try:
       def fStatus(*txArguments, **dxArguments):
         pass;
   
-  # Tests are yet to be added.
-  pass;
+  from fTestHTTPCache import fTestHTTPCache;
+  fTestHTTPCache(oConsole);
+  oConsole.fOutput("All tests passed.");
   
 except Exception as oException:
   if m0DebugOutput:
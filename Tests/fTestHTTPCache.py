@@ -0,0 +1,140 @@
+from mHTTPProtocol import (
+  cHeaders,
+  cRequest,
+  cResponse,
+  cURL,
+);
+from mHTTPConnection import cHTTPCache;
+from mHTTPConnection.cHTTPCache import (
+  fsb0GetHeaderValue,
+  fuGetStatusCode,
+);
+
+goServerBaseURL = cURL(b"http", b"localhost", 80);
+
+def foCreateMessage(cMessage, sbStartLine, asbHeaderLines, sbBody = b""):
+  oMessage = cMessage(
+    o0zHeaders = cHeaders.foDeserializeLines(asbHeaderLines),
+    **cMessage.fdxDeserializeStartLine(sbStartLine),
+  );
+  oMessage.fSetBody(sbBody);
+  return oMessage;
+
+class cFakeServer(object):
+  # Answers requests with the responses it is given, in order, and remembers
+  # the requests it received, so we can check what the cache sent.
+  def __init__(oSelf, *aoResponses):
+    oSelf.aoResponses = list(aoResponses);
+    oSelf.aoRequests = [];
+  
+  def fo0SendRequestAndReceiveResponse(oSelf, oRequest):
+    oSelf.aoRequests.append(oRequest);
+    assert oSelf.aoResponses, \
+        "The cache sent an unexpected request %s" % repr(oRequest.fsbSerializeStartLine());
+    return oSelf.aoResponses.pop(0);
+
+def foGetResponse(oHTTPCache, oServer, asbRequestHeaderLines = []):
+  return oHTTPCache.fo0GetResponse(
+    goServerBaseURL,
+    foCreateMessage(cRequest, b"GET /test HTTP/1.1", [b"Host: localhost"] + asbRequestHeaderLines),
+    oServer.fo0SendRequestAndReceiveResponse,
+  );
+
+def fTestFreshHit(oConsole):
+  oConsole.fOutput("  * Fresh response is used without sending a request...");
+  oHTTPCache = cHTTPCache();
+  oServer = cFakeServer(
+    foCreateMessage(cResponse, b"HTTP/1.1 200 OK", [b"Cache-Control: max-age=60", b"Content-Length: 4"], b"test"),
+  );
+  oResponse = foGetResponse(oHTTPCache, oServer);
+  assert oResponse.sbBody == b"test", \
+      "Unexpected body %s" % repr(oResponse.sbBody);
+  oResponse = foGetResponse(oHTTPCache, oServer);
+  assert len(oServer.aoRequests) == 1, \
+      "Expected 1 request to be sent, not %d" % len(oServer.aoRequests);
+  assert oResponse.sbBody == b"test", \
+      "Unexpected cached body %s" % repr(oResponse.sbBody);
+  assert fsb0GetHeaderValue(oResponse.oHeaders, b"age") is not None, \
+      "Cached response has no Age header";
+  assert oHTTPCache.n0HitRatio == 0.5, \
+      "Unexpected hit ratio %s" % repr(oHTTPCache.n0HitRatio);
+
+def fTestStaleResponseIsRevalidated(oConsole):
+  oConsole.fOutput("  * Stale response is revalidated and updated by a 304 response...");
+  oHTTPCache = cHTTPCache();
+  oServer = cFakeServer(
+    foCreateMessage(cResponse, b"HTTP/1.1 200 OK", [
+      b"Cache-Control: max-age=0",
+      b"ETag: \"v1\"",
+      b"X-Version: 1",
+      b"Content-Length: 4",
+    ], b"test"),
+    foCreateMessage(cResponse, b"HTTP/1.1 304 Not Modified", [
+      b"ETag: \"v1\"",
+      b"X-Version: 2",
+      b"Content-Length: 0",
+    ]),
+  );
+  foGetResponse(oHTTPCache, oServer);
+  oResponse = foGetResponse(oHTTPCache, oServer);
+  assert len(oServer.aoRequests) == 2, \
+      "Expected 2 requests to be sent, not %d" % len(oServer.aoRequests);
+  sb0IfNoneMatch = fsb0GetHeaderValue(oServer.aoRequests[1].oHeaders, b"if-none-match");
+  assert sb0IfNoneMatch == b"\"v1\"", \
+      "Unexpected If-None-Match header value %s" % repr(sb0IfNoneMatch);
+  assert fuGetStatusCode(oResponse) == 200, \
+      "Unexpected status code %d" % fuGetStatusCode(oResponse);
+  assert oResponse.sbBody == b"test", \
+      "Unexpected revalidated body %s" % repr(oResponse.sbBody);
+  sb0Version = fsb0GetHeaderValue(oResponse.oHeaders, b"x-version");
+  assert sb0Version == b"2", \
+      "Headers of the 304 response were not merged (X-Version: %s)" % repr(sb0Version);
+  sb0ContentLength = fsb0GetHeaderValue(oResponse.oHeaders, b"content-length");
+  assert sb0ContentLength == b"4", \
+      "Content-Length of the 304 response replaced the stored one (%s)" % repr(sb0ContentLength);
+
+def fTestNoStoreResponseIsNotStored(oConsole):
+  oConsole.fOutput("  * Response with \"Cache-Control: no-store\" is not stored...");
+  oHTTPCache = cHTTPCache();
+  oServer = cFakeServer(*[
+    foCreateMessage(cResponse, b"HTTP/1.1 200 OK", [b"Cache-Control: no-store, max-age=60", b"Content-Length: 4"], b"test")
+    for u in range(2)
+  ]);
+  foGetResponse(oHTTPCache, oServer);
+  foGetResponse(oHTTPCache, oServer);
+  assert len(oServer.aoRequests) == 2, \
+      "Expected 2 requests to be sent, not %d" % len(oServer.aoRequests);
+  assert oHTTPCache.uEntriesCount == 0, \
+      "Expected no entries in the cache, not %d" % oHTTPCache.uEntriesCount;
+
+def fTestVaryMismatchIsNotUsed(oConsole):
+  oConsole.fOutput("  * Response is not used for a request with other values for the headers in \"Vary\"...");
+  oHTTPCache = cHTTPCache();
+  oServer = cFakeServer(*[
+    foCreateMessage(cResponse, b"HTTP/1.1 200 OK", [
+      b"Cache-Control: max-age=60",
+      b"Vary: Accept-Language",
+      b"Content-Length: 2",
+    ], sbLanguage)
+    for sbLanguage in [b"en", b"nl"]
+  ]);
+  oResponse = foGetResponse(oHTTPCache, oServer, [b"Accept-Language: en"]);
+  assert oResponse.sbBody == b"en", \
+      "Unexpected body %s" % repr(oResponse.sbBody);
+  oResponse = foGetResponse(oHTTPCache, oServer, [b"Accept-Language: nl"]);
+  assert len(oServer.aoRequests) == 2, \
+      "Expected 2 requests to be sent, not %d" % len(oServer.aoRequests);
+  assert oResponse.sbBody == b"nl", \
+      "Response for another Accept-Language header value was used (%s)" % repr(oResponse.sbBody);
+  oResponse = foGetResponse(oHTTPCache, oServer, [b"Accept-Language: nl"]);
+  assert len(oServer.aoRequests) == 2, \
+      "Expected 2 requests to be sent, not %d" % len(oServer.aoRequests);
+  assert oResponse.sbBody == b"nl", \
+      "Unexpected cached body %s" % repr(oResponse.sbBody);
+
+def fTestHTTPCache(oConsole):
+  oConsole.fOutput("Testing cHTTPCache...");
+  fTestFreshHit(oConsole);
+  fTestStaleResponseIsRevalidated(oConsole);
+  fTestNoStoreResponseIsNotStored(oConsole);
+  fTestVaryMismatchIsNotUsed(oConsole);
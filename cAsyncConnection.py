@@ -0,0 +1,510 @@
+import asyncio;
+
+from mHTTPProtocol import (
+  cRequest,
+  cResponse,
+  cURL,
+  iMessage,
+);
+from mMultiThreading import cWithCallbacks;
+from mNotProvided import (
+  fxGetFirstProvidedValue,
+  zNotProvided,
+);
+
+from .cConnection import cConnection;
+from .cSSLContextWithSession import cSSLContextWithSession;
+from .mExceptions import (
+  cConnectionOutOfBandDataException,
+  cConnectionShutdownException,
+);
+from .mMessageParser import (
+  fiterParseBody,
+  fiterParseStartLineAndHeaders,
+  guBodyPart,
+  guReadBufferedData,
+  guReadBytes,
+  guReadBytesUntilShutdown,
+  guReadUntilMarker,
+);
+from .mOptionalDebugOutput import (
+  fShowDebugOutput,
+  gbShowDebugOutput,
+  ShowDebugOutput,
+);
+
+gbDebugOutputFullHTTPMessages = False;
+
+# This is the asyncio counterpart of cConnection: it reads and writes HTTP
+# messages using an asyncio.StreamReader/StreamWriter pair instead of blocking
+# socket calls, so a single thread can handle many connections at once. It
+# uses the same parser as cConnection (see mMessageParser). A connection is
+# not transactional: it must not be used by more than one task at a time.
+# All methods that read or write are coroutines and must be awaited.
+class cAsyncConnection(cWithCallbacks):
+  u0DefaultMaxReasonPhraseSize = cConnection.u0DefaultMaxReasonPhraseSize;
+  u0DefaultMaxHeaderLineSize = cConnection.u0DefaultMaxHeaderLineSize;
+  u0DefaultMaxNumberOfHeaders = cConnection.u0DefaultMaxNumberOfHeaders;
+  u0DefaultMaxBodySize = cConnection.u0DefaultMaxBodySize;
+  u0DefaultMaxChunkSize = cConnection.u0DefaultMaxChunkSize;
+  u0DefaultMaxNumberOfChunks = cConnection.u0DefaultMaxNumberOfChunks;
+  n0DefaultConnectTimeoutInSeconds = cConnection.n0DefaultConnectTimeoutInSeconds;
+  n0DefaultTransactionTimeoutInSeconds = cConnection.n0DefaultTransactionTimeoutInSeconds;
+  u0MaxChunkSizeCharacters = cConnection.u0MaxChunkSizeCharacters;
+  uReadBufferSize = 64*1024; # Maximum number of bytes requested from the StreamReader at once.
+  
+  @classmethod
+  @ShowDebugOutput
+  async def foConnectTo(cClass,
+    sbHost,
+    uPortNumber,
+    *,
+    n0zConnectTimeoutInSeconds = zNotProvided,
+    o0SSLContext = None,
+    o0SSLSession = None,
+  ):
+    # Open a connection to the given host and port. If an ssl.SSLContext is
+    # provided, the connection is secured using it; asyncio checks the host
+    # name if the context has `check_hostname` set. If an ssl.SSLSession from
+    # an earlier connection to the same server is provided, we try to resume
+    # it, which saves most of the work of the TLS handshake.
+    # Can throw timeout (asyncio.TimeoutError) or OSError exceptions.
+    n0ConnectTimeoutInSeconds = fxGetFirstProvidedValue(n0zConnectTimeoutInSeconds, cClass.n0DefaultConnectTimeoutInSeconds);
+    sHost = str(sbHost, "ascii", "strict");
+    (oStreamReader, oStreamWriter) = await asyncio.wait_for(
+      asyncio.open_connection(
+        sHost,
+        uPortNumber,
+        ssl = cSSLContextWithSession(o0SSLContext, o0SSLSession) if o0SSLContext and o0SSLSession else o0SSLContext,
+        server_hostname = sHost if o0SSLContext is not None else None,
+        limit = cClass.uReadBufferSize,
+      ),
+      n0ConnectTimeoutInSeconds,
+    );
+    return cClass(
+      oStreamReader,
+      oStreamWriter,
+      sb0RemoteHost = sbHost,
+      bCreatedLocally = True,
+    );
+  
+  def __init__(oSelf,
+    oStreamReader,
+    oStreamWriter,
+    *,
+    sb0RemoteHost = None,
+    bCreatedLocally,
+  ):
+    oSelf.__oStreamReader = oStreamReader;
+    oSelf.__oStreamWriter = oStreamWriter;
+    oSelf.bCreatedLocally = bCreatedLocally;
+    oSelf.bSecure = oStreamWriter.get_extra_info("sslcontext") is not None;
+    txPeerName = oStreamWriter.get_extra_info("peername") or ("", 0);
+    oSelf.sbRemoteIPAddress = bytes(txPeerName[0], "ascii", "strict");
+    oSelf.uRemotePortNumber = txPeerName[1];
+    oSelf.sbRemoteHost = sb0RemoteHost if sb0RemoteHost is not None else oSelf.sbRemoteIPAddress;
+    # Data read from the StreamReader that has not been consumed yet. We use
+    # our own buffer rather than the StreamReader's readuntil/readexactly so
+    # we can apply the same limits as cConnection and report the data that
+    # exceeded them.
+    oSelf.__abBuffer = bytearray();
+    oSelf.__bTerminated = False;
+    oSelf.__o0LastSentRequest = None;
+    oSelf.__o0LastReceivedRequest = None;
+    oSelf.fAddEvents(
+      "read bytes",
+      "wrote bytes",
+  
+      "sending message",
+      "sending message failed",
+      "sent message",
+  
+      "receiving message",
+      "receiving message failed",
+      "received message",
+  
+      "received out-of-band data from server",
+  
+      "sending request to server",
+      "sending request to server failed",
+      "sent request to server",
+  
+      "receiving request from client",
+      "receiving request from client failed",
+      "received request from client",
+  
+      "sending response to client",
+      "sending response to client failed",
+      "sent response to client",
+  
+      "receiving response from server",
+      "receiving response from server failed",
+      "received response from server",
+  
+      "terminated",
+    );
+  
+  @property
+  def sbRemoteAddress(oSelf):
+    return b"%s:%d" % (oSelf.sbRemoteHost, oSelf.uRemotePortNumber);
+  
+  @property
+  def bTerminated(oSelf):
+    return oSelf.__bTerminated;
+  
+  @property
+  def o0SSLSession(oSelf):
+    # With TLS 1.3, the session is sent by the server after the handshake, so
+    # it may only be available once data has been read from the connection.
+    o0SSLObject = oSelf.__oStreamWriter.get_extra_info("ssl_object");
+    return o0SSLObject.session if o0SSLObject else None;
+  
+  @property
+  def bSSLSessionReused(oSelf):
+    o0SSLObject = oSelf.__oStreamWriter.get_extra_info("ssl_object");
+    return o0SSLObject.session_reused if o0SSLObject else False;
+  
+  def foGetURLForRemoteServer(oSelf):
+    # Calling this only makes sense from a client on a connection to a server.
+    return cURL(b"https" if oSelf.bSecure else b"http", oSelf.sbRemoteHost, oSelf.uRemotePortNumber);
+  
+  @ShowDebugOutput
+  def fTerminate(oSelf):
+    # Close the connection immediately. This does not wait for buffered data
+    # to be sent.
+    if oSelf.__bTerminated:
+      return fShowDebugOutput("Already terminated");
+    oSelf.__bTerminated = True;
+    oSelf.__oStreamWriter.close();
+    oSelf.fFireCallbacks("terminated");
+  
+  @ShowDebugOutput
+  def fThrowExceptionIfSendingRequestIsNotPossible(oSelf):
+    if oSelf.__bTerminated or oSelf.__oStreamReader.at_eof():
+      raise cConnectionShutdownException(
+        "The connection was shut down.",
+        o0Connection = oSelf,
+        dxDetails = {},
+      );
+    # Data the server sent while the connection was idle (e.g. a "408 Request
+    # Timeout" response sent before closing it) is buffered by the
+    # StreamReader until we read it. It has no public API to find out if it
+    # has buffered data without waiting for it, so we look at its buffer.
+    if oSelf.__abBuffer or oSelf.__oStreamReader._buffer:
+      sbOutOfBandData = oSelf.__fsbReadBufferedData() + bytes(oSelf.__oStreamReader._buffer);
+      if gbShowDebugOutput:
+        fShowDebugOutput(oSelf, "Connection has out-of-band data from server: %s: %s." % (oSelf, repr(sbOutOfBandData)));
+      oSelf.fFireCallbacks("received out-of-band data from server", sbOutOfBandData = sbOutOfBandData);
+      oSelf.fTerminate();
+      raise cConnectionOutOfBandDataException(
+        "received out-of-band data from server",
+        o0Connection = oSelf,
+        dxDetails = {"sbOutOfBandData": sbOutOfBandData},
+      );
+  
+  # Read and write bytes
+  async def __fReadMoreBytes(oSelf):
+    sbBytes = await oSelf.__oStreamReader.read(oSelf.uReadBufferSize);
+    if len(sbBytes) == 0:
+      raise cConnectionShutdownException(
+        "The connection was shut down by the remote.",
+        o0Connection = oSelf,
+        dxDetails = {"uNumberOfBufferedBytes": len(oSelf.__abBuffer)},
+      );
+    oSelf.fFireCallbacks("read bytes", sbBytes = sbBytes);
+    oSelf.__abBuffer += sbBytes;
+  
+  async def __fsb0ReadUntilMarker(oSelf, sbMarker, u0MaxNumberOfBytes):
+    # Returns the bytes up to and including the marker, or None if the marker
+    # was not found within u0MaxNumberOfBytes bytes.
+    uStartIndex = 0;
+    while 1:
+      iMarkerIndex = oSelf.__abBuffer.find(sbMarker, uStartIndex);
+      if iMarkerIndex != -1:
+        uEndIndex = iMarkerIndex + len(sbMarker);
+        if u0MaxNumberOfBytes is not None and uEndIndex > u0MaxNumberOfBytes:
+          return None;
+        sbBytes = bytes(oSelf.__abBuffer[:uEndIndex]);
+        del oSelf.__abBuffer[:uEndIndex];
+        return sbBytes;
+      if u0MaxNumberOfBytes is not None and len(oSelf.__abBuffer) >= u0MaxNumberOfBytes:
+        return None;
+      # Do not search the bytes we already searched again, except for those
+      # that could be the start of a marker that is split across reads.
+      uStartIndex = max(0, len(oSelf.__abBuffer) - len(sbMarker) + 1);
+      await oSelf.__fReadMoreBytes();
+  
+  async def __fsbReadBytes(oSelf, uNumberOfBytes):
+    while len(oSelf.__abBuffer) < uNumberOfBytes:
+      await oSelf.__fReadMoreBytes();
+    sbBytes = bytes(oSelf.__abBuffer[:uNumberOfBytes]);
+    del oSelf.__abBuffer[:uNumberOfBytes];
+    return sbBytes;
+  
+  def __fsbReadBufferedData(oSelf):
+    sbBytes = bytes(oSelf.__abBuffer);
+    oSelf.__abBuffer.clear();
+    return sbBytes;
+  
+  async def __ftxReadBytesUntilShutdown(oSelf, uNumberOfBytes):
+    # Returns uNumberOfBytes bytes, or fewer if the connection is shut down by
+    # the remote first, and whether it was.
+    while len(oSelf.__abBuffer) < uNumberOfBytes:
+      try:
+        await oSelf.__fReadMoreBytes();
+      except cConnectionShutdownException:
+        return (oSelf.__fsbReadBufferedData(), True);
+    sbBytes = bytes(oSelf.__abBuffer[:uNumberOfBytes]);
+    del oSelf.__abBuffer[:uNumberOfBytes];
+    return (sbBytes, False);
+  
+  async def __fxRunParser(oSelf, oParser, a0sbBodyParts = None):
+    # Run a parser from mMessageParser until it returns its result, performing
+    # the operations it yields and adding the body parts it produces (if any)
+    # to a0sbBodyParts.
+    xResult = None;
+    while 1:
+      try:
+        txOperation = oParser.send(xResult);
+      except StopIteration as oStopIteration:
+        return oStopIteration.value;
+      uOperation = txOperation[0];
+      if uOperation == guBodyPart:
+        a0sbBodyParts.append(txOperation[1]);
+        xResult = None;
+      elif uOperation == guReadUntilMarker:
+        xResult = await oSelf.__fsb0ReadUntilMarker(txOperation[1], txOperation[2]);
+      elif uOperation == guReadBytes:
+        xResult = await oSelf.__fsbReadBytes(txOperation[1]);
+      elif uOperation == guReadBytesUntilShutdown:
+        xResult = await oSelf.__ftxReadBytesUntilShutdown(txOperation[1]);
+      else:
+        assert uOperation == guReadBufferedData, \
+            "Unknown parser operation %s" % repr(txOperation);
+        xResult = oSelf.__fsbReadBufferedData();
+  
+  async def __fWriteBytes(oSelf, sbBytes):
+    oSelf.__oStreamWriter.write(sbBytes);
+    await oSelf.__oStreamWriter.drain();
+    oSelf.fFireCallbacks("wrote bytes", sbBytes = sbBytes);
+  
+  # Send HTTP Messages
+  @ShowDebugOutput
+  async def fSendRequest(oSelf,
+    oRequest,
+  ):
+    # Attempt to write a request to the connection.
+    # Can throw out-of-band data, shutdown or OSError exception.
+    oSelf.fThrowExceptionIfSendingRequestIsNotPossible();
+    oSelf.fFireCallbacks("sending request to server", oRequest = oRequest);
+    try:
+      await oSelf.__fSendMessage(oRequest);
+    except BaseException as oException:
+      oSelf.__o0LastSentRequest = None;
+      oSelf.fFireCallbacks("sending request to server failed", oRequest = oRequest, oException = oException);
+      oSelf.fTerminate();
+      raise;
+    oSelf.__o0LastSentRequest = oRequest;
+    oSelf.fFireCallbacks("sent request to server", oRequest = oRequest);
+  
+  @ShowDebugOutput
+  async def fSendResponse(oSelf,
+    oResponse,
+  ):
+    # Attempt to write a response to the connection.
+    # Can throw shutdown or OSError exception.
+    o0Request = oSelf.__o0LastReceivedRequest;
+    oSelf.fFireCallbacks("sending response to client", o0Request = o0Request, oResponse = oResponse);
+    try:
+      await oSelf.__fSendMessage(oResponse);
+    except BaseException as oException:
+      oSelf.__o0LastReceivedRequest = None;
+      oSelf.fFireCallbacks("sending response to client failed", o0Request = o0Request, oResponse = oResponse, oException = oException);
+      oSelf.fTerminate();
+      raise;
+    oSelf.__o0LastReceivedRequest = None;
+    oSelf.fFireCallbacks("sent response to client", o0Request = o0Request, oResponse = oResponse);
+  
+  @ShowDebugOutput
+  async def __fSendMessage(oSelf,
+    oMessage,
+  ):
+    oSelf.fFireCallbacks("sending message", oMessage = oMessage);
+    sbMessage = oMessage.fsbSerialize();
+    try:
+      await oSelf.__fWriteBytes(sbMessage);
+    except BaseException as oException:
+      oSelf.fFireCallbacks("sending message failed", oException = oException, oMessage = oMessage);
+      raise;
+    if gbShowDebugOutput:
+      fShowDebugOutput("%s sent to %s." % (oMessage, oSelf));
+    if gbDebugOutputFullHTTPMessages:
+      fShowDebugOutput(str(sbMessage, 'latin1'));
+    oSelf.fFireCallbacks("sent message", oMessage = oMessage);
+  
+  # Read HTTP Messages
+  @ShowDebugOutput
+  async def foReceiveRequest(oSelf,
+    u0zMaxStartLineSize = zNotProvided,
+    u0zMaxHeaderLineSize = zNotProvided,
+    u0zMaxNumberOfHeaders = zNotProvided,
+    u0zMaxBodySize = zNotProvided,
+    u0zMaxChunkSize = zNotProvided,
+    u0zMaxNumberOfChunks = zNotProvided, # throw exception if more than this many chunks are received
+  ):
+    # Attempt to receive a request from the connection.
+    # Returns a cRequest object.
+    # Can throw shutdown or OSError exception.
+    oSelf.fFireCallbacks("receiving request from client");
+    try:
+      oRequest = await oSelf.__foReceiveMessage(
+        cRequest,
+        u0zMaxStartLineSize = u0zMaxStartLineSize,
+        u0zMaxHeaderLineSize = u0zMaxHeaderLineSize,
+        u0zMaxNumberOfHeaders = u0zMaxNumberOfHeaders,
+        u0zMaxBodySize = u0zMaxBodySize,
+        u0zMaxChunkSize = u0zMaxChunkSize,
+        u0zMaxNumberOfChunks = u0zMaxNumberOfChunks,
+        bCanHaveBody = True,
+      );
+    except BaseException as oException:
+      oSelf.__o0LastReceivedRequest = None;
+      oSelf.fFireCallbacks("receiving request from client failed", oException = oException);
+      oSelf.fTerminate();
+      raise;
+    oSelf.__o0LastReceivedRequest = oRequest;
+    oSelf.fFireCallbacks("received request from client", oRequest = oRequest);
+    return oRequest;
+  
+  @ShowDebugOutput
+  async def foReceiveResponse(oSelf,
+    u0zMaxStartLineSize = zNotProvided,
+    u0zMaxHeaderLineSize = zNotProvided,
+    u0zMaxNumberOfHeaders = zNotProvided,
+    u0zMaxBodySize = zNotProvided,
+    u0zMaxChunkSize = zNotProvided,
+    u0zMaxNumberOfChunks = zNotProvided, # throw exception if more than this many chunks are received
+  ):
+    # Attempt to receive a response from the connection.
+    # Returns a cResponse object.
+    # Can throw shutdown or OSError exception.
+    o0Request = oSelf.__o0LastSentRequest;
+    oSelf.fFireCallbacks("receiving response from server", o0Request = o0Request);
+    try:
+      oResponse = await oSelf.__foReceiveMessage(
+        cResponse,
+        u0zMaxStartLineSize = u0zMaxStartLineSize,
+        u0zMaxHeaderLineSize = u0zMaxHeaderLineSize,
+        u0zMaxNumberOfHeaders = u0zMaxNumberOfHeaders,
+        u0zMaxBodySize = u0zMaxBodySize,
+        u0zMaxChunkSize = u0zMaxChunkSize,
+        u0zMaxNumberOfChunks = u0zMaxNumberOfChunks,
+        bCanHaveBody = o0Request is None or o0Request.sbMethod != b"HEAD", # Response to HEAD request cannot have body
+      );
+    except BaseException as oException:
+      oSelf.__o0LastSentRequest = None;
+      oSelf.fFireCallbacks("receiving response from server failed", o0Request = o0Request, oException = oException);
+      oSelf.fTerminate();
+      raise;
+    oSelf.__o0LastSentRequest = None;
+    oSelf.fFireCallbacks("received response from server", o0Request = o0Request, oResponse = oResponse);
+    return oResponse;
+  
+  @ShowDebugOutput
+  async def __foReceiveMessage(oSelf,
+    cMessage: iMessage,
+    u0zMaxStartLineSize: int | None | type(zNotProvided) = zNotProvided,
+    u0zMaxHeaderLineSize: int | None | type(zNotProvided) = zNotProvided,
+    u0zMaxNumberOfHeaders: int | None | type(zNotProvided) = zNotProvided,
+    u0zMaxBodySize: int | None | type(zNotProvided) = zNotProvided,
+    u0zMaxChunkSize: int | None | type(zNotProvided) = zNotProvided,
+    u0zMaxNumberOfChunks: int | None | type(zNotProvided) = zNotProvided,
+    bCanHaveBody: bool = True, # Only for response to HEAD request
+  ):
+    # Read and parse a HTTP message.
+    # Returns a cMessage instance.
+    u0MaxStartLineSize   = fxGetFirstProvidedValue(u0zMaxStartLineSize,   oSelf.u0DefaultMaxReasonPhraseSize);
+    u0MaxHeaderLineSize  = fxGetFirstProvidedValue(u0zMaxHeaderLineSize,  oSelf.u0DefaultMaxHeaderLineSize);
+    u0MaxNumberOfHeaders = fxGetFirstProvidedValue(u0zMaxNumberOfHeaders, oSelf.u0DefaultMaxNumberOfHeaders);
+    u0MaxBodySize        = fxGetFirstProvidedValue(u0zMaxBodySize,        oSelf.u0DefaultMaxBodySize);
+    u0MaxChunkSize       = fxGetFirstProvidedValue(u0zMaxChunkSize,       oSelf.u0DefaultMaxChunkSize);
+    u0MaxNumberOfChunks  = fxGetFirstProvidedValue(u0zMaxNumberOfChunks,  oSelf.u0DefaultMaxNumberOfChunks);
+    oSelf.fFireCallbacks("receiving message");
+    try:
+      (dxConstructorStartLineArguments, o0Headers) = await oSelf.__fxRunParser(fiterParseStartLineAndHeaders(
+        cMessage,
+        u0MaxStartLineSize = u0MaxStartLineSize,
+        u0MaxHeaderLineSize = u0MaxHeaderLineSize,
+        u0MaxNumberOfHeaders = u0MaxNumberOfHeaders,
+        o0Connection = oSelf,
+      ));
+      # (this can throw a cInvalidMessageException if multiple Content-Length headers exist with different values)
+      oMessage = cMessage(
+        o0zHeaders = o0Headers,
+        **dxConstructorStartLineArguments
+      );
+      if bCanHaveBody:
+        asbBodyParts = [];
+        b0BodyIsComplete = await oSelf.__fxRunParser(
+          fiterParseBody(
+            oMessage,
+            o0Headers,
+            u0ReadSize = None,
+            bRemoveChunkedEncoding = False,
+            u0MaxBodySize = u0MaxBodySize,
+            u0MaxChunkSize = u0MaxChunkSize,
+            u0MaxNumberOfChunks = u0MaxNumberOfChunks,
+            u0MaxTrailerLineSize = u0MaxHeaderLineSize, # We use the same value for the headers and the trailer.
+            u0MaxChunkSizeCharacters = oSelf.u0MaxChunkSizeCharacters,
+            o0Connection = oSelf,
+          ),
+          asbBodyParts,
+        );
+        if b0BodyIsComplete is not None:
+          oMessage.fSetBody(b"".join(asbBodyParts));
+    except BaseException as oException:
+      oSelf.fFireCallbacks("receiving message failed", oException = oException);
+      raise;
+    if gbShowDebugOutput:
+      fShowDebugOutput("%s received from %s." % (oMessage, oSelf));
+    if gbDebugOutputFullHTTPMessages:
+      fShowDebugOutput(str(oMessage.fsbSerialize(), 'latin1'));
+    oSelf.fFireCallbacks("received message", oMessage = oMessage);
+    return oMessage;
+  
+  @ShowDebugOutput
+  async def foSendRequestAndReceiveResponse(oSelf,
+    # Send request arguments:
+    oRequest,
+    # Receive response arguments:
+    u0zMaxStartLineSize = zNotProvided,
+    u0zMaxHeaderLineSize = zNotProvided,
+    u0zMaxNumberOfHeaders = zNotProvided,
+    u0zMaxBodySize = zNotProvided,
+    u0zMaxChunkSize = zNotProvided,
+    u0zMaxNumberOfChunks = zNotProvided,
+  ):
+    await oSelf.fSendRequest(oRequest);
+    return await oSelf.foReceiveResponse(
+      u0zMaxStartLineSize = u0zMaxStartLineSize,
+      u0zMaxHeaderLineSize = u0zMaxHeaderLineSize,
+      u0zMaxNumberOfHeaders = u0zMaxNumberOfHeaders,
+      u0zMaxBodySize = u0zMaxBodySize,
+      u0zMaxChunkSize = u0zMaxChunkSize,
+      u0zMaxNumberOfChunks = u0zMaxNumberOfChunks,
+    );
+  
+  def fasGetDetails(oSelf):
+    return [s for s in [
+      "%s:%d" % (str(oSelf.sbRemoteIPAddress, "ascii", "strict"), oSelf.uRemotePortNumber),
+      "secure" if oSelf.bSecure else None,
+      "resumed TLS session" if oSelf.bSSLSessionReused else None,
+      "terminated" if oSelf.__bTerminated else None,
+    ] if s];
+  
+  def __repr__(oSelf):
+    sModuleName = ".".join(oSelf.__class__.__module__.split(".")[:-1]);
+    return "<%s.%s#%X|%s>" % (sModuleName, oSelf.__class__.__name__, id(oSelf), "|".join(oSelf.fasGetDetails()));
+  
+  def __str__(oSelf):
+    return "%s#%X{%s}" % (oSelf.__class__.__name__, id(oSelf), ", ".join(oSelf.fasGetDetails()));
@@ -0,0 +1,446 @@
+import asyncio, time;
+
+from mMultiThreading import cWithCallbacks;
+from mNotProvided import (
+  fxGetFirstProvidedValue,
+  zNotProvided,
+);
+
+from .cAsyncConnection import cAsyncConnection;
+from .mExceptions import  (
+  cConnectionOutOfBandDataException,
+  cConnectionShutdownException,
+  cMaximumNumberOfConnectionsToServerReachedException,
+);
+from .mOptionalDebugOutput import (
+  fShowDebugOutput,
+  gbShowDebugOutput,
+  ShowDebugOutput,
+);
+
+gu0DefaultMaxNumberOfConnectionsToServer = 10;
+
+# This is the asyncio counterpart of cConnectionsToServerPool. All tasks that
+# use a pool must run in the same event loop; since tasks only switch at
+# `await`, the pool's state needs no locks.
+class cAsyncConnectionsToServerPool(cWithCallbacks):
+  @ShowDebugOutput
+  def __init__(oSelf,
+    oServerBaseURL,
+    *,
+    u0zMaxNumberOfConnectionsToServer = zNotProvided,
+    o0SSLContext = None,
+    bWaitForFreeConnection = False,
+  ):
+    oSelf.__oServerBaseURL = oServerBaseURL;
+    oSelf.__u0MaxNumberOfConnectionsToServer = fxGetFirstProvidedValue(u0zMaxNumberOfConnectionsToServer, gu0DefaultMaxNumberOfConnectionsToServer);
+    oSelf.__o0SSLContext = o0SSLContext;
+    # The TLS session of the last secure connection to each server, which
+    # new connections to that server try to resume.
+    oSelf.__doSSLSession_by_txServer = {};
+    oSelf.__uTLSHandshakesCount = 0;
+    oSelf.__uResumedTLSSessionsCount = 0;
+    oSelf.__nTotalTLSHandshakeTimeInSeconds = 0;
+  
+    oSelf.__aoConnections = [];
+    # The connections that are not in use. This is used as a stack, so the
+    # most recently used connection is reused first.
+    oSelf.__aoIdleConnections = [];
+    oSelf.__uPendingConnects = 0;
+    # If bWaitForFreeConnection is True, requests that cannot get a connection
+    # because the maximum number of connections has been reached wait for one
+    # to become available. Each waiting request has a future in this list,
+    # which gets the connection that is handed over to it as its result, or
+    # None if a new connection can be created (first-in, first-out).
+    oSelf.__bWaitForFreeConnection = bWaitForFreeConnection;
+    oSelf.__aoWaitingForConnectionFutures = [];
+  
+    oSelf.__bStopping = False;
+    oSelf.__bTerminated = False;
+  
+    oSelf.fAddEvents(
+      "creating connection to server",
+      "creating connection to server failed",
+      "created connection to server",
+      "terminated connection to server",
+  
+      "read bytes",
+      "wrote bytes",
+  
+      "sending request to server",
+      "sending request to server failed",
+      "sent request to server",
+  
+      "receiving response from server",
+      "receiving response from server failed",
+      "received response from server",
+  
+      "received out-of-band data from server",
+  
+      "terminated"
+    );
+  
+  @property
+  def bTerminated(oSelf):
+    return oSelf.__bTerminated;
+  
+  @property
+  def uConnectionsCount(oSelf):
+    return len(oSelf.__aoConnections);
+  
+  @property
+  def uIdleConnectionsCount(oSelf):
+    return len(oSelf.__aoIdleConnections);
+  
+  @property
+  def uWaitingForConnectionCount(oSelf):
+    return len(oSelf.__aoWaitingForConnectionFutures);
+  
+  @property
+  def uTLSHandshakesCount(oSelf):
+    return oSelf.__uTLSHandshakesCount;
+  
+  @property
+  def uResumedTLSSessionsCount(oSelf):
+    return oSelf.__uResumedTLSSessionsCount;
+  
+  @property
+  def n0TLSSessionResumptionRate(oSelf):
+    # The fraction of TLS handshakes that resumed an earlier session.
+    if not oSelf.__uTLSHandshakesCount:
+      return None;
+    return oSelf.__uResumedTLSSessionsCount / oSelf.__uTLSHandshakesCount;
+  
+  @property
+  def n0AverageTLSHandshakeTimeInSeconds(oSelf):
+    # asyncio connects and secures a connection in one step, so this includes
+    # the time needed to connect.
+    if not oSelf.__uTLSHandshakesCount:
+      return None;
+    return oSelf.__nTotalTLSHandshakeTimeInSeconds / oSelf.__uTLSHandshakesCount;
+  
+  @ShowDebugOutput
+  def __fReportTerminatedIfNoMoreConnectionsExist(oSelf):
+    assert oSelf.__bStopping, \
+        "This functions should not be called if we are not stopping!";
+    if oSelf.__aoConnections:
+      fShowDebugOutput("There are %d connections left." % len(oSelf.__aoConnections));
+      return;
+    if oSelf.__bTerminated:
+      return; # Already terminated
+    oSelf.__bTerminated = True;
+    fShowDebugOutput("cAsyncConnectionsToServerPool terminated.");
+    oSelf.fFireCallbacks("terminated");
+  
+  @ShowDebugOutput
+  def fStop(oSelf):
+    # Idle connections are terminated immediately; connections that are in
+    # use are terminated as soon as their request has completed.
+    if oSelf.__bTerminated:
+      return fShowDebugOutput("Already terminated");
+    if oSelf.__bStopping:
+      return fShowDebugOutput("Already stopping");
+    fShowDebugOutput("Stopping...");
+    oSelf.__bStopping = True;
+    oSelf.__fHandOverConnectionToAllWaitingRequests(None);
+    for oConnection in oSelf.__aoIdleConnections[:]:
+      oConnection.fTerminate();
+    oSelf.__fReportTerminatedIfNoMoreConnectionsExist();
+  
+  @ShowDebugOutput
+  def fTerminate(oSelf):
+    if oSelf.__bTerminated:
+      return fShowDebugOutput("Already terminated");
+    fShowDebugOutput("Terminating...");
+    oSelf.__bStopping = True;
+    oSelf.__fHandOverConnectionToAllWaitingRequests(None);
+    for oConnection in oSelf.__aoConnections[:]:
+      oConnection.fTerminate();
+    oSelf.__fReportTerminatedIfNoMoreConnectionsExist();
+  
+  @ShowDebugOutput
+  async def __fo0GetConnection(oSelf,
+    n0zConnectTimeoutInSeconds,
+  ):
+    n0ConnectTimeoutInSeconds = fxGetFirstProvidedValue(n0zConnectTimeoutInSeconds, cAsyncConnection.n0DefaultConnectTimeoutInSeconds);
+    n0EndTime = (time.time() + n0ConnectTimeoutInSeconds) if n0ConnectTimeoutInSeconds is not None else None;
+    while not oSelf.__bStopping:
+      # Existing idle connections may be used:
+      while oSelf.__aoIdleConnections:
+        oConnection = oSelf.__aoIdleConnections.pop();
+        if oSelf.__fbConnectionIsUsable(oConnection):
+          return oConnection;
+      # New connections may be established:
+      if (
+        oSelf.__u0MaxNumberOfConnectionsToServer is None
+        or len(oSelf.__aoConnections) + oSelf.__uPendingConnects < oSelf.__u0MaxNumberOfConnectionsToServer
+      ):
+        return await oSelf.__foCreateNewConnection(
+          (n0EndTime - time.time()) if n0EndTime is not None else None,
+        );
+      if not oSelf.__bWaitForFreeConnection:
+        raise cMaximumNumberOfConnectionsToServerReachedException(
+          "Maximum number of connections to server reached.",
+          dxDetails = {
+            "bServerIsAProxy": False,
+            "uMaxNumberOfConnections": oSelf.__u0MaxNumberOfConnectionsToServer, # Cannot be None at this point
+          },
+        );
+      # Wait for a connection to be handed over to us, or for one to be
+      # terminated, which allows a new one to be created.
+      o0Connection = await oSelf.__fo0WaitForFreeConnection(n0EndTime);
+      if o0Connection is not None and oSelf.__fbConnectionIsUsable(o0Connection):
+        return o0Connection;
+    return None;
+  
+  @ShowDebugOutput
+  async def __fo0WaitForFreeConnection(oSelf,
+    n0EndTime,
+  ):
+    oWaitingForConnectionFuture = asyncio.get_running_loop().create_future();
+    oSelf.__aoWaitingForConnectionFutures.append(oWaitingForConnectionFuture);
+    fShowDebugOutput("Waiting for a free connection...");
+    nStartTime = time.time();
+    try:
+      return await asyncio.wait_for(
+        oWaitingForConnectionFuture,
+        max(0, n0EndTime - time.time()) if n0EndTime is not None else None,
+      );
+    except asyncio.TimeoutError:
+      # A connection may have been handed over just as we timed out.
+      if oWaitingForConnectionFuture.done() and not oWaitingForConnectionFuture.cancelled():
+        return oWaitingForConnectionFuture.result();
+      raise cMaximumNumberOfConnectionsToServerReachedException(
+        "Maximum number of connections to server reached and none became available in time.",
+        dxDetails = {
+          "bServerIsAProxy": False,
+          "uMaxNumberOfConnections": oSelf.__u0MaxNumberOfConnectionsToServer, # Cannot be None at this point
+          "nWaitTimeInSeconds": time.time() - nStartTime,
+        },
+      );
+    finally:
+      if oWaitingForConnectionFuture in oSelf.__aoWaitingForConnectionFutures:
+        oSelf.__aoWaitingForConnectionFutures.remove(oWaitingForConnectionFuture);
+  
+  def __fbHandOverConnectionToFirstWaitingRequest(oSelf, o0Connection):
+    # Returns True if there was a request waiting for a connection.
+    while oSelf.__aoWaitingForConnectionFutures:
+      oWaitingForConnectionFuture = oSelf.__aoWaitingForConnectionFutures.pop(0);
+      if not oWaitingForConnectionFuture.done(): # it may have been cancelled.
+        oWaitingForConnectionFuture.set_result(o0Connection);
+        return True;
+    return False;
+  
+  def __fHandOverConnectionToAllWaitingRequests(oSelf, o0Connection):
+    while oSelf.__fbHandOverConnectionToFirstWaitingRequest(o0Connection):
+      pass;
+  
+  @ShowDebugOutput
+  def __fbConnectionIsUsable(oSelf, oConnection):
+    try:
+      oConnection.fThrowExceptionIfSendingRequestIsNotPossible();
+    except cConnectionShutdownException:
+      if gbShowDebugOutput:
+        fShowDebugOutput(oSelf, "Connection shut down: %s." % oConnection);
+      oConnection.fTerminate();
+    except cConnectionOutOfBandDataException:
+      if gbShowDebugOutput:
+        fShowDebugOutput(oSelf, "Connection received out-of-band data: %s." % oConnection);
+    else:
+      if gbShowDebugOutput:
+        fShowDebugOutput(oSelf, "Reusing existing connection to server: %s." % oConnection);
+      return True;
+    return False;
+  
+  @ShowDebugOutput
+  async def __foCreateNewConnection(oSelf,
+    n0ConnectTimeoutInSeconds,
+  ):
+    sbHost = oSelf.__oServerBaseURL.sbHost;
+    uPortNumber = oSelf.__oServerBaseURL.uPortNumber;
+    oSelf.__uPendingConnects += 1;
+    oSelf.fFireCallbacks(
+      "creating connection to server",
+      sbHost = sbHost,
+      uPortNumber = uPortNumber,
+    );
+    nStartTime = time.perf_counter();
+    try:
+      oConnection = await cAsyncConnection.foConnectTo(
+        sbHost = sbHost,
+        uPortNumber = uPortNumber,
+        n0zConnectTimeoutInSeconds = n0ConnectTimeoutInSeconds,
+        o0SSLContext = oSelf.__o0SSLContext,
+        o0SSLSession = oSelf.__doSSLSession_by_txServer.get((sbHost, uPortNumber)),
+      );
+    except BaseException as oException:
+      oSelf.__uPendingConnects -= 1;
+      oSelf.fFireCallbacks(
+        "creating connection to server failed",
+        sbHost = sbHost,
+        uPortNumber = uPortNumber,
+        oException = oException,
+      );
+      # A new connection can be created by the first request that is waiting for one.
+      oSelf.__fbHandOverConnectionToFirstWaitingRequest(None);
+      raise;
+    oSelf.__uPendingConnects -= 1;
+    if oConnection.bSecure:
+      oSelf.__uTLSHandshakesCount += 1;
+      oSelf.__nTotalTLSHandshakeTimeInSeconds += time.perf_counter() - nStartTime;
+      if oConnection.bSSLSessionReused:
+        oSelf.__uResumedTLSSessionsCount += 1;
+      oSelf.__fSaveSSLSession(oConnection);
+    oSelf.__aoConnections.append(oConnection);
+    oSelf.fFireCallbacks(
+      "created connection to server",
+      sbHost = sbHost,
+      uPortNumber = uPortNumber,
+      oConnection = oConnection,
+    );
+    oConnection.fAddCallbacks({
+      "wrote bytes": lambda oConnection, *, sbBytes: oSelf.fFireCallbacks(
+        "wrote bytes",
+        oConnection = oConnection,
+        sbBytes = sbBytes,
+      ),
+      "read bytes": lambda oConnection, *, sbBytes: oSelf.fFireCallbacks(
+        "read bytes",
+        oConnection = oConnection,
+        sbBytes = sbBytes,
+      ),
+      "received out-of-band data from server": lambda oConnection, *, sbOutOfBandData: oSelf.fFireCallbacks(
+        "received out-of-band data from server",
+        oConnection = oConnection,
+        sbOutOfBandData = sbOutOfBandData,
+      ),
+      "sending request to server": lambda oConnection, *, oRequest: oSelf.fFireCallbacks(
+        "sending request to server",
+        oConnection = oConnection,
+        oRequest = oRequest,
+      ),
+      "sending request to server failed": lambda oConnection, *, oRequest, oException: oSelf.fFireCallbacks(
+        "sending request to server failed",
+        oConnection = oConnection,
+        oRequest = oRequest,
+        oException = oException,
+      ),
+      "sent request to server": lambda oConnection, *, oRequest: oSelf.fFireCallbacks(
+        "sent request to server",
+        oConnection = oConnection,
+        oRequest = oRequest,
+      ),
+      "receiving response from server": lambda oConnection, *, o0Request: oSelf.fFireCallbacks(
+        "receiving response from server",
+        oConnection = oConnection,
+        o0Request = o0Request,
+      ),
+      "receiving response from server failed": lambda oConnection, *, o0Request, oException: oSelf.fFireCallbacks(
+        "receiving response from server failed",
+        oConnection = oConnection,
+        o0Request = o0Request,
+        oException = oException,
+      ),
+      "received response from server": lambda oConnection, *, o0Request, oResponse: oSelf.fFireCallbacks(
+        "received response from server",
+        oConnection = oConnection,
+        o0Request = o0Request,
+        oResponse = oResponse,
+      ),
+      "terminated": oSelf.__fHandleTerminatedCallbackFromConnection,
+    });
+    return oConnection;
+  
+  def __fSaveSSLSession(oSelf, oConnection):
+    o0SSLSession = oConnection.o0SSLSession;
+    if o0SSLSession is not None:
+      oSelf.__doSSLSession_by_txServer[(oConnection.sbRemoteHost, oConnection.uRemotePortNumber)] = o0SSLSession;
+  
+  @ShowDebugOutput
+  def __fReleaseConnection(oSelf, oConnection):
+    # Called when a request has completed and the connection can be reused.
+    # With TLS 1.3 the server sends the session after the handshake, so we
+    # can only save it once a response has been received.
+    if oConnection.bSecure:
+      oSelf.__fSaveSSLSession(oConnection);
+    if oSelf.__bStopping:
+      oConnection.fTerminate();
+    elif not oSelf.__fbHandOverConnectionToFirstWaitingRequest(oConnection):
+      oSelf.__aoIdleConnections.append(oConnection);
+  
+  @ShowDebugOutput
+  def __fHandleTerminatedCallbackFromConnection(oSelf, oConnection):
+    if oConnection not in oSelf.__aoConnections:
+      return;
+    oSelf.__aoConnections.remove(oConnection);
+    if oConnection in oSelf.__aoIdleConnections:
+      oSelf.__aoIdleConnections.remove(oConnection);
+    oSelf.fFireCallbacks("terminated connection to server", oConnection = oConnection);
+    if oSelf.__bStopping:
+      oSelf.__fReportTerminatedIfNoMoreConnectionsExist();
+    else:
+      # A new connection can be created by the first request that is waiting for one.
+      oSelf.__fbHandOverConnectionToFirstWaitingRequest(None);
+  
+  @ShowDebugOutput
+  async def fo0SendRequestAndReceiveResponse(oSelf,
+    oRequest,
+    n0zConnectTimeoutInSeconds = zNotProvided,
+    n0zTransactionTimeoutInSeconds = zNotProvided,
+    u0zMaxStartLineSize = zNotProvided,
+    u0zMaxHeaderLineSize = zNotProvided,
+    u0zMaxNumberOfHeaders = zNotProvided,
+    u0zMaxBodySize = zNotProvided,
+    u0zMaxChunkSize = zNotProvided,
+    u0zMaxNumberOfChunks = zNotProvided,
+  ):
+    # Returns a cResponse object, or None if the pool is stopping.
+    o0Connection = await oSelf.__fo0GetConnection(n0zConnectTimeoutInSeconds);
+    if o0Connection is None:
+      assert oSelf.__bStopping, \
+          "A new connection was not established even though we are not stopping!?";
+      return None;
+    oConnection = o0Connection;
+    n0TransactionTimeoutInSeconds = fxGetFirstProvidedValue(n0zTransactionTimeoutInSeconds, cAsyncConnection.n0DefaultTransactionTimeoutInSeconds);
+    try:
+      oResponse = await asyncio.wait_for(
+        oConnection.foSendRequestAndReceiveResponse(
+          oRequest,
+          u0zMaxStartLineSize = u0zMaxStartLineSize,
+          u0zMaxHeaderLineSize = u0zMaxHeaderLineSize,
+          u0zMaxNumberOfHeaders = u0zMaxNumberOfHeaders,
+          u0zMaxBodySize = u0zMaxBodySize,
+          u0zMaxChunkSize = u0zMaxChunkSize,
+          u0zMaxNumberOfChunks = u0zMaxNumberOfChunks,
+        ),
+        n0TransactionTimeoutInSeconds,
+      );
+    except BaseException:
+      # The state of the connection is unknown (e.g. on timeout or if the task
+      # was cancelled), so it cannot be reused.
+      oConnection.fTerminate();
+      raise;
+    if oResponse.fbHasConnectionCloseHeader():
+      oConnection.fTerminate();
+    else:
+      oSelf.__fReleaseConnection(oConnection);
+    return oResponse;
+  
+  def fasGetDetails(oSelf):
+    uConnectionsCount = oSelf.uConnectionsCount;
+    bTerminated = oSelf.bTerminated;
+    return [s for s in [
+      str(oSelf.__oServerBaseURL.sbBase, 'latin1'),
+      "%d connections" % uConnectionsCount if not bTerminated else None,
+      "secure" if oSelf.__o0SSLContext else None,
+      "%d/%d TLS sessions resumed" % (oSelf.__uResumedTLSSessionsCount, oSelf.__uTLSHandshakesCount) if oSelf.__uTLSHandshakesCount else None,
+      "terminated" if bTerminated else
+          "stopping" if oSelf.__bStopping else None,
+    ] if s];
+  
+  def __repr__(oSelf):
+    sModuleName = ".".join(oSelf.__class__.__module__.split(".")[:-1]);
+    return "<%s.%s#%X|%s>" % (sModuleName, oSelf.__class__.__name__, id(oSelf), "|".join(oSelf.fasGetDetails()));
+  
+  def __str__(oSelf):
+    return "%s#%X{%s}" % (oSelf.__class__.__name__, id(oSelf), ", ".join(oSelf.fasGetDetails()));
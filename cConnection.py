@@ -1,10 +1,4 @@
-try: # mDebugOutput use is Optional
-  from mDebugOutput import ShowDebugOutput, fShowDebugOutput;
-except ModuleNotFoundError as oException:
-  if oException.args[0] != "No module named 'mDebugOutput'":
-    raise;
-  ShowDebugOutput = lambda fx: fx; # NOP
-  fShowDebugOutput = lambda x, s0 = None: x; # NOP
+import time;
 
 from mHTTPProtocol import (
   cHeaders,
@@ -19,31 +13,88 @@ from mNotProvided import (
   zNotProvided,
 );
 from mTCPIPConnection import (
-  cTransactionalBufferedTCPIPConnection
+  cTCPIPConnectionDisconnectedException,
+  cTCPIPConnectionShutdownException,
+  cTransactionalBufferedTCPIPConnection,
 );
 
+from .cContentDecoder import (
+  cContentDecoder,
+  gsbAcceptEncodingHeaderValue,
+);
+from .cContentEncoder import (
+  cContentEncoder,
+  fasbGetLowerHeaderValues,
+);
+from .cMetrics import cMetrics;
+from .cWithLazyCallbacks import cWithLazyCallbacks;
 from .mExceptions import (
+  cBodySourceSizeMismatchException,
   cConnectionOutOfBandDataException,
 );
+from .mMessageParser import (
+  fiterParseBody,
+  fiterParseStartLineAndHeaders,
+  guBodyPart,
+  guReadBufferedData,
+  guReadBytes,
+  guReadBytesUntilShutdown,
+  guReadUntilMarker,
+);
+from .mOptionalDebugOutput import (
+  fShowDebugOutput,
+  gbShowDebugOutput,
+  ShowDebugOutput,
+);
 
 gbDebugOutputFullHTTPMessages = False;
+# Once the body of a message has been decoded, these headers no longer apply to
+# it; they are replaced with a "Content-Length" header for the decoded body.
+gasbLowerHeaderNamesRemovedFromDecodedMessages = [b"content-encoding", b"content-length", b"transfer-encoding"];
 
-class cConnection(cTransactionalBufferedTCPIPConnection):
+# cWithLazyCallbacks makes firing the many events for which there are usually no
+# callbacks cheap.
+class cConnection(cWithLazyCallbacks, cTransactionalBufferedTCPIPConnection):
   u0DefaultMaxReasonPhraseSize = 1000;
   u0DefaultMaxHeaderLineSize = 10*1000;
   u0DefaultMaxNumberOfHeaders = 256;
   u0DefaultMaxBodySize = 1000*1000*1000;
   u0DefaultMaxChunkSize = 10*1000*1000;
   u0DefaultMaxNumberOfChunks = 1000*1000;
+  uDefaultBodyChunkSize = 64*1024; # Size of the parts in which bodies are streamed to and from the connection.
+  # Bodies smaller than this are joined with the start line and headers and
+  # written at once; larger bodies are written without copying them.
+  uMinimumBodySizeForSeparateWrites = 64*1024;
+  # Compressing bodies smaller than this saves too little to be worth the CPU.
+  uMinimumBodySizeForCompression = 1024;
+  uDefaultCompressionLevel = 6;
   n0DefaultTransactionTimeoutInSeconds = 10;
   # The HTTP RFC does not provide an upper limit to the maximum number of characters a chunk size can contain.
   # So, by padding a valid chunk size on the left with "0", one could theoretically create a valid chunk header that has
   # an infinite size. To prevent us accepting such an obviously invalid value, we will accept no chunk size containing
   # more than 16 chars (i.e. 64-bit numbers).
   u0MaxChunkSizeCharacters = 16;
-  def __init__(oSelf, *txArguments, **dxArguments):
-    super().__init__(*txArguments, **dxArguments);
+  # Only requests using these methods can safely be pipelined, as they do not
+  # change anything on the server and can be sent again if the server closes
+  # the connection before responding to them. Idempotent methods such as PUT
+  # and DELETE are not included: a request that follows one may see the server
+  # in a state that differs from the one the client expects after a failure.
+  asbPipelinableMethods = [b"GET", b"HEAD", b"OPTIONS", b"TRACE"];
+  def __init__(oSelf, oPythonSocket, *txArguments, **dxArguments):
+    super().__init__(oPythonSocket, *txArguments, **dxArguments);
+    # We keep a reference to the plain socket so we can let the OS send files
+    # directly over it for connections that are not secured.
+    oSelf.__oPythonSocket = oPythonSocket;
+    oSelf.__o0LastSentRequest = None;
+    oSelf.__o0LastReceivedRequest = None;
+    oSelf.__dx0StreamedBodyDetails = None;
+    # Counters and histograms for this connection; see cMetrics. Bytes read and
+    # written are counted per message, not per read or write.
+    oSelf.oMetrics = cMetrics();
+    oSelf.__n0RequestSentTime = None; # Used to measure the time to first byte of the response.
     oSelf.fAddEvents(
+      "ended transaction",
+      
       "sending message",
       "sending message failed",
       "sent message",
@@ -71,6 +122,51 @@ class cConnection(cTransactionalBufferedTCPIPConnection):
       "received response from server",
     );
   
+  @property
+  def oPythonSocket(oSelf):
+    # The plain socket this connection was created for; this can be used to
+    # wait for the connection to become readable using `selectors`.
+    return oSelf.__oPythonSocket;
+  
+  # A connections pool that resolves the hostname of the server itself
+  # connects to an IP address, which mTCPIPConnection then reports as the
+  # remote host. The pool sets the hostname using `fSetRemoteHostname`, so
+  # sbRemoteHost (and the URL for the remote server) uses the hostname again.
+  __sb0RemoteHostname = None;
+  __sb0RemoteHost = None;
+  @property
+  def sbRemoteHost(oSelf):
+    if oSelf.__sb0RemoteHostname is not None:
+      return oSelf.__sb0RemoteHostname;
+    if oSelf.__sb0RemoteHost is not None:
+      return oSelf.__sb0RemoteHost;
+    return super().sbRemoteHost;
+  @sbRemoteHost.setter
+  def sbRemoteHost(oSelf, sbRemoteHost):
+    oSelf.__sb0RemoteHost = sbRemoteHost;
+  
+  def fSetRemoteHostname(oSelf, sbHostname):
+    oSelf.__sb0RemoteHostname = sbHostname;
+
+  def fStartTransaction(oSelf, *txArguments, **dxArguments):
+    super().fStartTransaction(*txArguments, **dxArguments);
+    oSelf.oMetrics.fAddToCounter("transactions");
+  
+  def fEndTransaction(oSelf, *txArguments, **dxArguments):
+    if oSelf.__dx0StreamedBodyDetails is not None:
+      # The body of a response received using foReceiveResponseHeaders was not
+      # read (e.g. the generator returned by fiterBodyChunks was never started,
+      # so it cannot clean up when it is discarded). The rest of the body
+      # cannot be skipped, so the connection cannot be used anymore.
+      if gbShowDebugOutput:
+        fShowDebugOutput("Body of %s was not read; disconnecting %s." % (oSelf.__dx0StreamedBodyDetails["oResponse"], oSelf));
+      oSelf.__dx0StreamedBodyDetails = None;
+      oSelf.__o0LastSentRequest = None;
+      oSelf.fDisconnect();
+    super().fEndTransaction(*txArguments, **dxArguments);
+    # Let others (e.g. a connections pool) know this connection is available again.
+    oSelf.fFireCallbacks("ended transaction");
+  
   def foGetURLForRemoteServer(oSelf):
     # Calling this only makes sense from a client on a connection to a server.
     return cURL(b"https" if oSelf.bSecure else b"http", oSelf.sbRemoteHost, oSelf.uRemotePortNumber);
@@ -80,6 +176,7 @@ class cConnection(cTransactionalBufferedTCPIPConnection):
     oSelf.fThrowExceptionIfShutdownOrDisconnected();
     if oSelf.fbBytesAreAvailableForReading():
       sbOutOfBandData = oSelf.fsbReadAvailableBytes();
+      oSelf.oMetrics.fAddToCounter("bytes read", len(sbOutOfBandData));
       fShowDebugOutput(oSelf, "Connection has out-of-band data from server: %s: %s." % (oSelf, repr(sbOutOfBandData)));
       oSelf.fFireCallbacks("received out-of-band data from server", sbOutOfBandData = sbOutOfBandData);
       oSelf.fTerminate();
@@ -93,6 +190,9 @@ class cConnection(cTransactionalBufferedTCPIPConnection):
   @ShowDebugOutput
   def fSendRequest(oSelf,
     oRequest,
+    *,
+    x0BodySource = None,
+    bAcceptEncodedBody = False,
   ):
     oSelf.fThrowExceptionIfSendingRequestIsNotPossible();
     # Attempt to write a request to the connection.
@@ -101,56 +201,363 @@ class cConnection(cTransactionalBufferedTCPIPConnection):
     #   appropriate if this is not the case.
     # * The connection must not have any buffered data from the server. An
     #   `out-of-band data` exception is thrown if there is data in the buffer.
+    # * If x0BodySource is provided, the request body is read from it while it
+    #   is being sent; see `__fSendMessage` for details.
+    # * If bAcceptEncodedBody is True, an "Accept-Encoding" header for the
+    #   encodings `foReceiveResponse` can decode is sent, unless the request
+    #   already has one. The request itself is not modified.
     # Can throw out-of-band data, timeout, shutdown or disconnected exception.
     oSelf.fFireCallbacks("sending request to server", oRequest = oRequest);
+    asbAdditionalHeaderLines = (
+      [b"Accept-Encoding: " + gsbAcceptEncodingHeaderValue]
+      if bAcceptEncodedBody and not any(
+        sbHeaderLine.split(b":", 1)[0].strip().lower() == b"accept-encoding"
+        for sbHeaderLine in oRequest.oHeaders.fasbSerializeLines()
+      ) else []
+    );
     try:
-      oSelf.__fSendMessage(oRequest);
+      oSelf.__fSendMessage(oRequest, x0BodySource, asbAdditionalHeaderLines);
     except Exception as oException:
       oSelf.__o0LastSentRequest = None;
       oSelf.fFireCallbacks("sending request to server failed", oRequest = oRequest, oException = oException);
       oSelf.fTerminate();
       raise;
     oSelf.__o0LastSentRequest = oRequest;
+    oSelf.__n0RequestSentTime = time.perf_counter();
+    oSelf.oMetrics.fAddToCounter("requests sent");
     oSelf.fFireCallbacks( "sent request to server", oRequest = oRequest);
     return True;
   
   @ShowDebugOutput
   def fSendResponse(oSelf,
     oResponse,
+    *,
+    x0BodySource = None,
+    bCompressBody = False,
+    uzCompressionLevel = zNotProvided,
   ):
     o0Request = oSelf.__o0LastReceivedRequest;
     oSelf.fFireCallbacks("sending response to client", o0Request = o0Request, oResponse = oResponse);
     # Attempt to write a response to the connection.
+    # If x0BodySource is provided, the response body is read from it while it
+    # is being sent; see `__fSendMessage` for details.
+    # If bCompressBody is True, the body is compressed while it is being sent,
+    # using an encoding accepted by the request we last received; see
+    # `__ft0xGetCompressedResponseAndBodySource` for details. oResponse itself
+    # is not modified.
     # Can throw timeout, shutdown or disconnected exception.
     try:
-      oSelf.__fSendMessage(oResponse);
+      t0xCompressedResponseAndBodySource = oSelf.__ft0xGetCompressedResponseAndBodySource(
+        o0Request,
+        oResponse,
+        x0BodySource,
+        fxGetFirstProvidedValue(uzCompressionLevel, oSelf.uDefaultCompressionLevel),
+      ) if bCompressBody else None;
+      if t0xCompressedResponseAndBodySource is not None:
+        oSelf.__fSendMessage(*t0xCompressedResponseAndBodySource);
+        oSelf.oMetrics.fAddToCounter("responses compressed");
+      else:
+        oSelf.__fSendMessage(oResponse, x0BodySource);
     except Exception as oException:
       oSelf.__o0LastReceivedRequest = None;
       oSelf.fFireCallbacks("sending response to client failed", o0Request = o0Request, oResponse = oResponse, oException = oException);
       oSelf.fTerminate();
       raise;
     oSelf.__o0LastReceivedRequest = None;
+    oSelf.oMetrics.fAddToCounter("responses sent");
     oSelf.fFireCallbacks("sent response to client", o0Request = o0Request, oResponse = oResponse);
   
+  @ShowDebugOutput
+  def __ft0xGetCompressedResponseAndBodySource(oSelf,
+    o0Request,
+    oResponse,
+    x0BodySource,
+    uCompressionLevel,
+  ):
+    # Returns a copy of the response with headers for a compressed, chunked
+    # body and an iterator that yields the compressed body while it is read
+    # from x0BodySource or the response, or None if the body should not be
+    # compressed. This is the case if the client does not accept any encoding
+    # we support or does not support chunked encoding (HTTP/1.0), the body is
+    # small or has a media type that is usually compressed already, or the
+    # response already has a "Content-Encoding".
+    # A chunked response is only compressed if its body comes from
+    # x0BodySource, as its own body would already have chunked encoding.
+    if o0Request is None:
+      return None;
+    # Chunked encoding must not be sent to HTTP/1.0 clients (RFC 9112 section 6.1).
+    if o0Request.sbVersion.upper() in [b"HTTP/0.9", b"HTTP/1.0"]:
+      return None;
+    oHeaders = oResponse.oHeaders;
+    if fasbGetLowerHeaderValues(oHeaders, b"content-encoding"):
+      return None;
+    if x0BodySource is None:
+      if oResponse.fbHasChunkedEncodingHeader() or len(oResponse.sbBody) < oSelf.uMinimumBodySizeForCompression:
+        return None;
+    elif not oResponse.fbHasChunkedEncodingHeader():
+      u0ContentLength = oHeaders.fu0GetContentLength(None);
+      if u0ContentLength is not None and u0ContentLength < oSelf.uMinimumBodySizeForCompression:
+        return None;
+    asbLowerContentTypes = fasbGetLowerHeaderValues(oHeaders, b"content-type");
+    if not cContentEncoder.fbIsCompressibleMediaType(asbLowerContentTypes[0] if asbLowerContentTypes else None):
+      return None;
+    sb0LowerEncoding = cContentEncoder.fsb0GetEncodingAcceptedByRequest(o0Request);
+    if sb0LowerEncoding is None:
+      return None;
+    oContentEncoder = cContentEncoder(sb0LowerEncoding, uCompressionLevel);
+    asbCompressedResponseHeaderLines = [
+      sbHeaderLine
+      for sbHeaderLine in oHeaders.fasbSerializeLines()
+      if sbHeaderLine.split(b":", 1)[0].strip().lower() not in [b"content-length", b"transfer-encoding"]
+    ] + [
+      b"Content-Encoding: " + sb0LowerEncoding,
+      b"Transfer-Encoding: chunked",
+    ];
+    if b"accept-encoding" not in fasbGetLowerHeaderValues(oHeaders, b"vary"):
+      # Caches must not give the compressed body to clients that do not accept it.
+      asbCompressedResponseHeaderLines.append(b"Vary: Accept-Encoding");
+    oCompressedResponse = oResponse.__class__(
+      o0zHeaders = cHeaders.foDeserializeLines(asbCompressedResponseHeaderLines),
+      **oResponse.fdxDeserializeStartLine(oResponse.fsbSerializeStartLine()),
+    );
+    if gbShowDebugOutput:
+      fShowDebugOutput("Compressing body of %s using %s..." % (oResponse, oContentEncoder));
+    return (
+      oCompressedResponse,
+      oContentEncoder.fiterEncode(oSelf.__fiterReadBodySource(
+        x0BodySource if x0BodySource is not None else oResponse.sbBody
+      )),
+    );
+  
   @ShowDebugOutput
   def __fSendMessage(oSelf,
     oMessage,
+    x0BodySource = None,
+    asbAdditionalHeaderLines = [],
   ):
     # Serialize and send the cHTTPMessage instance.
+    # If x0BodySource is provided, the message must not have a body itself but
+    # it must have either a "Content-Length" or a chunked "Transfer-Encoding"
+    # header. The start line and headers are sent first, after which the body
+    # is read from x0BodySource and sent incrementally, so it never needs to
+    # be in memory completely. x0BodySource can be a bytes-like object (e.g. an
+    # mmap), a file object or an iterable of bytes.
+    # asbAdditionalHeaderLines are sent after the message's own headers.
     # Can throw timeout, shutdown or disconnected exception.
     oSelf.fFireCallbacks("sending message", oMessage = oMessage);
-    sbMessage = oMessage.fsbSerialize();
+    sbBody = oMessage.sbBody;
     try:
-      oSelf.fWriteBytes(sbMessage);
+      if len(sbBody) < oSelf.uMinimumBodySizeForSeparateWrites:
+        sbMessage = (
+          oSelf.__fsbSerializeMessageHead(oMessage, asbAdditionalHeaderLines) + sbBody
+          if asbAdditionalHeaderLines else
+          oMessage.fsbSerialize()
+        );
+        oSelf.fWriteBytes(sbMessage);
+        uNumberOfBytesWritten = len(sbMessage);
+        if x0BodySource is not None:
+          uNumberOfBytesWritten += oSelf.__fuSendBodyFromSource(oMessage, x0BodySource);
+      else:
+        # Serializing the message would copy the body into a new bytes object
+        # only to prepend the start line and headers. Instead we write the
+        # head and the body separately.
+        sbHead = oSelf.__fsbSerializeMessageHead(oMessage, asbAdditionalHeaderLines);
+        oSelf.__fWriteBytesSegments([sbHead, sbBody]);
+        uNumberOfBytesWritten = len(sbHead) + len(sbBody);
+        sbMessage = sbHead + sbBody if gbDebugOutputFullHTTPMessages else sbHead;
     except Exception as oException:
       oSelf.fFireCallbacks("sending message failed", oException = oException, oMessage = oMessage);
       raise;
     else:
-      fShowDebugOutput("%s sent to %s." % (oMessage, oSelf));
+      oSelf.oMetrics.fAddToCounter("bytes written", uNumberOfBytesWritten);
+      if gbShowDebugOutput:
+        fShowDebugOutput("%s sent to %s." % (oMessage, oSelf));
       if gbDebugOutputFullHTTPMessages:
         fShowDebugOutput(str(sbMessage, 'latin1'));
       oSelf.fFireCallbacks("sent message", oMessage = oMessage);
   
+  @staticmethod
+  def __fsbSerializeMessageHead(oMessage, asbAdditionalHeaderLines = []):
+    # Serialize the start line and headers of a message, including the empty
+    # line that separates them from the body.
+    return b"\r\n".join(
+      [oMessage.fsbSerializeStartLine()] +
+      oMessage.oHeaders.fasbSerializeLines() +
+      asbAdditionalHeaderLines +
+      [b"", b""]
+    );
+  
+  @ShowDebugOutput
+  def __fWriteBytesSegments(oSelf, asbSegments):
+    # Write a number of bytes objects to the connection as if they were one.
+    # On connections that are not secured, this is done using a scatter/gather
+    # `sendmsg` call on memoryviews of the segments, so they are never copied.
+    # Secured connections encrypt the data anyway, so we write the segments
+    # one after the other. Anything that cannot be sent directly (e.g. when the
+    # socket would block) is left to `fWriteBytes`, which handles waiting and
+    # timeouts.
+    aoSegmentViews = [memoryview(sbSegment) for sbSegment in asbSegments];
+    uSegmentIndex = 0;
+    if not oSelf.bSecure and not oSelf.nSendDelayPerByteInSeconds and hasattr(oSelf.__oPythonSocket, "sendmsg"):
+      bFireWroteBytes = oSelf.fbHasCallbacksForEvent("wrote bytes");
+      while uSegmentIndex < len(aoSegmentViews):
+        try:
+          uNumberOfBytesSent = oSelf.__oPythonSocket.sendmsg(aoSegmentViews[uSegmentIndex:]);
+        except (BlockingIOError, TimeoutError):
+          break;
+        except OSError as oException:
+          oSelf.__fThrowConnectionExceptionForOSError(oException);
+          raise;
+        while uNumberOfBytesSent > 0:
+          oSegmentView = aoSegmentViews[uSegmentIndex];
+          if uNumberOfBytesSent >= len(oSegmentView):
+            if bFireWroteBytes:
+              oSelf.fFireCallbacks("wrote bytes", sbBytes = bytes(oSegmentView));
+            uNumberOfBytesSent -= len(oSegmentView);
+            uSegmentIndex += 1;
+          else:
+            if bFireWroteBytes:
+              oSelf.fFireCallbacks("wrote bytes", sbBytes = bytes(oSegmentView[:uNumberOfBytesSent]));
+            aoSegmentViews[uSegmentIndex] = oSegmentView[uNumberOfBytesSent:];
+            uNumberOfBytesSent = 0;
+    for uIndex in range(uSegmentIndex, len(aoSegmentViews)):
+      # Segments that were not sent at all are passed as-is; the remainder of
+      # a partially sent segment is passed as a memoryview, so it is not copied.
+      oSegmentView = aoSegmentViews[uIndex];
+      oSelf.fWriteBytes(asbSegments[uIndex] if len(oSegmentView) == len(asbSegments[uIndex]) else oSegmentView);
+  
+  def __fThrowConnectionExceptionForOSError(oSelf, oException):
+    # Errors from writing directly to the socket are reported using the same
+    # exceptions as those thrown by `fWriteBytes`: the connection is terminated
+    # and a shutdown or disconnected exception is thrown. Other errors are left
+    # to the caller.
+    if isinstance(oException, BrokenPipeError):
+      oSelf.fTerminate();
+      raise cTCPIPConnectionShutdownException(
+        "The connection was shut down by the remote while writing.",
+        o0Connection = oSelf,
+        dxDetails = {"oException": oException},
+      );
+    if isinstance(oException, (ConnectionResetError, ConnectionAbortedError)):
+      oSelf.fTerminate();
+      raise cTCPIPConnectionDisconnectedException(
+        "The connection was disconnected while writing.",
+        o0Connection = oSelf,
+        dxDetails = {"oException": oException},
+      );
+  
+  @ShowDebugOutput
+  def __fuSendBodyFromSource(oSelf,
+    oMessage,
+    xBodySource,
+  ):
+    # Returns the number of bytes written, including chunked encoding.
+    assert oMessage.sbBody == b"", \
+        "A message that has a body cannot be sent with a body source.";
+    bChunked = oMessage.fbHasChunkedEncodingHeader();
+    u0ContentLength = None if bChunked else oMessage.oHeaders.fu0GetContentLength(None);
+    assert bChunked or u0ContentLength is not None, \
+        "A message sent with a body source must have a Content-Length or chunked Transfer-Encoding header.";
+    if not bChunked and oSelf.__fbSendBodyFromFileUsingSendFile(xBodySource, u0ContentLength):
+      return u0ContentLength;
+    if gbShowDebugOutput:
+      fShowDebugOutput("Sending %s message body from %s..." % ("chunked" if bChunked else "%d bytes" % u0ContentLength, repr(xBodySource)));
+    uBodySize = 0;
+    uNumberOfBytesWritten = 0;
+    for sbBodyChunk in oSelf.__fiterReadBodySource(xBodySource):
+      if len(sbBodyChunk) == 0:
+        continue; # An empty chunk would signal the end of a chunked body.
+      uBodySize += len(sbBodyChunk);
+      if bChunked:
+        sbEncodedBodyChunk = b"%X\r\n%s\r\n" % (len(sbBodyChunk), sbBodyChunk);
+        oSelf.fWriteBytes(sbEncodedBodyChunk);
+        uNumberOfBytesWritten += len(sbEncodedBodyChunk);
+      else:
+        if uBodySize > u0ContentLength:
+          oSelf.__fThrowBodySourceSizeMismatchException(
+            "The body source provided more than the %d bytes in the Content-Length header." % u0ContentLength,
+            {"uContentLength": u0ContentLength, "uMinimumBodySize": uBodySize},
+          );
+        oSelf.fWriteBytes(sbBodyChunk);
+        uNumberOfBytesWritten += len(sbBodyChunk);
+    if bChunked:
+      oSelf.fWriteBytes(b"0\r\n\r\n");
+      uNumberOfBytesWritten += 5;
+    elif uBodySize != u0ContentLength:
+      oSelf.__fThrowBodySourceSizeMismatchException(
+        "The body source provided %d bytes instead of the %d bytes in the Content-Length header." % (uBodySize, u0ContentLength),
+        {"uContentLength": u0ContentLength, "uBodySize": uBodySize},
+      );
+    if gbShowDebugOutput:
+      fShowDebugOutput("Sent %d bytes message body." % uBodySize);
+    return uNumberOfBytesWritten;
+  
+  def __fThrowBodySourceSizeMismatchException(oSelf, sMessage, dxDetails):
+    # The body that was sent does not match the headers, so the remote cannot
+    # find the end of the message: the connection cannot be used anymore.
+    oSelf.fTerminate();
+    raise cBodySourceSizeMismatchException(
+      sMessage,
+      o0Connection = oSelf,
+      dxDetails = dxDetails,
+    );
+  
+  def __fiterReadBodySource(oSelf, xBodySource):
+    uChunkSize = oSelf.uDefaultBodyChunkSize;
+    try:
+      oBodyView = memoryview(xBodySource).cast("B");
+    except TypeError:
+      pass; # Not a bytes-like object.
+    else:
+      for uOffset in range(0, len(oBodyView), uChunkSize):
+        yield bytes(oBodyView[uOffset:uOffset + uChunkSize]);
+      return;
+    if hasattr(xBodySource, "read"):
+      while 1:
+        sbBodyChunk = xBodySource.read(uChunkSize);
+        if len(sbBodyChunk) == 0:
+          return;
+        yield sbBodyChunk;
+    for sbBodyChunk in xBodySource:
+      yield sbBodyChunk;
+  
+  @ShowDebugOutput
+  def __fbSendBodyFromFileUsingSendFile(oSelf,
+    xBodySource,
+    uContentLength,
+  ):
+    # For connections that are not secured, the OS can copy the contents of a
+    # file to the socket directly, without it ever being read into Python.
+    # Returns False if this is not possible, in which case nothing was sent.
+    # Note that no "wrote bytes" events are fired for data sent this way.
+    if oSelf.bSecure or oSelf.nSendDelayPerByteInSeconds or not hasattr(xBodySource, "fileno"):
+      return False;
+    try:
+      xBodySource.fileno();
+      uOffset = xBodySource.tell();
+    except (OSError, ValueError): # Not a real file.
+      return False;
+    if gbShowDebugOutput:
+      fShowDebugOutput("Sending %d bytes message body from %s using sendfile..." % (uContentLength, repr(xBodySource)));
+    try:
+      uBodySize = oSelf.__oPythonSocket.sendfile(xBodySource, uOffset, uContentLength);
+    except ValueError: # Socket is non-blocking; sendfile cannot be used.
+      return False;
+    except OSError as oException:
+      oSelf.__fThrowConnectionExceptionForOSError(oException);
+      # Part of the body may have been sent, so the connection cannot be used
+      # for another message.
+      oSelf.fTerminate();
+      raise;
+    if uBodySize != uContentLength:
+      oSelf.__fThrowBodySourceSizeMismatchException(
+        "The body source provided %d bytes instead of the %d bytes in the Content-Length header." % (uBodySize, uContentLength),
+        {"uContentLength": uContentLength, "uBodySize": uBodySize},
+      );
+    if gbShowDebugOutput:
+      fShowDebugOutput("Sent %d bytes message body using sendfile." % uBodySize);
+    return True;
+  
   # Read HTTP Messages
   @ShowDebugOutput
   def foReceiveRequest(oSelf,
@@ -186,6 +593,7 @@ class cConnection(cTransactionalBufferedTCPIPConnection):
       oSelf.fTerminate();
       raise;
     oSelf.__o0LastReceivedRequest = oRequest;
+    oSelf.oMetrics.fAddToCounter("requests received");
     oSelf.fFireCallbacks("received request from client", oRequest = oRequest);
     return oRequest;
 
@@ -198,13 +606,23 @@ class cConnection(cTransactionalBufferedTCPIPConnection):
     u0zMaxChunkSize = None,
     u0zMaxNumberOfChunks = None, # throw exception if more than this many chunks are received
     u0MaxNumberOfChunksBeforeDisconnecting = None, # disconnect and return response once this many chunks are received.
+    bDecodeBody = False,
   ):
     # Attempt to receive a response from the connection.
     # Optionally end a transaction after doing so, even if an exception is thrown.
+    # If bDecodeBody is True, a gzip, deflate or (if brotli is installed) br
+    # "Content-Encoding" is removed from the body while it is read; the maximum
+    # body size then applies to the decoded body. The response returned has
+    # headers that match the decoded body. Bodies with other encodings are
+    # returned as-is.
+    # A body cannot be decoded if it is not read completely, so bDecodeBody
+    # cannot be combined with u0MaxNumberOfChunksBeforeDisconnecting.
     # Returns a cResponse object.
     # Can throw timeout, shutdown or disconnected exception.
     assert oSelf.bInTransaction, \
         "A transaction must be started before a response can be received over this connection.";
+    assert not bDecodeBody or u0MaxNumberOfChunksBeforeDisconnecting is None, \
+        "A body cannot be decoded if it is not read completely.";
     o0Request = oSelf.__o0LastSentRequest;
     oSelf.fFireCallbacks("receiving response from server", o0Request = o0Request);
     try:
@@ -219,6 +637,7 @@ class cConnection(cTransactionalBufferedTCPIPConnection):
         u0zMaxNumberOfChunks = u0zMaxNumberOfChunks,
         u0MaxNumberOfChunksBeforeDisconnecting = u0MaxNumberOfChunksBeforeDisconnecting,
         bCanHaveBody = o0Request is None or o0Request.sbMethod != b"HEAD", # Response to HEAD request cannot have body
+        bDecodeBody = bDecodeBody,
       );
     except Exception as oException:
       oSelf.__o0LastSentRequest = None;
@@ -226,9 +645,147 @@ class cConnection(cTransactionalBufferedTCPIPConnection):
       oSelf.fTerminate();
       raise;
     oSelf.__o0LastSentRequest = None;
+    oSelf.oMetrics.fAddToCounter("responses received");
     oSelf.fFireCallbacks("received response from server", o0Request = o0Request, oResponse = oResponse);
     return oResponse;
   
+  @ShowDebugOutput
+  def foReceiveResponseHeaders(oSelf,
+    u0zMaxStartLineSize = zNotProvided,
+    u0zMaxHeaderLineSize = zNotProvided,
+    u0zMaxNumberOfHeaders = zNotProvided,
+    u0zMaxBodySize = zNotProvided,
+    u0zMaxChunkSize = zNotProvided,
+    u0zMaxNumberOfChunks = zNotProvided, # throw exception if more than this many chunks are received
+    bDecodeBody = False,
+  ):
+    # Attempt to receive the start line and headers of a response from the
+    # connection, but not its body. The body must be read using
+    # `fiterBodyChunks` before the connection can be used for anything else.
+    # The body size and chunk limits are applied while the body is read.
+    # If bDecodeBody is True, `fiterBodyChunks` yields the body with its
+    # "Content-Encoding" removed (see `foReceiveResponse`) and the maximum body
+    # size applies to the decoded body. The headers of the response returned
+    # are those received, so they still describe the encoded body.
+    # Returns a cResponse object without a body.
+    # Can throw timeout, shutdown or disconnected exception.
+    assert oSelf.bInTransaction, \
+        "A transaction must be started before a response can be received over this connection.";
+    assert oSelf.__dx0StreamedBodyDetails is None, \
+        "The body of the previous response must be read before another response can be received.";
+    o0Request = oSelf.__o0LastSentRequest;
+    oSelf.fFireCallbacks("receiving response from server", o0Request = o0Request);
+    u0MaxStartLineSize   = fxGetFirstProvidedValue(u0zMaxStartLineSize,   oSelf.u0DefaultMaxReasonPhraseSize);
+    u0MaxHeaderLineSize  = fxGetFirstProvidedValue(u0zMaxHeaderLineSize,  oSelf.u0DefaultMaxHeaderLineSize);
+    u0MaxNumberOfHeaders = fxGetFirstProvidedValue(u0zMaxNumberOfHeaders, oSelf.u0DefaultMaxNumberOfHeaders);
+    oSelf.fFireCallbacks("receiving message");
+    try:
+      (oResponse, o0Headers) = oSelf.__ftxReadAndDeserializeStartLineAndHeaders(
+        cResponse,
+        u0MaxStartLineSize,
+        u0MaxHeaderLineSize,
+        u0MaxNumberOfHeaders,
+      );
+    except Exception as oException:
+      oSelf.fFireCallbacks("receiving message failed", oException);
+      oSelf.__o0LastSentRequest = None;
+      oSelf.fFireCallbacks("receiving response from server failed", o0Request = o0Request, oException = oException);
+      oSelf.fTerminate();
+      raise;
+    if gbShowDebugOutput:
+      fShowDebugOutput("%s headers received from %s." % (oResponse, oSelf));
+    bCanHaveBody = o0Request is None or o0Request.sbMethod != b"HEAD"; # Response to HEAD request cannot have body
+    u0MaxBodySize = fxGetFirstProvidedValue(u0zMaxBodySize, oSelf.u0DefaultMaxBodySize);
+    oSelf.__dx0StreamedBodyDetails = {
+      "o0Request": o0Request,
+      "oResponse": oResponse,
+      "o0Headers": o0Headers,
+      "bCanHaveBody": bCanHaveBody,
+      "o0ContentDecoder": cContentDecoder.fo0CreateForHeaders(
+        o0Headers,
+        u0MaxDecodedSize = u0MaxBodySize,
+        o0Connection = oSelf,
+      ) if bDecodeBody and bCanHaveBody else None,
+      # This applies to the body as it is read and, if it is decoded, to the
+      # decoded body as well.
+      "u0MaxBodySize": u0MaxBodySize,
+      "u0MaxChunkSize": fxGetFirstProvidedValue(u0zMaxChunkSize, oSelf.u0DefaultMaxChunkSize),
+      "u0MaxNumberOfChunks": fxGetFirstProvidedValue(u0zMaxNumberOfChunks, oSelf.u0DefaultMaxNumberOfChunks),
+      "u0MaxTrailerLineSize": u0MaxHeaderLineSize, # We use the same value for the headers and the trailer.
+      "nHeadersReceivedTime": time.perf_counter(),
+    };
+    return oResponse;
+  
+  def fiterBodyChunks(oSelf,
+    uzChunkSize = zNotProvided,
+  ):
+    # Yield the body of the response received using `foReceiveResponseHeaders`
+    # in parts of at most uChunkSize bytes, as they are read from the
+    # connection. Chunked encoding is removed from the body, as is any
+    # "Content-Encoding" if this was requested. If the caller
+    # stops before the entire body was read, the connection is disconnected,
+    # as the remainder of the body cannot be skipped.
+    # Can throw timeout, shutdown or disconnected exception.
+    dx0StreamedBodyDetails = oSelf.__dx0StreamedBodyDetails;
+    assert dx0StreamedBodyDetails is not None, \
+        "Response headers must be received using foReceiveResponseHeaders before the body can be read.";
+    dxStreamedBodyDetails = dx0StreamedBodyDetails;
+    uChunkSize = fxGetFirstProvidedValue(uzChunkSize, oSelf.uDefaultBodyChunkSize);
+    assert uChunkSize > 0, \
+        "uChunkSize must be larger than 0, not %d" % uChunkSize;
+    o0Request = dxStreamedBodyDetails["o0Request"];
+    oResponse = dxStreamedBodyDetails["oResponse"];
+    o0ContentDecoder = dxStreamedBodyDetails["o0ContentDecoder"];
+    try:
+      if dxStreamedBodyDetails["bCanHaveBody"]:
+        for sbBodyChunk in oSelf.__fiterReadBodyChunks(
+          oResponse,
+          dxStreamedBodyDetails["o0Headers"],
+          uChunkSize,
+          dxStreamedBodyDetails["u0MaxBodySize"],
+          dxStreamedBodyDetails["u0MaxChunkSize"],
+          dxStreamedBodyDetails["u0MaxNumberOfChunks"],
+          dxStreamedBodyDetails["u0MaxTrailerLineSize"],
+        ):
+          if o0ContentDecoder is None:
+            yield sbBodyChunk;
+          else:
+            # Decoded data can be much larger than the encoded data, so we ask
+            # for at most one chunk at a time and get all decoded data before
+            # reading more.
+            sbDecodedBodyChunk = o0ContentDecoder.fsbDecode(sbBodyChunk, uChunkSize);
+            while sbDecodedBodyChunk:
+              for uOffset in range(0, len(sbDecodedBodyChunk), uChunkSize):
+                yield sbDecodedBodyChunk[uOffset:uOffset + uChunkSize];
+              sbDecodedBodyChunk = o0ContentDecoder.fsbDecode(b"", uChunkSize);
+        if o0ContentDecoder:
+          sbDecodedBodyChunk = o0ContentDecoder.fsbFinish();
+          for uOffset in range(0, len(sbDecodedBodyChunk), uChunkSize):
+            yield sbDecodedBodyChunk[uOffset:uOffset + uChunkSize];
+    except GeneratorExit:
+      if gbShowDebugOutput:
+        fShowDebugOutput("Body of %s was not completely read; disconnecting %s." % (oResponse, oSelf));
+      oSelf.__dx0StreamedBodyDetails = None;
+      oSelf.__o0LastSentRequest = None;
+      oSelf.fDisconnect();
+      raise;
+    except Exception as oException:
+      oSelf.__dx0StreamedBodyDetails = None;
+      oSelf.__o0LastSentRequest = None;
+      oSelf.fFireCallbacks("receiving message failed", oException);
+      oSelf.fFireCallbacks("receiving response from server failed", o0Request = o0Request, oException = oException);
+      oSelf.fTerminate();
+      raise;
+    oSelf.__dx0StreamedBodyDetails = None;
+    oSelf.__o0LastSentRequest = None;
+    if dxStreamedBodyDetails["bCanHaveBody"]:
+      oSelf.oMetrics.fRecordDuration("body transfer time", time.perf_counter() - dxStreamedBodyDetails["nHeadersReceivedTime"]);
+    oSelf.oMetrics.fAddToCounter("responses received");
+    if gbShowDebugOutput:
+      fShowDebugOutput("%s body received from %s." % (oResponse, oSelf));
+    oSelf.fFireCallbacks("received message", oResponse);
+    oSelf.fFireCallbacks("received response from server", o0Request = o0Request, oResponse = oResponse);
+  
   @ShowDebugOutput
   def __foReceiveMessage(oSelf,
     cMessage: iMessage,
@@ -240,8 +797,11 @@ class cConnection(cTransactionalBufferedTCPIPConnection):
     u0zMaxNumberOfChunks: int | None | type(zNotProvided) = zNotProvided,
     u0MaxNumberOfChunksBeforeDisconnecting: int | None = None,
     bCanHaveBody: bool = True, # Only for response to HEAD request
+    bDecodeBody: bool = False,
   ):
     # Read and parse a HTTP message.
+    # If bDecodeBody is True, the body is decoded while it is read if it has a
+    # "Content-Encoding" we support; see `foReceiveResponse`.
     # Returns a cMessage instance.
     # Can throw timeout, shutdown or disconnected exception.
     u0MaxStartLineSize  = fxGetFirstProvidedValue(u0zMaxStartLineSize,   oSelf.u0DefaultMaxReasonPhraseSize);
@@ -260,50 +820,66 @@ class cConnection(cTransactionalBufferedTCPIPConnection):
         );
     oSelf.fFireCallbacks("receiving message");
     try:
-      # Read and parse start line
-      dxConstructorStartLineArguments = oSelf.__fdxReadAndDeserializeStartLine(
+      (oMessage, o0Headers) = oSelf.__ftxReadAndDeserializeStartLineAndHeaders(
         cMessage,
         u0MaxStartLineSize,
-      );
-      # Read and parse headers
-      o0Headers = oSelf.__fo0ReadAndDeserializeHeaders(
-        cMessage,
         u0MaxHeaderLineSize,
         u0MaxNumberOfHeaders,
       );
-      # Find out what headers are present and at the same time do some sanity checking:
-      # (this can throw a cInvalidMessageException if multiple Content-Length headers exist with different values)
-      oMessage = cMessage(
-        o0zHeaders = o0Headers,
-        **dxConstructorStartLineArguments
-      );
-      if bCanHaveBody:
-        if oMessage.fbHasChunkedEncodingHeader():
-          sbChunkedBody = oSelf.__fsbReadChunkedBody(
-            u0MaxBodySize,
-            u0MaxChunkSize,
-            u0MaxNumberOfChunks,
-            u0MaxNumberOfChunksBeforeDisconnecting,
-            u0MaxHeaderLineSize, # We use the same value for the headers and the trailer.
-          );
-          oMessage.fSetBody(sbChunkedBody);
-        else:
-          u0ContentLength = o0Headers and o0Headers.fu0GetContentLength(u0MaxBodySize);
-          if u0ContentLength is not None:
-            fShowDebugOutput("Reading %d bytes message body..." % u0ContentLength);
-            sbBody = oSelf.fsbReadBytes(u0ContentLength);
+      nHeadersReceivedTime = time.perf_counter();
+      bBodyWasRead = False;
+      o0ContentDecoder = cContentDecoder.fo0CreateForHeaders(
+        o0Headers,
+        u0MaxDecodedSize = u0MaxBodySize,
+        o0Connection = oSelf,
+      ) if bDecodeBody and bCanHaveBody else None;
+      if o0ContentDecoder:
+        oMessage = oSelf.__foReadAndDecodeBody(
+          cMessage,
+          oMessage,
+          o0Headers,
+          o0ContentDecoder,
+          u0MaxBodySize,
+          u0MaxChunkSize,
+          u0MaxNumberOfChunks,
+          u0MaxHeaderLineSize, # We use the same value for the headers and the trailer.
+        );
+        # The number of bytes read has already been added to the metrics.
+        oSelf.oMetrics.fRecordDuration("body transfer time", time.perf_counter() - nHeadersReceivedTime);
+      elif bCanHaveBody:
+        asbBodyParts = [];
+        b0BodyIsComplete = oSelf.__fxRunParser(
+          fiterParseBody(
+            oMessage,
+            o0Headers,
+            u0ReadSize = None,
+            bRemoveChunkedEncoding = False,
+            u0MaxBodySize = u0MaxBodySize,
+            u0MaxChunkSize = u0MaxChunkSize,
+            u0MaxNumberOfChunks = u0MaxNumberOfChunks,
+            u0MaxNumberOfChunksBeforeDisconnecting = u0MaxNumberOfChunksBeforeDisconnecting,
+            u0MaxTrailerLineSize = u0MaxHeaderLineSize, # We use the same value for the headers and the trailer.
+            u0MaxChunkSizeCharacters = oSelf.u0MaxChunkSizeCharacters,
+            o0Connection = oSelf,
+          ),
+          asbBodyParts,
+        );
+        if b0BodyIsComplete is not None:
+          sbBody = b"".join(asbBodyParts);
+          if gbShowDebugOutput:
             fShowDebugOutput("Message body is %d bytes." % len(sbBody));
-            oMessage.fSetBody(sbBody);
-          elif cMessage.bCanHaveBodyIfConnectionCloseHeaderIsPresent and \
-              o0Headers and oMessage.fbHasConnectionCloseHeader():
-            fShowDebugOutput("Reading response body until closed...");
-            sbBody = oSelf.fsbReadBytesUntilShutdown(u0MaxNumberOfBytes = u0MaxBodySize);
-            fShowDebugOutput("Response body is %d bytes." % len(sbBody));
-            oMessage.fSetBody(sbBody);
+          oMessage.fSetBody(sbBody);
+          bBodyWasRead = True;
+          if not b0BodyIsComplete:
+            # We stopped reading after u0MaxNumberOfChunksBeforeDisconnecting chunks.
+            oSelf.fDisconnect();
     except Exception as oException:
       oSelf.fFireCallbacks("receiving message failed", oException);
       raise;
-    fShowDebugOutput("%s received from %s." % (oMessage, oSelf));
+    if bBodyWasRead:
+      oSelf.oMetrics.fRecordDuration("body transfer time", time.perf_counter() - nHeadersReceivedTime);
+    if gbShowDebugOutput:
+      fShowDebugOutput("%s received from %s." % (oMessage, oSelf));
     if gbDebugOutputFullHTTPMessages:
       fShowDebugOutput(str(oMessage.fsbSerialize(), 'latin1'));
     
@@ -311,162 +887,154 @@ class cConnection(cTransactionalBufferedTCPIPConnection):
     
     return oMessage;
   
-  @ShowDebugOutput
-  def __fdxReadAndDeserializeStartLine(oSelf,
+  def __foReadAndDecodeBody(oSelf,
     cMessage,
-    u0MaxStartLineSize,
+    oMessage,
+    o0Headers,
+    oContentDecoder,
+    u0MaxBodySize,
+    u0MaxChunkSize,
+    u0MaxNumberOfChunks,
+    u0MaxTrailerLineSize,
   ):
-    fShowDebugOutput("Reading start line...");
-    sb0StartLineCRLF = oSelf.fsb0ReadUntilMarker(b"\r\n", u0MaxNumberOfBytes = u0MaxStartLineSize);
-    if sb0StartLineCRLF is None:
-      sbStartLine = oSelf.fsbReadBufferedData();
-      raise cInvalidMessageException(
-        "The start line was too large.",
-        o0Connection = oSelf,
-        dxDetails = {"sbStartLine": sbStartLine, "u0MaxStartLineSize": u0MaxStartLineSize},
-      );
-    fShowDebugOutput("Parsing start line...");
-    return cMessage.fdxDeserializeStartLine(sb0StartLineCRLF[:-2]);
+    # Read the body of a message, decoding it as it is read, and return a copy
+    # of the message with the decoded body and headers that match it.
+    asbDecodedBodyParts = [];
+    for sbBodyChunk in oSelf.__fiterReadBodyChunks(
+      oMessage,
+      o0Headers,
+      oSelf.uDefaultBodyChunkSize,
+      u0MaxBodySize,
+      u0MaxChunkSize,
+      u0MaxNumberOfChunks,
+      u0MaxTrailerLineSize,
+    ):
+      asbDecodedBodyParts.append(oContentDecoder.fsbDecode(sbBodyChunk));
+    asbDecodedBodyParts.append(oContentDecoder.fsbFinish());
+    sbDecodedBody = b"".join(asbDecodedBodyParts);
+    if gbShowDebugOutput:
+      fShowDebugOutput("Message body is %d bytes (%d bytes decoded)." % (oContentDecoder.uEncodedSize, len(sbDecodedBody)));
+    asbDecodedMessageHeaderLines = [
+      sbHeaderLine
+      for sbHeaderLine in o0Headers.fasbSerializeLines()
+      if sbHeaderLine.split(b":", 1)[0].strip().lower() not in gasbLowerHeaderNamesRemovedFromDecodedMessages
+    ] + [b"Content-Length: %d" % len(sbDecodedBody)];
+    oDecodedMessage = cMessage(
+      o0zHeaders = cHeaders.foDeserializeLines(asbDecodedMessageHeaderLines),
+      **cMessage.fdxDeserializeStartLine(oMessage.fsbSerializeStartLine()),
+    );
+    oDecodedMessage.fSetBody(sbDecodedBody);
+    return oDecodedMessage;
   
   @ShowDebugOutput
-  def __fo0ReadAndDeserializeHeaders(oSelf,
+  def __ftxReadAndDeserializeStartLineAndHeaders(oSelf,
     cMessage,
+    u0MaxStartLineSize,
     u0MaxHeaderLineSize,
     u0MaxNumberOfHeaders,
   ):
-    fShowDebugOutput("Reading headers...");
-    asbHeaderLines = [];
-    while 1:
-      sb0HeaderLineCRLF = oSelf.fsb0ReadUntilMarker(b"\r\n", u0MaxNumberOfBytes = u0MaxHeaderLineSize);
-      if sb0HeaderLineCRLF is None:
-        sbHeaderLine = oSelf.fsbReadBufferedData();
-        raise cInvalidMessageException(
-          "A header line was too large.",
-          o0Connection = oSelf,
-          dxDetails = {"sbHeaderLine": sbHeaderLine, "u0MaxHeaderLineSize": u0MaxHeaderLineSize},
-        );
-      sbHeaderLine = sb0HeaderLineCRLF[:-2];
-      if len(sbHeaderLine) == 0:
-        break; # Empty line == end of headers
-      asbHeaderLines.append(sbHeaderLine);
-    if len(asbHeaderLines) == 0:
-      return None;
-    return cHeaders.foDeserializeLines(asbHeaderLines);
+    # Read and parse the start line and headers of a HTTP message.
+    # Returns a cMessage instance without a body and the headers (if any).
+    (dxConstructorStartLineArguments, o0Headers) = oSelf.__fxRunParser(fiterParseStartLineAndHeaders(
+      cMessage,
+      u0MaxStartLineSize = u0MaxStartLineSize,
+      u0MaxHeaderLineSize = u0MaxHeaderLineSize,
+      u0MaxNumberOfHeaders = u0MaxNumberOfHeaders,
+      o0Connection = oSelf,
+    ));
+    if oSelf.__n0RequestSentTime is not None and cMessage is cResponse:
+      # This is the first response after a request was sent.
+      oSelf.oMetrics.fRecordDuration("time to first byte", time.perf_counter() - oSelf.__n0RequestSentTime);
+      oSelf.__n0RequestSentTime = None;
+    # Find out what headers are present and at the same time do some sanity checking:
+    # (this can throw a cInvalidMessageException if multiple Content-Length headers exist with different values)
+    oMessage = cMessage(
+      o0zHeaders = o0Headers,
+      **dxConstructorStartLineArguments
+    );
+    return (oMessage, o0Headers);
   
-  @ShowDebugOutput
-  def __fsbReadChunkedBody(oSelf,
+  def __fiterReadBodyChunks(oSelf,
+    oMessage,
+    o0Headers,
+    uChunkSize,
     u0MaxBodySize,
     u0MaxChunkSize,
     u0MaxNumberOfChunks,
-    u0MaxNumberOfChunksBeforeDisconnecting,
     u0MaxTrailerLineSize,
   ):
-    fShowDebugOutput("Reading chunked response body...");
-    sbChunkedBody = b"";
-    uTotalNumberOfBodyChunks = 0;
-    while 1:
-      if u0MaxNumberOfChunksBeforeDisconnecting is not None:
-        uMaxNumberOfChunksBeforeDisconnecting = u0MaxNumberOfChunksBeforeDisconnecting;
-        if uTotalNumberOfBodyChunks == uMaxNumberOfChunksBeforeDisconnecting:
-          oSelf.fDisconnect();
-          return abChunkedBody;
-      if u0MaxNumberOfChunks is not None and uTotalNumberOfBodyChunks == u0MaxNumberOfChunks:
-        raise cInvalidMessageException(
-          "The number of body chunks was larger than the maximum expected.",
-          o0Connection = oSelf,
-          dxDetails = {"uMaxNumberOfChunks": u0MaxNumberOfChunks, "uMinimumNumberOfChunksInBody": u0MaxNumberOfChunks + 1},
-        );
-      fShowDebugOutput("Reading response body chunk #%d header line..." % (uTotalNumberOfBodyChunks + 1));
-      # Read size in the chunk header
-      u0MaxChunkHeaderLineSize = oSelf.u0MaxChunkSizeCharacters + 2 if oSelf.u0MaxChunkSizeCharacters is not None else None;
-      bLimitedByTotalBodySize = u0MaxBodySize is not None and u0MaxBodySize - len(sbChunkedBody) < u0MaxChunkHeaderLineSize;
-      if bLimitedByTotalBodySize:
-        u0MaxChunkHeaderLineSize = u0MaxBodySize - len(sbChunkedBody);
-      sb0ChunkHeaderLineCRLF = oSelf.fsb0ReadUntilMarker(b"\r\n", u0MaxNumberOfBytes = u0MaxChunkHeaderLineSize);
-      if sb0ChunkHeaderLineCRLF is None:
-        sbChunkHeaderLine = oSelf.fsbReadBufferedData();
-        if bLimitedByTotalBodySize:
-          sbChunkedBody += sbChunkHeaderLine;
-          raise cInvalidMessageException(
-            "The chunked body was larger than the maximum accepted.",
-            o0Connection = oSelf,
-            dxDetails = {"uMaxBodySize": u0MaxBodySize, "uMinimumNumberOfBytesInBodyChunks": len(sbChunkedBody)},
-          );
-        else:
-          raise cInvalidMessageException(
-            "A body chunk header line was larger than the maximum accepted.",
-            o0Connection = oSelf,
-            dxDetails = {"uMaxChunkHeaderLineSize": u0MaxChunkHeaderLineSize, "uMinimumNumberOfBytesInChunkHeader": len(sbChunkHeaderLine)},
-          );
-      sbChunkedBody += sb0ChunkHeaderLineCRLF;
-      uIndexOfExtensionSeparator = sb0ChunkHeaderLineCRLF.find(b";");
-      if uIndexOfExtensionSeparator != -1:
-        sbChunkSize = sb0ChunkHeaderLineCRLF[:uIndexOfExtensionSeparator];
-      else:
-        sbChunkSize = sb0ChunkHeaderLineCRLF[:-2];
-      try:
-        uChunkSize = int(sbChunkSize, 16);
-      except ValueError:
-        raise cInvalidMessageException(
-          "A body chunk header line contained an invalid character in the chunk size.",
-          o0Connection = oSelf,
-          dxDetails = {"sb0ChunkHeaderLineCRLF": sb0ChunkHeaderLineCRLF},
-        );
-      if uChunkSize == 0:
-        break; # end of chunked body
-      if u0MaxChunkSize is not None and uChunkSize > u0MaxChunkSize:
-        raise cInvalidMessageException(
-          "A body chunk was larger than the maximum accepted",
-          o0Connection = oSelf,
-          dxDetails = {"uMaxChunkSize": u0MaxChunkSize, "uChunkSize": uChunkSize},
-        );
-      # Check chunk size and number of chunks
-      uMinimumChunkedBodySize = len(sbChunkedBody) + uChunkSize + 5; # add 5 because we expect at least "\r\n0\r\n" after this chunk"
-      if u0MaxBodySize is not None and u0MaxBodySize < uMinimumChunkedBodySize:
-        raise cInvalidMessageException(
-          "The chunked body was larger than the maximum accepted.",
-          o0Connection = oSelf,
-          dxDetails = {"uMaxBodySize": uMaxBodySize, "uMinimumChunkedBodySize": uMinimumChunkedBodySize},
-        );
-      # Read the chunk
-      fShowDebugOutput("Reading response body chunk #%d (%d bytes)..." % (uTotalNumberOfBodyChunks + 1, uChunkSize));
-      sbChunkCRLF = oSelf.fsbReadBytes(uChunkSize + 2);
-      if sbChunkCRLF[-2:] != b"\r\n":
-        raise cInvalidMessageException(
-          "A body chunk did not end with CRLF.",
+    # Yield the body of a message in parts of at most uChunkSize bytes, with
+    # chunked encoding removed.
+    # The number of bytes read, including chunked encoding, is added to the
+    # metrics even if the caller stops before the entire body was read.
+    auNumberOfBytesRead = [0];
+    try:
+      yield from oSelf.__fiterPerformParserOperations(
+        fiterParseBody(
+          oMessage,
+          o0Headers,
+          u0ReadSize = uChunkSize,
+          bRemoveChunkedEncoding = True,
+          u0MaxBodySize = u0MaxBodySize,
+          u0MaxChunkSize = u0MaxChunkSize,
+          u0MaxNumberOfChunks = u0MaxNumberOfChunks,
+          u0MaxTrailerLineSize = u0MaxTrailerLineSize,
+          u0MaxChunkSizeCharacters = oSelf.u0MaxChunkSizeCharacters,
           o0Connection = oSelf,
-          dxDetails = {"sbChunkCRLF": sbChunkCRLF},
-        );
-      sbChunkedBody += sbChunkCRLF;
-    # Read chunk trailer line
+        ),
+        auNumberOfBytesRead,
+      );
+    finally:
+      oSelf.oMetrics.fAddToCounter("bytes read", auNumberOfBytesRead[0]);
+  
+  def __fxRunParser(oSelf, oParser, a0sbBodyParts = None):
+    # Run a parser from mMessageParser until it returns its result, adding the
+    # body parts it produces (if any) to a0sbBodyParts.
+    auNumberOfBytesRead = [0];
+    oBodyParts = oSelf.__fiterPerformParserOperations(oParser, auNumberOfBytesRead);
+    try:
+      while 1:
+        try:
+          sbBodyPart = next(oBodyParts);
+        except StopIteration as oStopIteration:
+          return oStopIteration.value;
+        a0sbBodyParts.append(sbBodyPart);
+    finally:
+      oSelf.oMetrics.fAddToCounter("bytes read", auNumberOfBytesRead[0]);
+  
+  def __fiterPerformParserOperations(oSelf, oParser, auNumberOfBytesRead):
+    # Perform the operations yielded by a parser from mMessageParser, yield the
+    # body parts it produces and return its result. The number of bytes read
+    # is added to auNumberOfBytesRead[0] as they are read.
+    xResult = None;
     while 1:
-      bLimitedByTotalBodySize = u0MaxBodySize is not None and u0MaxBodySize - len(sbChunkedBody) < u0MaxTrailerLineSize;
-      if bLimitedByTotalBodySize:
-        u0MaxTrailerLineSize = u0MaxBodySize - len(sbChunkedBody);
-      sb0TrailerLineCRLF = oSelf.fsb0ReadUntilMarker(b"\r\n", u0MaxNumberOfBytes = u0MaxTrailerLineSize);
-      if sb0TrailerLineCRLF is None:
-        sbTrailerLine = oSelf.fsbReadBufferedData();
-        if bLimitedByTotalBodySize:
-          sbChunkedBody += sbTrailerLine;
-          raise cInvalidMessageException(
-            "The chunked body was larger than the maximum accepted.",
-            o0Connection = oSelf,
-            dxDetails = {"uMaxBodySize": u0MaxBodySize, "uMinimumNumberOfBytesInBodyChunks": len(sbChunkedBody)},
-          );
-        else:
-          raise cInvalidMessageException(
-            "A chunked body trailer line was larger than the maximum accepted.",
-            o0Connection = oSelf,
-            dxDetails = {"uMaxTrailerLineSize": u0MaxTrailerLineSize, "uMinimumNumberOfBytesInTrailer": len(sbTrailerLine)},
-          );
-      # Add chunk trailer line to body
-      sbChunkedBody += sb0TrailerLineCRLF;
-      sbTrailerLine = sb0TrailerLineCRLF[:-2];
-      # If it is end, this is the end of the body
-      if sbTrailerLine == b"":
-        # empty line means end of trailers.
-        break;
-    return sbChunkedBody;
+      try:
+        txOperation = oParser.send(xResult);
+      except StopIteration as oStopIteration:
+        return oStopIteration.value;
+      uOperation = txOperation[0];
+      if uOperation == guBodyPart:
+        xResult = None;
+        yield txOperation[1];
+        continue;
+      if uOperation == guReadUntilMarker:
+        xResult = oSelf.fsb0ReadUntilMarker(txOperation[1], u0MaxNumberOfBytes = txOperation[2]);
+        if xResult is not None:
+          auNumberOfBytesRead[0] += len(xResult);
+      elif uOperation == guReadBytes:
+        xResult = oSelf.fsbReadBytes(txOperation[1]);
+        auNumberOfBytesRead[0] += len(xResult);
+      elif uOperation == guReadBytesUntilShutdown:
+        try:
+          xResult = (oSelf.fsbReadBytes(txOperation[1]), False);
+        except (cTCPIPConnectionShutdownException, cTCPIPConnectionDisconnectedException):
+          xResult = (oSelf.fsbReadBufferedData(), True);
+        auNumberOfBytesRead[0] += len(xResult[0]);
+      else:
+        assert uOperation == guReadBufferedData, \
+            "Unknown parser operation %s" % repr(txOperation);
+        xResult = oSelf.fsbReadBufferedData();
+        auNumberOfBytesRead[0] += len(xResult);
   
   @ShowDebugOutput
   def foSendRequestAndReceiveResponse(oSelf,
@@ -480,8 +1048,14 @@ class cConnection(cTransactionalBufferedTCPIPConnection):
     u0zMaxChunkSize = zNotProvided,
     u0zMaxNumberOfChunks = zNotProvided,
     u0MaxNumberOfChunksBeforeDisconnecting = None,
+    # Send request arguments:
+    x0BodySource = None,
+    # Send request and receive response arguments:
+    bDecodeBody = False, # Ask for an encoded (compressed) body and decode it.
   ):
-    oSelf.fSendRequest(oRequest);
+    assert not bDecodeBody or u0MaxNumberOfChunksBeforeDisconnecting is None, \
+        "A body cannot be decoded if it is not read completely.";
+    oSelf.fSendRequest(oRequest, x0BodySource = x0BodySource, bAcceptEncodedBody = bDecodeBody);
     return oSelf.foReceiveResponse(
       u0zMaxStartLineSize = u0zMaxStartLineSize,
       u0zMaxHeaderLineSize = u0zMaxHeaderLineSize,
@@ -490,4 +1064,92 @@ class cConnection(cTransactionalBufferedTCPIPConnection):
       u0zMaxChunkSize = u0zMaxChunkSize,
       u0zMaxNumberOfChunks = u0zMaxNumberOfChunks,
       u0MaxNumberOfChunksBeforeDisconnecting = u0MaxNumberOfChunksBeforeDisconnecting,
+      bDecodeBody = bDecodeBody,
     );
+  
+  @ShowDebugOutput
+  def faoSendPipelinedRequestsAndReceiveResponses(oSelf,
+    # Send request arguments:
+    aoRequests,
+    # Receive response arguments:
+    u0zMaxStartLineSize = zNotProvided,
+    u0zMaxHeaderLineSize = zNotProvided,
+    u0zMaxNumberOfHeaders = zNotProvided,
+    u0zMaxBodySize = zNotProvided,
+    u0zMaxChunkSize = zNotProvided,
+    u0zMaxNumberOfChunks = zNotProvided,
+    f0ResponseReceivedCallback = None, # called with (oRequest, oResponse) for each response received.
+  ):
+    # Send all requests back to back, then receive their responses in order.
+    # This saves a round-trip per request on high-latency connections, but it
+    # only works with servers that support HTTP/1.1 pipelining.
+    # Only safe requests without a body can be pipelined (see
+    # asbPipelinableMethods). Requests are small that way, so sending all of
+    # them before reading any response cannot deadlock because both sides wait
+    # for the other to read what they wrote.
+    # If the server closes the connection before responding to all requests,
+    # the responses received so far are returned; the caller can send the
+    # remaining requests again (they are all safe).
+    # Returns a list of cResponse objects for the first N requests, where N > 0.
+    # Can throw out-of-band data, timeout, shutdown or disconnected exception
+    # if no response at all is received.
+    assert len(aoRequests) > 0, \
+        "At least one request must be provided.";
+    for oRequest in aoRequests:
+      assert oRequest.sbMethod in oSelf.asbPipelinableMethods, \
+          "Cannot pipeline %s request: the method is not safe." % str(oRequest.sbMethod, "ascii", "strict");
+      assert len(oRequest.sbBody) == 0 and not oRequest.fbHasChunkedEncodingHeader(), \
+          "Cannot pipeline a request with a body.";
+    # Once the first request has been sent, the server may start responding
+    # while we are still sending, so we only check for out-of-band data once.
+    oSelf.fThrowExceptionIfSendingRequestIsNotPossible();
+    aoSentRequests = [];
+    for oRequest in aoRequests:
+      oSelf.fFireCallbacks("sending request to server", oRequest = oRequest);
+      try:
+        oSelf.__fSendMessage(oRequest);
+      except (cTCPIPConnectionShutdownException, cTCPIPConnectionDisconnectedException) as oException:
+        oSelf.fFireCallbacks("sending request to server failed", oRequest = oRequest, oException = oException);
+        if len(aoSentRequests) == 0:
+          oSelf.fTerminate();
+          raise;
+        # The server closed the connection; we may still be able to read
+        # responses to the requests we have sent.
+        fShowDebugOutput("Server closed connection after %d pipelined requests." % len(aoSentRequests));
+        break;
+      except Exception as oException:
+        oSelf.fFireCallbacks("sending request to server failed", oRequest = oRequest, oException = oException);
+        oSelf.fTerminate();
+        raise;
+      oSelf.fFireCallbacks("sent request to server", oRequest = oRequest);
+      oSelf.oMetrics.fAddToCounter("requests sent");
+      aoSentRequests.append(oRequest);
+    # The time to first byte is only measured for the first response.
+    oSelf.__n0RequestSentTime = time.perf_counter();
+    aoResponses = [];
+    for oRequest in aoSentRequests:
+      oSelf.__o0LastSentRequest = oRequest;
+      try:
+        oResponse = oSelf.foReceiveResponse(
+          u0zMaxStartLineSize = u0zMaxStartLineSize,
+          u0zMaxHeaderLineSize = u0zMaxHeaderLineSize,
+          u0zMaxNumberOfHeaders = u0zMaxNumberOfHeaders,
+          u0zMaxBodySize = u0zMaxBodySize,
+          u0zMaxChunkSize = u0zMaxChunkSize,
+          u0zMaxNumberOfChunks = u0zMaxNumberOfChunks,
+        );
+      except (cTCPIPConnectionShutdownException, cTCPIPConnectionDisconnectedException):
+        if len(aoResponses) == 0:
+          raise;
+        fShowDebugOutput("Server closed connection after %d pipelined responses." % len(aoResponses));
+        break;
+      aoResponses.append(oResponse);
+      if f0ResponseReceivedCallback:
+        f0ResponseReceivedCallback(oRequest, oResponse);
+      if oResponse.fbHasConnectionCloseHeader():
+        # The server will not respond to any more requests.
+        fShowDebugOutput("Server closed connection after %d pipelined responses." % len(aoResponses));
+        oSelf.fDisconnect();
+        break;
+    oSelf.__o0LastSentRequest = None;
+    return aoResponses;
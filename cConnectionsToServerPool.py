@@ -1,16 +1,8 @@
-import time;
-
-try: # mDebugOutput use is Optional
-  from mDebugOutput import ShowDebugOutput, fShowDebugOutput;
-except ModuleNotFoundError as oException:
-  if oException.args[0] != "No module named 'mDebugOutput'":
-    raise;
-  ShowDebugOutput = lambda x: x; # NOP
-  fShowDebugOutput = lambda x, y = None: x; # NOP
+import queue, re, selectors, time;
 
 from mMultiThreading import (
   cLock,
-  cWithCallbacks,
+  cThread,
 );
 from mNotProvided import (
   fxGetFirstProvidedValue,
@@ -24,18 +16,65 @@ from mTCPIPConnection import (
 );
 
 from .cConnection import cConnection;
+from .cDNSCache import cDNSCache;
+from .cMetrics import cMetrics;
+from .cWithLazyCallbacks import cWithLazyCallbacks;
 from .mExceptions import  (
   cConnectionOutOfBandDataException,
   cMaximumNumberOfConnectionsToServerReachedException,
 );
+from .mOptionalDebugOutput import (
+  fShowDebugOutput,
+  gbShowDebugOutput,
+  ShowDebugOutput,
+);
 
 # To turn access to data store in multiple variables into a single transaction, we will create locks.
 # These locks should only ever be locked for a short time; if it is locked for too long, it is considered a "deadlock"
 # bug, where "too long" is defined by the following value:
 gnDeadlockTimeoutInSeconds = 1; # We're not doing anything time consuming, so this should suffice.
 gu0DefaultMaxNumberOfConnectionsToServer = 10;
+guDefaultMaxNumberOfPipelinedRequestsPerConnection = 16;
+# When the server's hostname resolves to multiple IP addresses, a connection
+# attempt to the next address is started if the previous has not succeeded
+# within this time (RFC 8305 recommends 250ms).
+gnDefaultConnectionAttemptDelayInSeconds = 0.25;
+# IP addresses to which we failed to connect are tried last for this long.
+gnIPAddressFailurePenaltyInSeconds = 30;
+# Weight of a new connect time in the smoothed connect time of an IP address.
+gnConnectTimeSmoothingFactor = 0.125;
+# Idle connections are closed after this time, or shortly before the server
+# would close them if it tells us when it does in a "Keep-Alive" header.
+gn0DefaultMaxIdleTimeInSeconds = 60;
+gnKeepAliveTimeoutMarginInSeconds = 1;
+# How often idle connections are checked for having been idle for too long, or
+# having been closed by the server.
+gnDefaultIdleConnectionsCheckIntervalInSeconds = 1;
+grbKeepAliveTimeoutHeaderLine = re.compile(rb"^keep-alive\s*:.*\btimeout\s*=\s*(\d+)", re.I);
+
+def fn0GetKeepAliveTimeoutInSeconds(oResponse):
+  # Returns the timeout from a "Keep-Alive: timeout=<seconds>" header, if any.
+  for sbHeaderLine in oResponse.oHeaders.fasbSerializeLines():
+    o0Match = grbKeepAliveTimeoutHeaderLine.match(sbHeaderLine);
+    if o0Match:
+      return int(o0Match.group(1));
+  return None;
+# These events are fired by connections and then by the pool as well, with an
+# additional oConnection argument. Callbacks that do so are only added to the
+# connections once a callback has been added to the pool for the event.
+gasForwardedConnectionEventNames = [
+  "read bytes",
+  "wrote bytes",
+  "received out-of-band data from server",
+  "sending request to server",
+  "sending request to server failed",
+  "sent request to server",
+  "receiving response from server",
+  "receiving response from server failed",
+  "received response from server",
+];
 
-class cConnectionsToServerPool(cWithCallbacks):
+class cConnectionsToServerPool(cWithLazyCallbacks):
   @ShowDebugOutput
   def __init__(oSelf,
     oServerBaseURL,
@@ -44,19 +83,73 @@ class cConnectionsToServerPool(cWithCallbacks):
     o0SSLContext = None,
     nSendDelayPerByteInSeconds = 0,
     bzCheckHost = zNotProvided,
+    bWaitForFreeConnection = False,
+    o0zDNSCache = zNotProvided,
+    nzConnectionAttemptDelayInSeconds = zNotProvided,
+    uMinIdleConnections = 0,
+    n0zMaxIdleTimeInSeconds = zNotProvided,
+    nzIdleConnectionsCheckIntervalInSeconds = zNotProvided,
+    o0HTTPCache = None,
   ):
     oSelf.__oServerBaseURL = oServerBaseURL;
     oSelf.__u0MaxNumberOfConnectionsToServer = fxGetFirstProvidedValue(u0zMaxNumberOfConnectionsToServer, gu0DefaultMaxNumberOfConnectionsToServer);
     oSelf.__o0SSLContext = o0SSLContext;
     oSelf.__bzCheckHost = bzCheckHost;
+    # Hostnames are resolved using the DNS cache shared by all pools, unless
+    # another one is provided. If None is provided, they are resolved by
+    # cConnection.foConnectTo for every new connection.
+    oSelf.__o0DNSCache = cDNSCache.foGetDefault() if o0zDNSCache is zNotProvided else o0zDNSCache;
+    oSelf.__nConnectionAttemptDelayInSeconds = fxGetFirstProvidedValue(nzConnectionAttemptDelayInSeconds, gnDefaultConnectionAttemptDelayInSeconds);
+    # For each IP address we tried to connect to, the smoothed connect time
+    # and the time of the last failure (see __fRecordIPAddressConnectResult).
+    oSelf.__dtxConnectStatistics_by_sbIPAddress = {};
+    # If a cHTTPCache is provided, `fo0SendRequestAndReceiveResponse` uses it
+    # to avoid sending requests for responses it has stored. It can be shared
+    # by multiple pools.
+    oSelf.__o0HTTPCache = o0HTTPCache;
     
     oSelf.__oConnectionsPropertyLock = cLock(
       "%s.__oConnectionsPropertyLock" % oSelf.__class__.__name__,
       n0DeadlockTimeoutInSeconds = gnDeadlockTimeoutInSeconds
     );
     oSelf.__aoConnections = []; # The connections this pool can use itself
+    # The connections this pool can use that are not in a transaction. This is
+    # used as a stack, so the most recently used connection is reused first.
+    oSelf.__aoIdleConnections = [];
+    oSelf.__dnIdleSinceTime_by_oConnection = {};
+    # Idle connections are checked in a background thread, which only runs
+    # while there are idle connections: those that have been idle too long
+    # are closed and those that the server closed are removed.
+    oSelf.__n0MaxIdleTimeInSeconds = fxGetFirstProvidedValue(n0zMaxIdleTimeInSeconds, gn0DefaultMaxIdleTimeInSeconds);
+    oSelf.__n0ServerKeepAliveTimeoutInSeconds = None;
+    oSelf.__nIdleConnectionsCheckIntervalInSeconds = fxGetFirstProvidedValue(nzIdleConnectionsCheckIntervalInSeconds, gnDefaultIdleConnectionsCheckIntervalInSeconds);
+    oSelf.__bIdleConnectionsCheckThreadIsRunning = False;
     oSelf.__aoExternallyManagedConnections = []; # The connections this pool has provided for use by others.
+    oSelf.__asForwardedConnectionEventNames = set(); # See gasForwardedConnectionEventNames
     oSelf.__uPendingConnects = 0;
+    # The pool creates connections in the background to keep at least this
+    # many idle connections. A single thread creates them one at a time; it is
+    # started when the number of idle connections drops below the minimum and
+    # stops when there are enough.
+    oSelf.__uMinIdleConnections = uMinIdleConnections;
+    oSelf.__bMinIdleConnectionsThreadIsRunning = False;
+    oSelf.__uPendingPrewarmConnects = 0;
+    # If bWaitForFreeConnection is True, requests that cannot get a connection
+    # because the maximum number of connections has been reached wait for one
+    # to become available. Each waiting request has a locked lock in this list,
+    # which is unlocked when it is its turn (first-in, first-out). A connection
+    # that ends its transaction while requests are waiting is handed over to
+    # the first one directly, so it cannot be taken by a request that arrives
+    # later. Likewise, when a connection is terminated, the slot it frees up is
+    # reserved for the first waiting request by counting it as a pending
+    # connect, so it cannot be taken by a request that arrives later either.
+    oSelf.__bWaitForFreeConnection = bWaitForFreeConnection;
+    oSelf.__aoWaitingForConnectionLocks = [];
+    oSelf.__doHandedOverConnection_by_oWaitingForConnectionLock = {};
+    oSelf.__aoWaitingForConnectionLocksWithReservedConnectSlot = [];
+    oSelf.__uTotalNumberOfWaitsForConnection = 0;
+    oSelf.__nTotalWaitForConnectionTimeInSeconds = 0;
+    oSelf.__nMaxWaitForConnectionTimeInSeconds = 0;
     
     oSelf.__bStopping = False;
     oSelf.__oTerminatedPropertyLock = cLock(
@@ -68,6 +161,12 @@ class cConnectionsToServerPool(cWithCallbacks):
       bLocked = True
     );
     oSelf.nSendDelayPerByteInSeconds = nSendDelayPerByteInSeconds;
+    # The metrics of all connections created by this pool are added to these,
+    # in addition to the connect, TLS handshake and checkout wait times.
+    oSelf.oMetrics = cMetrics();
+    oSelf.oMetrics.fAddGauge("connections", lambda: oSelf.uConnectionsCount);
+    oSelf.oMetrics.fAddGauge("idle connections", lambda: oSelf.uIdleConnectionsCount);
+    oSelf.oMetrics.fAddGauge("requests waiting for connection", lambda: oSelf.uWaitingForConnectionCount);
     
     oSelf.fAddEvents(
       "server host invalid",
@@ -100,6 +199,7 @@ class cConnectionsToServerPool(cWithCallbacks):
       
       "terminated"
     );
+    oSelf.__fMaintainMinIdleConnections();
   
   @property
   def bTerminated(oSelf):
@@ -114,6 +214,59 @@ class cConnectionsToServerPool(cWithCallbacks):
   def uConnectionsCount(oSelf):
     return len(oSelf.__aoConnections) + len(oSelf.__aoExternallyManagedConnections);
   
+  @property
+  def uIdleConnectionsCount(oSelf):
+    return len(oSelf.__aoIdleConnections);
+  
+  @property
+  def uWaitingForConnectionCount(oSelf):
+    return len(oSelf.__aoWaitingForConnectionLocks);
+  @property
+  def uTotalNumberOfWaitsForConnection(oSelf):
+    return oSelf.__uTotalNumberOfWaitsForConnection;
+  @property
+  def nTotalWaitForConnectionTimeInSeconds(oSelf):
+    return oSelf.__nTotalWaitForConnectionTimeInSeconds;
+  @property
+  def nMaxWaitForConnectionTimeInSeconds(oSelf):
+    return oSelf.__nMaxWaitForConnectionTimeInSeconds;
+  @property
+  def uTLSHandshakesCount(oSelf):
+    dx0Histogram = oSelf.oMetrics.fdxGetSnapshot()["dxHistograms"].get("TLS handshake time");
+    return dx0Histogram["uCount"] if dx0Histogram else 0;
+  @property
+  def uResumedTLSSessionsCount(oSelf):
+    # Unlike cAsyncConnectionsToServerPool, this pool does not resume TLS
+    # sessions: connections are secured by mTCPIPConnection and mSSL, which
+    # offer no way to provide a session. Every handshake is a full handshake.
+    return 0;
+  @property
+  def n0TLSSessionResumptionRate(oSelf):
+    # The fraction of TLS handshakes that resumed an earlier session; these
+    # properties can be compared to those of cAsyncConnectionsToServerPool.
+    uTLSHandshakesCount = oSelf.uTLSHandshakesCount;
+    if not uTLSHandshakesCount:
+      return None;
+    return oSelf.uResumedTLSSessionsCount / uTLSHandshakesCount;
+  @property
+  def n0AverageTLSHandshakeTimeInSeconds(oSelf):
+    dx0Histogram = oSelf.oMetrics.fdxGetSnapshot()["dxHistograms"].get("TLS handshake time");
+    if not dx0Histogram:
+      return None;
+    return dx0Histogram["nSumInSeconds"] / dx0Histogram["uCount"];
+  
+  @property
+  def o0HTTPCache(oSelf):
+    return oSelf.__o0HTTPCache;
+  
+  @property
+  def uMinIdleConnections(oSelf):
+    return oSelf.__uMinIdleConnections;
+  
+  def fSetMinIdleConnections(oSelf, uMinIdleConnections):
+    oSelf.__uMinIdleConnections = uMinIdleConnections;
+    oSelf.__fMaintainMinIdleConnections();
+  
   def fSetSendDelayPerByteInSeconds(oSelf, nSendDelayPerByteInSeconds):
     oSelf.nSendDelayPerByteInSeconds = nSendDelayPerByteInSeconds;
     for oConnection in oSelf.__aoConnections:
@@ -173,6 +326,7 @@ class cConnectionsToServerPool(cWithCallbacks):
       oSelf.__bStopping = True;
     finally:
       oSelf.__oConnectionsPropertyLock.fRelease();
+    oSelf.__fReleaseAllWaitingForConnectionLocks();
     # We are stopping. New connections will no longer be created.
     # Existing connections should all be stopping:
     for oConnection in aoConnectionsThatAreNotStopping:
@@ -186,6 +340,7 @@ class cConnectionsToServerPool(cWithCallbacks):
       return fShowDebugOutput("Already terminated");
     fShowDebugOutput("Terminated...");
     oSelf.__bStopping = True;
+    oSelf.__fReleaseAllWaitingForConnectionLocks();
     # We are now officially stopping, so there should not be any new connections
     # added from this point onward.  If there are existing connections, we will
     # terminate them:
@@ -224,6 +379,7 @@ class cConnectionsToServerPool(cWithCallbacks):
       return None;
     oSelf.__oConnectionsPropertyLock.fAcquire();
     try:
+      # The connection is in a transaction, so it is not in the list of idle connections.
       oSelf.__aoConnections.remove(o0Connection);
       oSelf.__aoExternallyManagedConnections.append(o0Connection);
     finally:
@@ -242,6 +398,153 @@ class cConnectionsToServerPool(cWithCallbacks):
       return None;
     n0ConnectTimeoutInSeconds = fxGetFirstProvidedValue(n0zConnectTimeoutInSeconds, cConnection.n0DefaultConnectTimeoutInSeconds);
     fShowDebugOutput("Getting connection...");
+    nStartTime = time.perf_counter();
+    o0Connection = oSelf.__fo0GetConnectionAndStartTransaction(
+      n0ConnectTimeoutInSeconds,
+      bSecureConnection,
+      bzCheckHost,
+      n0zSecureTimeoutInSeconds,
+      n0zTransactionTimeoutInSeconds,
+    );
+    if o0Connection is not None:
+      # This includes the time needed to create a new connection, if any.
+      oSelf.oMetrics.fRecordDuration("checkout wait time", time.perf_counter() - nStartTime);
+      # We may have used an idle connection, so we may need to create another.
+      oSelf.__fMaintainMinIdleConnections();
+    return o0Connection;
+  
+  @ShowDebugOutput
+  def fPrewarm(oSelf,
+    uNumberOfIdleConnections,
+    *,
+    n0zConnectTimeoutInSeconds = zNotProvided,
+    n0zSecureTimeoutInSeconds = zNotProvided,
+  ):
+    # Create new connections in the background (in parallel) until there are at
+    # least the given number of idle connections, so requests do not have to
+    # wait for the server's hostname to be resolved and a connection to be
+    # established and secured. Fewer connections are created if that would
+    # exceed the maximum number of connections.
+    # Returns the number of connections that are being created.
+    oSelf.__oConnectionsPropertyLock.fAcquire();
+    try:
+      if oSelf.__bStopping:
+        return 0;
+      iNumberOfConnectionsToCreate = oSelf.__fiGetNumberOfIdleConnectionsToCreate(uNumberOfIdleConnections);
+      if iNumberOfConnectionsToCreate <= 0:
+        return 0;
+      oSelf.__uPendingPrewarmConnects += iNumberOfConnectionsToCreate;
+    finally:
+      oSelf.__oConnectionsPropertyLock.fRelease();
+    fShowDebugOutput(oSelf, "Creating %d connections in the background..." % iNumberOfConnectionsToCreate);
+    for uIndex in range(iNumberOfConnectionsToCreate):
+      cThread(
+        oSelf.__fbCreateIdleConnection,
+        fxGetFirstProvidedValue(n0zConnectTimeoutInSeconds, cConnection.n0DefaultConnectTimeoutInSeconds),
+        n0zSecureTimeoutInSeconds,
+      ).fStart();
+    return iNumberOfConnectionsToCreate;
+  
+  def __fiGetNumberOfIdleConnectionsToCreate(oSelf, uNumberOfIdleConnections):
+    # Must be called while holding the connections property lock. Connections
+    # that are being created in the background are counted as idle.
+    iNumberOfConnectionsToCreate = (
+      uNumberOfIdleConnections
+      - len(oSelf.__aoIdleConnections)
+      - oSelf.__uPendingPrewarmConnects
+    );
+    if oSelf.__u0MaxNumberOfConnectionsToServer is not None:
+      iNumberOfConnectionsToCreate = min(
+        iNumberOfConnectionsToCreate,
+        oSelf.__u0MaxNumberOfConnectionsToServer - len(oSelf.__aoConnections) - oSelf.__uPendingConnects,
+      );
+    return iNumberOfConnectionsToCreate;
+  
+  def __fMaintainMinIdleConnections(oSelf):
+    # This is called after anything that may reduce the number of idle
+    # connections, so it must be cheap if there is nothing to do.
+    if not oSelf.__uMinIdleConnections:
+      return;
+    oSelf.__oConnectionsPropertyLock.fAcquire();
+    try:
+      if (
+        oSelf.__bStopping
+        or oSelf.__bMinIdleConnectionsThreadIsRunning
+        or oSelf.__fiGetNumberOfIdleConnectionsToCreate(oSelf.__uMinIdleConnections) <= 0
+      ):
+        return;
+      oSelf.__bMinIdleConnectionsThreadIsRunning = True;
+    finally:
+      oSelf.__oConnectionsPropertyLock.fRelease();
+    cThread(oSelf.__fMinIdleConnectionsThread).fStart();
+  
+  @ShowDebugOutput
+  def __fMinIdleConnectionsThread(oSelf):
+    while 1:
+      oSelf.__oConnectionsPropertyLock.fAcquire();
+      try:
+        if (
+          oSelf.__bStopping
+          or oSelf.__fiGetNumberOfIdleConnectionsToCreate(oSelf.__uMinIdleConnections) <= 0
+        ):
+          oSelf.__bMinIdleConnectionsThreadIsRunning = False;
+          return;
+        oSelf.__uPendingPrewarmConnects += 1;
+      finally:
+        oSelf.__oConnectionsPropertyLock.fRelease();
+      if not oSelf.__fbCreateIdleConnection(cConnection.n0DefaultConnectTimeoutInSeconds, zNotProvided):
+        # Do not keep trying to connect to a server that cannot be reached; we
+        # will try again when the next connection is taken from the pool.
+        oSelf.__oConnectionsPropertyLock.fAcquire();
+        try:
+          oSelf.__bMinIdleConnectionsThreadIsRunning = False;
+        finally:
+          oSelf.__oConnectionsPropertyLock.fRelease();
+        return;
+  
+  @ShowDebugOutput
+  def __fbCreateIdleConnection(oSelf,
+    n0ConnectTimeoutInSeconds,
+    n0zSecureTimeoutInSeconds,
+  ):
+    # Returns True if a connection was created.
+    try:
+      o0Connection = oSelf.__foCreateNewConnectionAndStartTransaction(
+        n0ConnectTimeoutInSeconds,
+        True, # bSecureConnection
+        zNotProvided, # bzCheckHost
+        n0zSecureTimeoutInSeconds,
+        zNotProvided, # n0zTransactionTimeoutInSeconds
+      );
+    except Exception as oException:
+      # Events have been fired for connection errors; a request that needs a
+      # connection will try again.
+      fShowDebugOutput(oSelf, "Cannot create connection in the background: %s" % repr(oException));
+      o0Connection = None;
+    finally:
+      oSelf.__oConnectionsPropertyLock.fAcquire();
+      try:
+        oSelf.__uPendingPrewarmConnects -= 1;
+      finally:
+        oSelf.__oConnectionsPropertyLock.fRelease();
+    if o0Connection is None:
+      return False;
+    if oSelf.__bStopping:
+      o0Connection.fTerminate();
+    else:
+      # Ending the transaction makes it idle, or hands it over to a request that
+      # is waiting for one.
+      o0Connection.fEndTransaction();
+    return True;
+  
+  def __fo0GetConnectionAndStartTransaction(
+    oSelf,
+    n0ConnectTimeoutInSeconds,
+    bSecureConnection,
+    bzCheckHost,
+    n0zSecureTimeoutInSeconds,
+    n0zTransactionTimeoutInSeconds,
+  ):
     n0EndTime = (time.time() + n0ConnectTimeoutInSeconds) if n0ConnectTimeoutInSeconds is not None else None;
     while not oSelf.__bStopping:
       # Existing idle connections may be used:
@@ -263,38 +566,179 @@ class cConnectionsToServerPool(cWithCallbacks):
           n0zTransactionTimeoutInSeconds,
         );
       except cMaximumNumberOfConnectionsToServerReachedException:
-        # We have reached the max number of connections; try reusing one again.
-        raise;
+        if not oSelf.__bWaitForFreeConnection:
+          raise;
+      # We have reached the max number of connections; wait for one to become
+      # available and try reusing it, or for a slot to create a new one.
+      (o0Connection, bConnectSlotReserved) = oSelf.__ftxWaitForFreeConnectionOrConnectSlot(n0EndTime);
+      if o0Connection is not None:
+        if oSelf.__fbStartTransactionOnIdleConnection(
+          o0Connection,
+          n0zTransactionTimeoutInSeconds,
+        ):
+          oSelf.oMetrics.fAddToCounter("connections reused");
+          return o0Connection;
+      elif bConnectSlotReserved:
+        # A slot was reserved for us; we do not compete for it with other requests.
+        n0ConnectTimeoutInSeconds = (n0EndTime - time.time()) if n0EndTime is not None else None;
+        return oSelf.__foCreateNewConnectionAndStartTransaction(
+          n0ConnectTimeoutInSeconds,
+          bSecureConnection,
+          bzCheckHost,
+          n0zSecureTimeoutInSeconds,
+          n0zTransactionTimeoutInSeconds,
+          bConnectSlotReserved = True,
+        );
     return None;
   
+  @ShowDebugOutput
+  def __ftxWaitForFreeConnectionOrConnectSlot(oSelf,
+    n0EndTime,
+  ):
+    # Wait until a connection is handed over to us, or until a connection is
+    # terminated and the slot it frees up is reserved for us.
+    # Returns a tuple with the connection that was handed over (or None) and
+    # a boolean that indicates if a slot to create a new connection was
+    # reserved for us. If neither, we should try again (or we are stopping).
+    # Can throw a max-connections-reached exception if we time out.
+    oWaitingForConnectionLock = cLock(
+      "%s.__oWaitingForConnectionLock" % oSelf.__class__.__name__,
+      bLocked = True,
+    );
+    oSelf.__oConnectionsPropertyLock.fAcquire();
+    try:
+      if oSelf.__bStopping:
+        return (None, False);
+      if (
+        len(oSelf.__aoIdleConnections) > 0
+        or len(oSelf.__aoConnections) + oSelf.__uPendingConnects < oSelf.__u0MaxNumberOfConnectionsToServer
+      ):
+        # A connection became available after we last checked; try again.
+        return (None, False);
+      oSelf.__aoWaitingForConnectionLocks.append(oWaitingForConnectionLock);
+    finally:
+      oSelf.__oConnectionsPropertyLock.fRelease();
+    fShowDebugOutput("Waiting for a free connection...");
+    nStartTime = time.time();
+    oWaitingForConnectionLock.fbWait(max(0, n0EndTime - time.time()) if n0EndTime is not None else None);
+    nWaitTimeInSeconds = time.time() - nStartTime;
+    oSelf.__oConnectionsPropertyLock.fAcquire();
+    try:
+      # We may have timed out, but a connection may have been handed over after
+      # that and before we acquired the lock, so we check both.
+      o0Connection = oSelf.__doHandedOverConnection_by_oWaitingForConnectionLock.pop(oWaitingForConnectionLock, None);
+      bConnectSlotReserved = oWaitingForConnectionLock in oSelf.__aoWaitingForConnectionLocksWithReservedConnectSlot;
+      if bConnectSlotReserved:
+        oSelf.__aoWaitingForConnectionLocksWithReservedConnectSlot.remove(oWaitingForConnectionLock);
+        if oSelf.__bStopping:
+          # We will not be using the reserved slot.
+          oSelf.__uPendingConnects -= 1;
+          bConnectSlotReserved = False;
+      bTimedOut = oWaitingForConnectionLock in oSelf.__aoWaitingForConnectionLocks;
+      if bTimedOut:
+        oSelf.__aoWaitingForConnectionLocks.remove(oWaitingForConnectionLock);
+      oSelf.__uTotalNumberOfWaitsForConnection += 1;
+      oSelf.__nTotalWaitForConnectionTimeInSeconds += nWaitTimeInSeconds;
+      oSelf.__nMaxWaitForConnectionTimeInSeconds = max(oSelf.__nMaxWaitForConnectionTimeInSeconds, nWaitTimeInSeconds);
+    finally:
+      oSelf.__oConnectionsPropertyLock.fRelease();
+    if bTimedOut:
+      raise cMaximumNumberOfConnectionsToServerReachedException(
+        "Maximum number of connections to server reached and none became available in time.",
+        dxDetails = {
+          "bServerIsAProxy": False,
+          "uMaxNumberOfConnections": oSelf.__u0MaxNumberOfConnectionsToServer, # Cannot be None at this point
+          "nWaitTimeInSeconds": nWaitTimeInSeconds,
+        },
+      );
+    if gbShowDebugOutput:
+      fShowDebugOutput("Waited %f seconds for a free connection." % nWaitTimeInSeconds);
+    return (o0Connection, bConnectSlotReserved);
+  
+  def __fReserveConnectSlotForFirstWaitingRequest(oSelf):
+    # Called when a slot becomes available because a connection was terminated
+    # or could not be established.
+    oSelf.__oConnectionsPropertyLock.fAcquire();
+    try:
+      if len(oSelf.__aoWaitingForConnectionLocks) == 0 or oSelf.__bStopping:
+        return;
+      oWaitingForConnectionLock = oSelf.__aoWaitingForConnectionLocks.pop(0);
+      oSelf.__uPendingConnects += 1;
+      oSelf.__aoWaitingForConnectionLocksWithReservedConnectSlot.append(oWaitingForConnectionLock);
+    finally:
+      oSelf.__oConnectionsPropertyLock.fRelease();
+    oWaitingForConnectionLock.fRelease();
+  
+  def __fReleaseAllWaitingForConnectionLocks(oSelf):
+    # Used when we are stopping: nobody should wait for a connection anymore.
+    oSelf.__oConnectionsPropertyLock.fAcquire();
+    try:
+      aoWaitingForConnectionLocks = oSelf.__aoWaitingForConnectionLocks;
+      oSelf.__aoWaitingForConnectionLocks = [];
+    finally:
+      oSelf.__oConnectionsPropertyLock.fRelease();
+    for oWaitingForConnectionLock in aoWaitingForConnectionLocks:
+      oWaitingForConnectionLock.fRelease();
+  
   @ShowDebugOutput
   def __fo0StartTransactionOnExistingConnectionBeforeSendingRequest(oSelf,
     n0zTransactionTimeoutInSeconds,
   ):
-    aoConnections = oSelf.__aoConnections[:];
-    for oConnection in aoConnections:
+    # Idle connections are taken from the top of the stack, so there is no need
+    # to try to start a transaction on every connection to find one that is not
+    # in use.
+    while 1:
       if oSelf.__bStopping:
         return None;
-      fShowDebugOutput(oSelf, "Testing if existing connection is available: %s" % repr(oConnection));
-      try: # Try to start a transaction; this will only succeed on an idle connection.
-        oConnection.fStartTransaction(
-          n0TimeoutInSeconds = fxGetFirstProvidedValue(n0zTransactionTimeoutInSeconds, cConnection.n0DefaultTransactionTimeoutInSeconds),
-        );
-        oConnection.fThrowExceptionIfSendingRequestIsNotPossible();
-      except cTCPIPConnectionCannotBeUsedConcurrentlyException:
+      oSelf.__oConnectionsPropertyLock.fAcquire();
+      try:
+        if len(oSelf.__aoIdleConnections) == 0:
+          return None;
+        oConnection = oSelf.__aoIdleConnections.pop();
+        nIdleSinceTime = oSelf.__dnIdleSinceTime_by_oConnection.pop(oConnection);
+      finally:
+        oSelf.__oConnectionsPropertyLock.fRelease();
+      n0MaxIdleTimeInSeconds = oSelf.n0MaxIdleTimeInSeconds;
+      if n0MaxIdleTimeInSeconds is not None and time.time() - nIdleSinceTime >= n0MaxIdleTimeInSeconds:
+        # The idle connections check has not closed it yet.
+        oSelf.__fCloseIdleConnection(oConnection);
+        continue;
+      if oSelf.__fbStartTransactionOnIdleConnection(oConnection, n0zTransactionTimeoutInSeconds):
+        oSelf.oMetrics.fAddToCounter("connections reused");
+        return oConnection;
+  
+  @ShowDebugOutput
+  def __fbStartTransactionOnIdleConnection(oSelf,
+    oConnection,
+    n0zTransactionTimeoutInSeconds,
+  ):
+    if gbShowDebugOutput:
+      fShowDebugOutput(oSelf, "Testing if idle connection is available: %s" % repr(oConnection));
+    try: # Try to start a transaction; this should succeed as the connection is idle.
+      oConnection.fStartTransaction(
+        n0TimeoutInSeconds = fxGetFirstProvidedValue(n0zTransactionTimeoutInSeconds, cConnection.n0DefaultTransactionTimeoutInSeconds),
+      );
+      oConnection.fThrowExceptionIfSendingRequestIsNotPossible();
+    except cTCPIPConnectionCannotBeUsedConcurrentlyException:
+      # It will be added to the idle connections again when that transaction ends.
+      if gbShowDebugOutput:
         fShowDebugOutput(oSelf, "Connection is use: %s." % oConnection);
-      except cTCPIPConnectionShutdownException:
+    except cTCPIPConnectionShutdownException:
+      if gbShowDebugOutput:
         fShowDebugOutput(oSelf, "Connection shut down: %s." % oConnection);
-        oConnection.fDisconnect();
-      except cTCPIPConnectionDisconnectedException:
+      oConnection.fDisconnect();
+    except cTCPIPConnectionDisconnectedException:
+      if gbShowDebugOutput:
         fShowDebugOutput(oSelf, "Connection disconnected: %s." % oConnection);
-      except cConnectionOutOfBandDataException:
+    except cConnectionOutOfBandDataException:
+      if gbShowDebugOutput:
         fShowDebugOutput(oSelf, "Connection received out-of-band data: %s." % oConnection);
-        oConnection.fDisconnect();
-      else:
-        fShowDebugOutput(oSelf, "Reusing existing connection to server: %s." % oConnection);
-        return oConnection;
-    return None;
+      oConnection.fDisconnect();
+    else:
+      if gbShowDebugOutput:
+        fShowDebugOutput(oSelf, "Connection is usable: %s." % oConnection);
+      return True;
+    return False;
   
   @ShowDebugOutput
   def __foCreateNewConnectionAndStartTransaction(oSelf,
@@ -303,100 +747,35 @@ class cConnectionsToServerPool(cWithCallbacks):
     bzCheckHost,
     n0zSecureTimeoutInSeconds,
     n0zTransactionTimeoutInSeconds,
+    bConnectSlotReserved = False,
   ):
-    # Make sure we would not create too many connections and add a pending connection:
+    # Make sure we would not create too many connections and add a pending connection,
+    # unless a slot was reserved for us, in which case it was already added:
     # Can throw a max-connections-reached exception
-    oSelf.__oConnectionsPropertyLock.fAcquire();
-    try:
-      if (
-        oSelf.__u0MaxNumberOfConnectionsToServer is not None
-        and len(oSelf.__aoConnections) + oSelf.__uPendingConnects == oSelf.__u0MaxNumberOfConnectionsToServer
-      ):
-        raise cMaximumNumberOfConnectionsToServerReachedException(
-          "Maximum number of connections to server reached.",
-          dxDetails = {
-            "bServerIsAProxy": False,
-            "uMaxNumberOfConnections": oSelf.__u0MaxNumberOfConnectionsToServer, # Cannot be None at this point
-          },
-        );
-      oSelf.__uPendingConnects += 1;
-    finally:
-      oSelf.__oConnectionsPropertyLock.fRelease();
+    if not bConnectSlotReserved:
+      oSelf.__oConnectionsPropertyLock.fAcquire();
+      try:
+        if (
+          oSelf.__u0MaxNumberOfConnectionsToServer is not None
+          and len(oSelf.__aoConnections) + oSelf.__uPendingConnects == oSelf.__u0MaxNumberOfConnectionsToServer
+        ):
+          raise cMaximumNumberOfConnectionsToServerReachedException(
+            "Maximum number of connections to server reached.",
+            dxDetails = {
+              "bServerIsAProxy": False,
+              "uMaxNumberOfConnections": oSelf.__u0MaxNumberOfConnectionsToServer, # Cannot be None at this point
+            },
+          );
+        oSelf.__uPendingConnects += 1;
+      finally:
+        oSelf.__oConnectionsPropertyLock.fRelease();
     # Try to establish a connection:
     try:
-      oConnection = cConnection.foConnectTo(
-        sbHost = oSelf.__oServerBaseURL.sbHost,
-        uPortNumber = oSelf.__oServerBaseURL.uPortNumber,
-        n0zConnectTimeoutInSeconds = n0ConnectTimeoutInSeconds,
-        o0SSLContext = oSelf.__o0SSLContext if bSecureConnection else None,
-        bzCheckHost = fxzGetFirstProvidedValueIfAny(bzCheckHost, oSelf.__bzCheckHost),
-        n0zSecureTimeoutInSeconds = n0zSecureTimeoutInSeconds,
-        nSendDelayPerByteInSeconds = oSelf.nSendDelayPerByteInSeconds,
-        f0HostInvalidCallback = lambda sbHost, oException: oSelf.fFireCallbacks(
-          "server host invalid",
-          sbHost = sbHost,
-          oException = oException,
-        ),
-        f0ResolvingHostnameCallback = lambda sbHostname: oSelf.fFireCallbacks(
-          "resolving server hostname to ip address",
-          sbHostname = sbHostname,
-        ),
-        f0ResolvingHostnameFailedCallback = lambda sbHostname, oException: oSelf.fFireCallbacks(
-          "resolving server hostname to ip address failed",
-          sbHostname = sbHostname,
-          oException = oException,
-        ),
-        f0HostnameResolvedToIPAddressCallback = lambda sbHostname, sbIPAddress, sCanonicalName: oSelf.fFireCallbacks(
-          "resolved server hostname to ip address",
-          sbHostname = sbHostname,
-          sbIPAddress = sbIPAddress,
-          sCanonicalName = sCanonicalName,
-        ),
-        f0ConnectingToIPAddressCallback = lambda sbHost, uPortNumber, sbIPAddress: oSelf.fFireCallbacks(
-          "creating connection to server",
-          sbHost = sbHost,
-          uPortNumber = uPortNumber,
-          sbIPAddress = sbIPAddress,
-        ),
-        f0ConnectingToIPAddressFailedCallback = lambda oException, sbHost, uPortNumber, sbIPAddress: oSelf.fFireCallbacks(
-          "creating connection to server failed",
-          sbHost = sbHost,
-          uPortNumber = uPortNumber,
-          sbIPAddress = sbIPAddress,
-          oException = oException,
-        ),
-        f0ConnectedToIPAddressCallback = lambda sbHost, uPortNumber, sbIPAddress, oConnection: oSelf.fFireCallbacks(
-          "created connection to server",
-          sbHost = sbHost,
-          uPortNumber = uPortNumber,
-          sbIPAddress = sbIPAddress,
-          oConnection = oConnection,
-        ),
-        f0SecuringConnectionCallback = lambda sbHost, uPortNumber, sbIPAddress, oConnection, oSSLContext: oSelf.fFireCallbacks(
-          "securing connection to server",
-          sbHost = sbHost,
-          uPortNumber = uPortNumber,
-          sbIPAddress = sbIPAddress,
-          oConnection = oConnection,
-          oSSLContext = oSSLContext,
-        ),
-        f0SecuringConnectionFailedCallback = lambda oException, sbHost, uPortNumber, sbIPAddress, oConnection, oSSLContext: oSelf.fFireCallbacks(
-          "securing connection to server failed",
-          oException = oException,
-          sbHost = sbHost,
-          uPortNumber = uPortNumber,
-          sbIPAddress = sbIPAddress,
-          oConnection = oConnection,
-          oSSLContext = oSSLContext,
-        ),
-        f0ConnectionSecuredCallback = lambda sbHost, uPortNumber, sbIPAddress, oConnection, oSSLContext: oSelf.fFireCallbacks(
-          "secured connection to server",
-          sbHost = sbHost,
-          uPortNumber = uPortNumber,
-          sbIPAddress = sbIPAddress,
-          oConnection = oConnection,
-          oSSLContext = oSSLContext,
-        ),
+      (oConnection, dnDurationInSeconds_by_sMetricName) = oSelf.__ftxConnect(
+        n0ConnectTimeoutInSeconds,
+        bSecureConnection,
+        bzCheckHost,
+        n0zSecureTimeoutInSeconds,
       );
     except:
       oSelf.__oConnectionsPropertyLock.fAcquire();
@@ -404,7 +783,14 @@ class cConnectionsToServerPool(cWithCallbacks):
         oSelf.__uPendingConnects -= 1;
       finally:
         oSelf.__oConnectionsPropertyLock.fRelease();
+      # A new connection can be created by the first request that is waiting for one.
+      oSelf.__fReserveConnectSlotForFirstWaitingRequest();
       raise;
+    # The metrics of the connection are included in those of the pool from now on.
+    oSelf.oMetrics.fAddChild(oConnection.oMetrics);
+    oSelf.oMetrics.fAddToCounter("connections created");
+    for (sMetricName, nDurationInSeconds) in dnDurationInSeconds_by_sMetricName.items():
+      oConnection.oMetrics.fRecordDuration(sMetricName, nDurationInSeconds);
     # Start a transaction to prevent other threads from using it:
     oConnection.fStartTransaction(
       n0TimeoutInSeconds = fxGetFirstProvidedValue(n0zTransactionTimeoutInSeconds, cConnection.n0DefaultTransactionTimeoutInSeconds),
@@ -415,61 +801,278 @@ class cConnectionsToServerPool(cWithCallbacks):
     try:
       oSelf.__uPendingConnects -= 1;
       oSelf.__aoConnections.append(oConnection);
+      # This is done while the lock is held, so an event cannot get forwarded
+      # twice if a callback is added for it to the pool at the same time.
+      for sEventName in oSelf.__asForwardedConnectionEventNames:
+        oSelf.__fAddForwardingCallbackToConnection(oConnection, sEventName);
     finally:
       oSelf.__oConnectionsPropertyLock.fRelease();
     oConnection.fAddCallbacks({
-      "wrote bytes": lambda oConnection, *, sbBytes: oSelf.fFireCallbacks(
-        "wrote bytes",
-        oConnection = oConnection,
-        sbBytes = sbBytes,
-      ),
-      "read bytes": lambda oConnection, *, sbBytes: oSelf.fFireCallbacks(
-        "read bytes",
-        oConnection = oConnection,
-        sbBytes = sbBytes,
-      ),
-      "received out-of-band data from server": lambda oConnection, *, sbOutOfBandData: oSelf.fFireCallbacks(
-        "received out-of-band data from server",
-        oConnection = oConnection,
-        sbOutOfBandData = sbOutOfBandData,
-      ),
-      "sending request to server": lambda oConnection, *, oRequest: oSelf.fFireCallbacks(
-        "sending request to server",
-        oConnection = oConnection,
-        oRequest = oRequest,
-      ),
-      "sending request to server failed": lambda oConnection, *, oRequest, oException: oSelf.fFireCallbacks(
-        "sending request to server failed",
-        oConnection = oConnection,
-        oRequest = oRequest,
-        oException = oException,
-      ),
-      "sent request to server": lambda oConnection, *, oRequest: oSelf.fFireCallbacks(
-        "sent request to server",
-        oConnection = oConnection,
-        oRequest = oRequest,
-      ),
-      "receiving response from server": lambda oConnection, *, o0Request: oSelf.fFireCallbacks(
-        "receiving response from server",
-        oConnection = oConnection,
-        o0Request = o0Request,
-      ),
-      "receiving response from server failed": lambda oConnection, *, o0Request, oException: oSelf.fFireCallbacks(
-        "receiving response from server failed",
-        oConnection = oConnection,
-        o0Request = o0Request,
-        oException = oException,
-      ),
-      "received response from server": lambda oConnection, *, o0Request, oResponse: oSelf.fFireCallbacks(
-        "received response from server",
-        oConnection = oConnection,
-        o0Request = o0Request,
-        oResponse = oResponse,
-      ),
+      "ended transaction": oSelf.__fHandleEndedTransactionCallbackFromConnection,
       "terminated": oSelf.__fHandleTerminatedCallbackFromConnection,
     });
     return oConnection;
   
+  def fHandleFirstCallbackAddedForEvent(oSelf, sEventName):
+    # Start forwarding the event from all existing and future connections.
+    if sEventName not in gasForwardedConnectionEventNames:
+      return;
+    oSelf.__oConnectionsPropertyLock.fAcquire();
+    try:
+      if sEventName in oSelf.__asForwardedConnectionEventNames:
+        return;
+      oSelf.__asForwardedConnectionEventNames.add(sEventName);
+      for oConnection in oSelf.__aoConnections + oSelf.__aoExternallyManagedConnections:
+        oSelf.__fAddForwardingCallbackToConnection(oConnection, sEventName);
+    finally:
+      oSelf.__oConnectionsPropertyLock.fRelease();
+  
+  def __fAddForwardingCallbackToConnection(oSelf, oConnection, sEventName):
+    oConnection.fAddCallback(
+      sEventName,
+      lambda oConnection, **dxArguments: oSelf.fFireCallbacks(
+        sEventName,
+        oConnection = oConnection,
+        **dxArguments,
+      ),
+    );
+  
+  @ShowDebugOutput
+  def __ftxConnect(oSelf,
+    n0ConnectTimeoutInSeconds,
+    bSecureConnection,
+    bzCheckHost,
+    n0zSecureTimeoutInSeconds,
+  ):
+    # Returns a new connection to the server and a dict with the time it took
+    # to connect and secure it.
+    # If we have a DNS cache, the hostname of the server is resolved using it.
+    # If it resolves to multiple IP addresses, we try to connect to them in
+    # parallel, starting a new attempt every so often until one succeeds, as
+    # described in RFC 8305 ("Happy Eyeballs"). The first connection that is
+    # established is used and all others are terminated. The SSL context
+    # determines the hostname used for securing the connection, so we do not
+    # need to provide it to foConnectTo.
+    # Events are fired with the hostname of the server, not the IP address, and
+    # the connection reports the hostname as its remote host as well.
+    sbServerHost = oSelf.__oServerBaseURL.sbHost;
+    n0EndTime = (time.time() + n0ConnectTimeoutInSeconds) if n0ConnectTimeoutInSeconds is not None else None;
+    fResolvingHostname = lambda sbHostname: oSelf.fFireCallbacks(
+      "resolving server hostname to ip address",
+      sbHostname = sbHostname,
+    );
+    fResolvingHostnameFailed = lambda sbHostname, oException: oSelf.fFireCallbacks(
+      "resolving server hostname to ip address failed",
+      sbHostname = sbHostname,
+      oException = oException,
+    );
+    fHostnameResolvedToIPAddress = lambda sbHostname, sbIPAddress, sCanonicalName: oSelf.fFireCallbacks(
+      "resolved server hostname to ip address",
+      sbHostname = sbHostname,
+      sbIPAddress = sbIPAddress,
+      sCanonicalName = sCanonicalName,
+    );
+    if oSelf.__o0DNSCache is None:
+      asbHostOrIPAddresses = [sbServerHost];
+    else:
+      asbHostOrIPAddresses = oSelf.__fasbSortIPAddresses(oSelf.__o0DNSCache.fasbGetIPAddresses(
+        sbServerHost,
+        f0ResolvingHostnameCallback = fResolvingHostname,
+        f0ResolvingHostnameFailedCallback = fResolvingHostnameFailed,
+        f0HostnameResolvedToIPAddressCallback = fHostnameResolvedToIPAddress,
+      ));
+      # foConnectTo gets an IP address, so there is nothing left to resolve.
+      fResolvingHostname = fResolvingHostnameFailed = fHostnameResolvedToIPAddress = None;
+    
+    def ftxConnectTo(sbHostOrIPAddress):
+      # The connect and TLS handshake times are measured between the callbacks
+      # that are called before and after each.
+      dnStartTime_by_sMetricName = {};
+      dnDurationInSeconds_by_sMetricName = {};
+      def fStartTimer(sMetricName):
+        dnStartTime_by_sMetricName[sMetricName] = time.perf_counter();
+      def fStopTimer(sMetricName):
+        n0StartTime = dnStartTime_by_sMetricName.pop(sMetricName, None);
+        if n0StartTime is not None:
+          dnDurationInSeconds_by_sMetricName[sMetricName] = time.perf_counter() - n0StartTime;
+      try:
+        oConnection = cConnection.foConnectTo(
+          sbHost = sbHostOrIPAddress,
+          uPortNumber = oSelf.__oServerBaseURL.uPortNumber,
+          n0zConnectTimeoutInSeconds = (n0EndTime - time.time()) if n0EndTime is not None else None,
+          o0SSLContext = oSelf.__o0SSLContext if bSecureConnection else None,
+          bzCheckHost = fxzGetFirstProvidedValueIfAny(bzCheckHost, oSelf.__bzCheckHost),
+          n0zSecureTimeoutInSeconds = n0zSecureTimeoutInSeconds,
+          nSendDelayPerByteInSeconds = oSelf.nSendDelayPerByteInSeconds,
+          f0HostInvalidCallback = lambda sbIgnoredHost, oException: oSelf.fFireCallbacks(
+            "server host invalid",
+            sbHost = sbServerHost,
+            oException = oException,
+          ),
+          f0ResolvingHostnameCallback = fResolvingHostname,
+          f0ResolvingHostnameFailedCallback = fResolvingHostnameFailed,
+          f0HostnameResolvedToIPAddressCallback = fHostnameResolvedToIPAddress,
+          f0ConnectingToIPAddressCallback = lambda sbIgnoredHost, uPortNumber, sbIPAddress: fStartTimer("connect time") or oSelf.fFireCallbacks(
+            "creating connection to server",
+            sbHost = sbServerHost,
+            uPortNumber = uPortNumber,
+            sbIPAddress = sbIPAddress,
+          ),
+          f0ConnectingToIPAddressFailedCallback = lambda oException, sbIgnoredHost, uPortNumber, sbIPAddress: oSelf.fFireCallbacks(
+            "creating connection to server failed",
+            sbHost = sbServerHost,
+            uPortNumber = uPortNumber,
+            sbIPAddress = sbIPAddress,
+            oException = oException,
+          ),
+          f0ConnectedToIPAddressCallback = lambda sbIgnoredHost, uPortNumber, sbIPAddress, oConnection: fStopTimer("connect time") or oConnection.fSetRemoteHostname(sbServerHost) or oSelf.fFireCallbacks(
+            "created connection to server",
+            sbHost = sbServerHost,
+            uPortNumber = uPortNumber,
+            sbIPAddress = sbIPAddress,
+            oConnection = oConnection,
+          ),
+          f0SecuringConnectionCallback = lambda sbIgnoredHost, uPortNumber, sbIPAddress, oConnection, oSSLContext: fStartTimer("TLS handshake time") or oSelf.fFireCallbacks(
+            "securing connection to server",
+            sbHost = sbServerHost,
+            uPortNumber = uPortNumber,
+            sbIPAddress = sbIPAddress,
+            oConnection = oConnection,
+            oSSLContext = oSSLContext,
+          ),
+          f0SecuringConnectionFailedCallback = lambda oException, sbIgnoredHost, uPortNumber, sbIPAddress, oConnection, oSSLContext: oSelf.fFireCallbacks(
+            "securing connection to server failed",
+            oException = oException,
+            sbHost = sbServerHost,
+            uPortNumber = uPortNumber,
+            sbIPAddress = sbIPAddress,
+            oConnection = oConnection,
+            oSSLContext = oSSLContext,
+          ),
+          f0ConnectionSecuredCallback = lambda sbIgnoredHost, uPortNumber, sbIPAddress, oConnection, oSSLContext: fStopTimer("TLS handshake time") or oSelf.fFireCallbacks(
+            "secured connection to server",
+            sbHost = sbServerHost,
+            uPortNumber = uPortNumber,
+            sbIPAddress = sbIPAddress,
+            oConnection = oConnection,
+            oSSLContext = oSSLContext,
+          ),
+        );
+      except Exception:
+        oSelf.__fRecordIPAddressConnectResult(sbHostOrIPAddress, False, None);
+        raise;
+      oSelf.__fRecordIPAddressConnectResult(sbHostOrIPAddress, True, dnDurationInSeconds_by_sMetricName.get("connect time"));
+      return (oConnection, dnDurationInSeconds_by_sMetricName);
+    
+    if len(asbHostOrIPAddresses) == 1:
+      return ftxConnectTo(asbHostOrIPAddresses[0]);
+    # Each attempt is made in a separate thread, which reports the result in
+    # this queue. Only the first connection that is established is reported;
+    # any others are terminated by the thread that established them.
+    oResultsQueue = queue.Queue();
+    oWinnerLock = cLock("%s.__oWinnerLock" % oSelf.__class__.__name__);
+    abWinnerFound = [False];
+    def fConnectToIPAddressThread(sbIPAddress):
+      try:
+        txConnectionAndDurations = ftxConnectTo(sbIPAddress);
+      except Exception as oException:
+        oResultsQueue.put((None, oException));
+        return;
+      oWinnerLock.fAcquire();
+      try:
+        bTooLate = abWinnerFound[0];
+        abWinnerFound[0] = True;
+      finally:
+        oWinnerLock.fRelease();
+      if bTooLate:
+        fShowDebugOutput(oSelf, "Connected to %s after another connection was established." % repr(sbIPAddress));
+        oConnection = txConnectionAndDurations[0];
+        oConnection.fTerminate();
+        # "created connection to server" was fired for this connection, but it
+        # was never added to the pool, so we report its termination here.
+        oSelf.fFireCallbacks(
+          "terminated connection to server",
+          sbHost = sbServerHost,
+          uPortNumber = oSelf.__oServerBaseURL.uPortNumber,
+          sbIPAddress = sbIPAddress,
+          oConnection = oConnection,
+        );
+      else:
+        oResultsQueue.put((txConnectionAndDurations, None));
+    uNumberOfAttemptsStarted = 0;
+    uNumberOfAttemptsFinished = 0;
+    while 1:
+      if uNumberOfAttemptsStarted < len(asbHostOrIPAddresses):
+        cThread(fConnectToIPAddressThread, asbHostOrIPAddresses[uNumberOfAttemptsStarted]).fStart();
+        uNumberOfAttemptsStarted += 1;
+      # Wait for an attempt to finish, or until it is time to start the next.
+      while 1:
+        n0WaitTimeoutInSeconds = (
+          oSelf.__nConnectionAttemptDelayInSeconds if uNumberOfAttemptsStarted < len(asbHostOrIPAddresses)
+          else None
+        );
+        try:
+          (t0xConnectionAndDurations, o0Exception) = oResultsQueue.get(timeout = n0WaitTimeoutInSeconds);
+        except queue.Empty:
+          break; # Start the next attempt.
+        uNumberOfAttemptsFinished += 1;
+        if t0xConnectionAndDurations is not None:
+          return t0xConnectionAndDurations;
+        if uNumberOfAttemptsFinished == len(asbHostOrIPAddresses):
+          raise o0Exception;
+        fShowDebugOutput(oSelf, "A connection attempt failed (%s)." % repr(o0Exception));
+        if uNumberOfAttemptsFinished == uNumberOfAttemptsStarted:
+          break; # All attempts we started have failed: start the next now.
+  
+  def __fasbSortIPAddresses(oSelf, asbIPAddresses):
+    # Alternate between IPv6 and IPv4 addresses, starting with the family of
+    # the first address (RFC 8305 section 4). Then move addresses to which we
+    # connected recently to the front, fastest first, and addresses to which
+    # we recently failed to connect to the back.
+    asbIPv6Addresses = [sbIPAddress for sbIPAddress in asbIPAddresses if b":" in sbIPAddress];
+    asbIPv4Addresses = [sbIPAddress for sbIPAddress in asbIPAddresses if b":" not in sbIPAddress];
+    if asbIPv4Addresses and asbIPAddresses[0] == asbIPv4Addresses[0]:
+      (asbIPv6Addresses, asbIPv4Addresses) = (asbIPv4Addresses, asbIPv6Addresses);
+    asbInterleavedIPAddresses = [];
+    for uIndex in range(max(len(asbIPv6Addresses), len(asbIPv4Addresses))):
+      asbInterleavedIPAddresses += asbIPv6Addresses[uIndex:uIndex + 1] + asbIPv4Addresses[uIndex:uIndex + 1];
+    nNow = time.time();
+    oSelf.__oConnectionsPropertyLock.fAcquire();
+    try:
+      dtxStatistics_by_sbIPAddress = dict(oSelf.__dtxConnectStatistics_by_sbIPAddress);
+    finally:
+      oSelf.__oConnectionsPropertyLock.fRelease();
+    def ftxGetSortKey(sbIPAddress):
+      (n0SmoothedConnectTimeInSeconds, n0LastFailureTime) = dtxStatistics_by_sbIPAddress.get(sbIPAddress, (None, None));
+      bFailedRecently = n0LastFailureTime is not None and nNow - n0LastFailureTime < gnIPAddressFailurePenaltyInSeconds;
+      return (
+        bFailedRecently,
+        n0SmoothedConnectTimeInSeconds is None,
+        n0SmoothedConnectTimeInSeconds or 0,
+      );
+    return sorted(asbInterleavedIPAddresses, key = ftxGetSortKey);
+  
+  def __fRecordIPAddressConnectResult(oSelf, sbIPAddress, bConnected, n0ConnectTimeInSeconds):
+    # Remember the smoothed connect time (like TCP's smoothed round-trip time)
+    # and the time of the last failure for each IP address. A successful
+    # connection clears the failure.
+    oSelf.__oConnectionsPropertyLock.fAcquire();
+    try:
+      (n0SmoothedConnectTimeInSeconds, n0LastFailureTime) = \
+          oSelf.__dtxConnectStatistics_by_sbIPAddress.get(sbIPAddress, (None, None));
+      if not bConnected:
+        n0LastFailureTime = time.time();
+      else:
+        n0LastFailureTime = None;
+        if n0ConnectTimeInSeconds is not None:
+          n0SmoothedConnectTimeInSeconds = n0ConnectTimeInSeconds if n0SmoothedConnectTimeInSeconds is None else (
+            n0SmoothedConnectTimeInSeconds * (1 - gnConnectTimeSmoothingFactor)
+            + n0ConnectTimeInSeconds * gnConnectTimeSmoothingFactor
+          );
+      oSelf.__dtxConnectStatistics_by_sbIPAddress[sbIPAddress] = (n0SmoothedConnectTimeInSeconds, n0LastFailureTime);
+    finally:
+      oSelf.__oConnectionsPropertyLock.fRelease();
+  
   @ShowDebugOutput
   def fo0SendRequestAndReceiveResponse(oSelf,
     oRequest,
@@ -482,7 +1085,54 @@ class cConnectionsToServerPool(cWithCallbacks):
     u0zMaxBodySize = zNotProvided,
     u0zMaxChunkSize = zNotProvided,
     u0zMaxNumberOfChunks = zNotProvided,
-    u0MaxNumberOfChunksBeforeDisconnecting = zNotProvided, # disconnect and return response once this many chunks are received.
+    u0MaxNumberOfChunksBeforeDisconnecting = None, # disconnect and return response once this many chunks are received.
+    x0BodySource = None, # Read the request body from this while it is sent (see cConnection.fSendRequest).
+    bDecodeBody = False, # Ask for an encoded (compressed) body and decode it (see cConnection.foReceiveResponse).
+  ):
+    # Send a request to the server and receive a response, or get the response
+    # from the HTTP cache if the pool has one and it has a usable response.
+    assert not bDecodeBody or u0MaxNumberOfChunksBeforeDisconnecting is None, \
+        "A body cannot be decoded if it is not read completely.";
+    fo0SendRequestAndReceiveResponse = lambda oRequest: oSelf.__fo0SendRequestAndReceiveResponse(
+      oRequest,
+      n0zConnectTimeoutInSeconds = n0zConnectTimeoutInSeconds,
+      n0zSecureTimeoutInSeconds = n0zSecureTimeoutInSeconds,
+      n0zTransactionTimeoutInSeconds = n0zTransactionTimeoutInSeconds,
+      u0zMaxStartLineSize = u0zMaxStartLineSize,
+      u0zMaxHeaderLineSize = u0zMaxHeaderLineSize,
+      u0zMaxNumberOfHeaders = u0zMaxNumberOfHeaders,
+      u0zMaxBodySize = u0zMaxBodySize,
+      u0zMaxChunkSize = u0zMaxChunkSize,
+      u0zMaxNumberOfChunks = u0zMaxNumberOfChunks,
+      u0MaxNumberOfChunksBeforeDisconnecting = u0MaxNumberOfChunksBeforeDisconnecting,
+      x0BodySource = x0BodySource,
+      bDecodeBody = bDecodeBody,
+    );
+    if oSelf.__o0HTTPCache is None or u0MaxNumberOfChunksBeforeDisconnecting is not None:
+      # A response that was cut short cannot be stored.
+      return fo0SendRequestAndReceiveResponse(oRequest);
+    return oSelf.__o0HTTPCache.fo0GetResponse(
+      oSelf.__oServerBaseURL,
+      oRequest,
+      fo0SendRequestAndReceiveResponse,
+    );
+  
+  @ShowDebugOutput
+  def __fo0SendRequestAndReceiveResponse(oSelf,
+    oRequest,
+    *,
+    n0zConnectTimeoutInSeconds,
+    n0zSecureTimeoutInSeconds,
+    n0zTransactionTimeoutInSeconds,
+    u0zMaxStartLineSize,
+    u0zMaxHeaderLineSize,
+    u0zMaxNumberOfHeaders,
+    u0zMaxBodySize,
+    u0zMaxChunkSize,
+    u0zMaxNumberOfChunks,
+    u0MaxNumberOfChunksBeforeDisconnecting,
+    x0BodySource,
+    bDecodeBody,
   ):
     # Send a request to the server and receive a response. A transaction on the
     # connection is started before and ended after this exchange.
@@ -518,7 +1168,10 @@ class cConnectionsToServerPool(cWithCallbacks):
           u0zMaxChunkSize = u0zMaxChunkSize,
           u0zMaxNumberOfChunks = u0zMaxNumberOfChunks,
           u0MaxNumberOfChunksBeforeDisconnecting = u0MaxNumberOfChunksBeforeDisconnecting, # disconnect and return response once this many chunks are received.
+          x0BodySource = x0BodySource,
+          bDecodeBody = bDecodeBody,
         );
+        oSelf.__fUpdateServerKeepAliveTimeout(oResponse);
         if oRequest.fbHasConnectionCloseHeader():
           fShowDebugOutput("Closing connection per client request...");
           oConnection.fDisconnect();
@@ -529,17 +1182,240 @@ class cConnectionsToServerPool(cWithCallbacks):
         oConnection.fEndTransaction();
       return oResponse;
   
+  def fiterSendRequestsAndReceiveResponses(oSelf,
+    aoRequests,
+    uzMaxNumberOfParallelRequests = zNotProvided,
+    bInOrder = False,
+    **dxSendRequestAndReceiveResponseArguments,
+  ):
+    # Send requests to the server and receive their responses in parallel,
+    # using up to uMaxNumberOfParallelRequests worker threads that share the
+    # connections in this pool. aoRequests can be any iterable; requests are
+    # taken from it as workers become available.
+    # The remaining arguments are passed to `fo0SendRequestAndReceiveResponse`.
+    # Yields (oRequest, o0Response, o0Exception) for each request as soon as
+    # it completes, or in the order of the requests if bInOrder is True.
+    # o0Response is None if an exception was thrown or we are stopping.
+    # If iterating over aoRequests throws an exception, it is re-thrown.
+    uMaxNumberOfParallelRequests = fxGetFirstProvidedValue(
+      uzMaxNumberOfParallelRequests,
+      oSelf.__u0MaxNumberOfConnectionsToServer or gu0DefaultMaxNumberOfConnectionsToServer,
+    );
+    assert uMaxNumberOfParallelRequests > 0, \
+        "uMaxNumberOfParallelRequests must be larger than 0, not %d" % uMaxNumberOfParallelRequests;
+    # This lock is held while the next request is taken from aoRequests, which
+    # can take any amount of time (e.g. if it is read from a database), so it
+    # has no deadlock timeout.
+    oRequestsLock = cLock(
+      "%s.fiterSendRequestsAndReceiveResponses.oRequestsLock" % oSelf.__class__.__name__,
+    );
+    oIndexedRequestsIterator = enumerate(aoRequests);
+    oResultsQueue = queue.Queue();
+    bStopped = False;
+    def fWorker():
+      try:
+        while not bStopped and not oSelf.__bStopping:
+          oRequestsLock.fAcquire();
+          try:
+            (uIndex, oRequest) = next(oIndexedRequestsIterator);
+          except StopIteration:
+            break;
+          except Exception as oException:
+            # The requests iterable failed; the consumer re-throws this.
+            oResultsQueue.put((None, None, None, oException));
+            break;
+          finally:
+            oRequestsLock.fRelease();
+          try:
+            o0Response = oSelf.fo0SendRequestAndReceiveResponse(oRequest, **dxSendRequestAndReceiveResponseArguments);
+          except Exception as oException:
+            oResultsQueue.put((uIndex, oRequest, None, oException));
+          else:
+            oResultsQueue.put((uIndex, oRequest, o0Response, None));
+      finally:
+        oResultsQueue.put(None); # Signal this worker is done.
+    for uWorkerIndex in range(uMaxNumberOfParallelRequests):
+      cThread(fWorker).fStart();
+    uNumberOfRunningWorkers = uMaxNumberOfParallelRequests;
+    dtxResult_by_uIndex = {};
+    uNextIndex = 0;
+    try:
+      while uNumberOfRunningWorkers > 0:
+        tx0Result = oResultsQueue.get();
+        if tx0Result is None:
+          uNumberOfRunningWorkers -= 1;
+          continue;
+        (u0Index, oRequest, o0Response, o0Exception) = tx0Result;
+        if u0Index is None:
+          raise o0Exception;
+        uIndex = u0Index;
+        if not bInOrder:
+          yield (oRequest, o0Response, o0Exception);
+          continue;
+        dtxResult_by_uIndex[uIndex] = (oRequest, o0Response, o0Exception);
+        while uNextIndex in dtxResult_by_uIndex:
+          yield dtxResult_by_uIndex.pop(uNextIndex);
+          uNextIndex += 1;
+      # Workers stop taking requests when we are stopping; all requests they
+      # took have been reported, so the remaining requests come last.
+      for (uIndex, oRequest) in oIndexedRequestsIterator:
+        yield (oRequest, None, None);
+    finally:
+      # If the caller stops iterating, workers finish their current request
+      # but do not start new ones.
+      bStopped = True;
+  
+  def fao0SendRequestsAndReceiveResponses(oSelf,
+    aoRequests,
+    uzMaxNumberOfParallelRequests = zNotProvided,
+    **dxSendRequestAndReceiveResponseArguments,
+  ):
+    # Send requests to the server and receive their responses in parallel (see
+    # `fiterSendRequestsAndReceiveResponses`).
+    # Returns a list with a response for each request in the same order as the
+    # requests. An item is None if an exception was thrown for that request or
+    # we are stopping; use `fiterSendRequestsAndReceiveResponses` to find out
+    # what exceptions were thrown.
+    return [
+      o0Response
+      for (oRequest, o0Response, o0Exception) in oSelf.fiterSendRequestsAndReceiveResponses(
+        aoRequests,
+        uzMaxNumberOfParallelRequests = uzMaxNumberOfParallelRequests,
+        bInOrder = True,
+        **dxSendRequestAndReceiveResponseArguments,
+      )
+    ];
+  
+  @ShowDebugOutput
+  def fao0SendPipelinedRequestsAndReceiveResponses(oSelf,
+    aoRequests,
+    n0zConnectTimeoutInSeconds = zNotProvided,
+    n0zSecureTimeoutInSeconds = zNotProvided,
+    n0zTransactionTimeoutInSeconds = zNotProvided,
+    u0zMaxStartLineSize = zNotProvided,
+    u0zMaxHeaderLineSize = zNotProvided,
+    u0zMaxNumberOfHeaders = zNotProvided,
+    u0zMaxBodySize = zNotProvided,
+    u0zMaxChunkSize = zNotProvided,
+    u0zMaxNumberOfChunks = zNotProvided,
+    uzMaxNumberOfPipelinedRequestsPerConnection = zNotProvided,
+    f0ResponseReceivedCallback = None, # called with (oRequest, oResponse) for each response received.
+  ):
+    # Send safe requests without a body to the server using HTTP/1.1
+    # pipelining and receive their responses (see
+    # cConnection.faoSendPipelinedRequestsAndReceiveResponses).
+    # Up to uMaxNumberOfPipelinedRequestsPerConnection requests are sent back
+    # to back over a connection. If the server closes the connection before
+    # responding to all of them, the remaining requests are sent again over
+    # another connection.
+    # Returns a list of cResponse objects in the same order as the requests,
+    # or None if we are stopping.
+    # Can throw a max-connections-reached exception.
+    uMaxNumberOfPipelinedRequestsPerConnection = fxGetFirstProvidedValue(
+      uzMaxNumberOfPipelinedRequestsPerConnection,
+      guDefaultMaxNumberOfPipelinedRequestsPerConnection,
+    );
+    aoResponses = [];
+    aoRequestsLeft = list(aoRequests);
+    while aoRequestsLeft:
+      if oSelf.__bStopping:
+        return None;
+      # A request that asks the server to close the connection must be the
+      # last one sent over a connection.
+      aoRequestsForConnection = [];
+      for oRequest in aoRequestsLeft[:uMaxNumberOfPipelinedRequestsPerConnection]:
+        aoRequestsForConnection.append(oRequest);
+        if oRequest.fbHasConnectionCloseHeader():
+          break;
+      o0Connection = oSelf.__fo0GetConnectionAndStartTransactionBeforeSendingRequest(
+        n0zConnectTimeoutInSeconds = n0zConnectTimeoutInSeconds,
+        bSecureConnection = True,
+        bzCheckHost = oSelf.__bzCheckHost,
+        n0zSecureTimeoutInSeconds = n0zSecureTimeoutInSeconds,
+        n0zTransactionTimeoutInSeconds = n0zTransactionTimeoutInSeconds,
+      );
+      if o0Connection is None:
+        assert oSelf.__bStopping, \
+            "A new connection was not established even though we are not stopping!?";
+        return None;
+      oConnection = o0Connection;
+      try:
+        # Returns at least one cResponse instance.
+        aoConnectionResponses = oConnection.faoSendPipelinedRequestsAndReceiveResponses(
+          aoRequestsForConnection,
+          u0zMaxStartLineSize = u0zMaxStartLineSize,
+          u0zMaxHeaderLineSize = u0zMaxHeaderLineSize,
+          u0zMaxNumberOfHeaders = u0zMaxNumberOfHeaders,
+          u0zMaxBodySize = u0zMaxBodySize,
+          u0zMaxChunkSize = u0zMaxChunkSize,
+          u0zMaxNumberOfChunks = u0zMaxNumberOfChunks,
+          f0ResponseReceivedCallback = f0ResponseReceivedCallback,
+        );
+        oSelf.__fUpdateServerKeepAliveTimeout(aoConnectionResponses[-1]);
+        if len(aoConnectionResponses) < len(aoRequestsForConnection):
+          fShowDebugOutput("Server responded to %d/%d pipelined requests; sending the rest again..." % (
+            len(aoConnectionResponses), len(aoRequestsForConnection),
+          ));
+          oConnection.fDisconnect();
+        elif aoRequestsForConnection[-1].fbHasConnectionCloseHeader():
+          fShowDebugOutput("Closing connection per client request...");
+          oConnection.fDisconnect();
+      finally:
+        oConnection.fEndTransaction();
+      aoResponses += aoConnectionResponses;
+      aoRequestsLeft = aoRequestsLeft[len(aoConnectionResponses):];
+    return aoResponses;
+  
+  @ShowDebugOutput
+  def __fHandleEndedTransactionCallbackFromConnection(oSelf, oConnection):
+    o0WaitingForConnectionLock = None;
+    bStartIdleConnectionsCheckThread = False;
+    oSelf.__oConnectionsPropertyLock.fAcquire();
+    try:
+      # Externally managed and terminated connections are not reused.
+      if (
+        oConnection in oSelf.__aoConnections
+        and oConnection not in oSelf.__aoIdleConnections
+        and not oConnection.bStopping
+      ):
+        if oSelf.__aoWaitingForConnectionLocks:
+          o0WaitingForConnectionLock = oSelf.__aoWaitingForConnectionLocks.pop(0);
+          oSelf.__doHandedOverConnection_by_oWaitingForConnectionLock[o0WaitingForConnectionLock] = oConnection;
+        else:
+          oSelf.__aoIdleConnections.append(oConnection);
+          oSelf.__dnIdleSinceTime_by_oConnection[oConnection] = time.time();
+          bStartIdleConnectionsCheckThread = not oSelf.__bIdleConnectionsCheckThreadIsRunning;
+          oSelf.__bIdleConnectionsCheckThreadIsRunning = True;
+    finally:
+      oSelf.__oConnectionsPropertyLock.fRelease();
+    if bStartIdleConnectionsCheckThread:
+      cThread(oSelf.__fIdleConnectionsCheckThread).fStart();
+    if o0WaitingForConnectionLock:
+      if gbShowDebugOutput:
+        fShowDebugOutput(oSelf, "Handing over connection to waiting request: %s." % oConnection);
+      o0WaitingForConnectionLock.fRelease();
+  
   @ShowDebugOutput
   def __fHandleTerminatedCallbackFromConnection(oSelf, oConnection):
     oSelf.__oConnectionsPropertyLock.fAcquire();
     try:
-      if oConnection in oSelf.__aoConnections:
+      bConnectionWasInPool = oConnection in oSelf.__aoConnections;
+      if bConnectionWasInPool:
         oSelf.__aoConnections.remove(oConnection);
+        if oConnection in oSelf.__aoIdleConnections:
+          oSelf.__aoIdleConnections.remove(oConnection);
+          del oSelf.__dnIdleSinceTime_by_oConnection[oConnection];
       else:
         oSelf.__aoExternallyManagedConnections.remove(oConnection);
       bCheckIfTerminated = oSelf.__bStopping and len(oSelf.__aoConnections) == 0 and len(oSelf.__aoExternallyManagedConnections) == 0;
     finally:
       oSelf.__oConnectionsPropertyLock.fRelease();
+    # The metrics of the connection are kept, but are no longer read from it.
+    oSelf.oMetrics.fRemoveChild(oConnection.oMetrics);
+    if bConnectionWasInPool:
+      # A new connection can be created by the first request that is waiting for one.
+      oSelf.__fReserveConnectSlotForFirstWaitingRequest();
+      oSelf.__fMaintainMinIdleConnections();
     oSelf.fFireCallbacks(
       "terminated connection to server",
       sbHost = oSelf.__oServerBaseURL.sbHost,
@@ -550,13 +1426,121 @@ class cConnectionsToServerPool(cWithCallbacks):
     if bCheckIfTerminated:
       oSelf.__fReportTerminatedIfNoMoreConnectionsExist();
   
+  @property
+  def n0MaxIdleTimeInSeconds(oSelf):
+    # The configured maximum idle time, or the timeout the server reported
+    # minus a margin if that is shorter.
+    n0MaxIdleTimeInSeconds = oSelf.__n0MaxIdleTimeInSeconds;
+    n0ServerKeepAliveTimeoutInSeconds = oSelf.__n0ServerKeepAliveTimeoutInSeconds;
+    if n0ServerKeepAliveTimeoutInSeconds is not None:
+      nMaxIdleTimeForServerInSeconds = max(0, n0ServerKeepAliveTimeoutInSeconds - gnKeepAliveTimeoutMarginInSeconds);
+      if n0MaxIdleTimeInSeconds is None or nMaxIdleTimeForServerInSeconds < n0MaxIdleTimeInSeconds:
+        return nMaxIdleTimeForServerInSeconds;
+    return n0MaxIdleTimeInSeconds;
+  
+  def __fUpdateServerKeepAliveTimeout(oSelf, oResponse):
+    n0KeepAliveTimeoutInSeconds = fn0GetKeepAliveTimeoutInSeconds(oResponse);
+    if n0KeepAliveTimeoutInSeconds is not None:
+      oSelf.__n0ServerKeepAliveTimeoutInSeconds = n0KeepAliveTimeoutInSeconds;
+  
+  @ShowDebugOutput
+  def __fIdleConnectionsCheckThread(oSelf):
+    while 1:
+      oSelf.__oTerminatedLock.fbWait(oSelf.__nIdleConnectionsCheckIntervalInSeconds);
+      oSelf.__oConnectionsPropertyLock.fAcquire();
+      try:
+        if oSelf.__bStopping or not oSelf.__aoIdleConnections:
+          oSelf.__bIdleConnectionsCheckThreadIsRunning = False;
+          return;
+      finally:
+        oSelf.__oConnectionsPropertyLock.fRelease();
+      oSelf.__fCheckIdleConnections();
+  
+  def __fCheckIdleConnections(oSelf):
+    # Close connections that have been idle for too long and check all others
+    # for having been closed by the server (or having received unexpected
+    # data) at once, so requests do not have to find out the hard way.
+    n0MaxIdleTimeInSeconds = oSelf.n0MaxIdleTimeInSeconds;
+    nNow = time.time();
+    aoExpiredConnections = [];
+    oSelf.__oConnectionsPropertyLock.fAcquire();
+    try:
+      if n0MaxIdleTimeInSeconds is not None:
+        for oConnection in oSelf.__aoIdleConnections[:]:
+          if nNow - oSelf.__dnIdleSinceTime_by_oConnection[oConnection] >= n0MaxIdleTimeInSeconds:
+            oSelf.__aoIdleConnections.remove(oConnection);
+            del oSelf.__dnIdleSinceTime_by_oConnection[oConnection];
+            aoExpiredConnections.append(oConnection);
+      aoIdleConnections = oSelf.__aoIdleConnections[:];
+    finally:
+      oSelf.__oConnectionsPropertyLock.fRelease();
+    for oConnection in aoExpiredConnections:
+      oSelf.__fCloseIdleConnection(oConnection);
+    if not aoIdleConnections:
+      return;
+    # An idle connection should not be readable: if it is, the server closed
+    # it or sent data we did not ask for.
+    oSelector = selectors.DefaultSelector();
+    try:
+      for oConnection in aoIdleConnections:
+        try:
+          oSelector.register(oConnection.oPythonSocket, selectors.EVENT_READ, oConnection);
+        except (ValueError, OSError):
+          pass; # The socket has been closed; the connection will be removed when it terminates.
+      atxReadableKeyAndEvents = oSelector.select(0);
+    finally:
+      oSelector.close();
+    for (oKey, uEvents) in atxReadableKeyAndEvents:
+      oConnection = oKey.data;
+      oSelf.__oConnectionsPropertyLock.fAcquire();
+      try:
+        if oConnection not in oSelf.__aoIdleConnections:
+          continue; # It is being used by a request, which will check it.
+        oSelf.__aoIdleConnections.remove(oConnection);
+        del oSelf.__dnIdleSinceTime_by_oConnection[oConnection];
+      finally:
+        oSelf.__oConnectionsPropertyLock.fRelease();
+      # This disconnects the connection if the server closed it or sent data.
+      # On secure connections, the data may be TLS records that do not affect
+      # the connection, in which case it becomes idle again.
+      if oSelf.__fbStartTransactionOnIdleConnection(oConnection, zNotProvided):
+        oConnection.fEndTransaction();
+  
+  @ShowDebugOutput
+  def fuCloseIdleConnections(oSelf, u0MaxNumberOfConnections = None):
+    # Close idle connections, least recently used first, e.g. to make room for
+    # connections to other servers. Returns the number of connections closed.
+    oSelf.__oConnectionsPropertyLock.fAcquire();
+    try:
+      uNumberOfConnections = len(oSelf.__aoIdleConnections) if u0MaxNumberOfConnections is None else \
+          min(u0MaxNumberOfConnections, len(oSelf.__aoIdleConnections));
+      # The idle connections are used as a stack: the least recently used is at the bottom.
+      aoConnectionsToClose = oSelf.__aoIdleConnections[:uNumberOfConnections];
+      for oConnection in aoConnectionsToClose:
+        oSelf.__aoIdleConnections.remove(oConnection);
+        del oSelf.__dnIdleSinceTime_by_oConnection[oConnection];
+    finally:
+      oSelf.__oConnectionsPropertyLock.fRelease();
+    for oConnection in aoConnectionsToClose:
+      oSelf.__fCloseIdleConnection(oConnection);
+    return len(aoConnectionsToClose);
+  
+  def __fCloseIdleConnection(oSelf, oConnection):
+    if gbShowDebugOutput:
+      fShowDebugOutput(oSelf, "Closing idle connection: %s." % oConnection);
+    oSelf.oMetrics.fAddToCounter("idle connections closed");
+    oConnection.fTerminate();
+  
   def fasGetDetails(oSelf):
     uConnectionsCount = oSelf.uConnectionsCount;
     bTerminated = oSelf.bTerminated;
+    uTLSHandshakesCount = oSelf.uTLSHandshakesCount;
     return [s for s in [
       str(oSelf.__oServerBaseURL.sbBase, 'latin1'),
       "%d connections" % uConnectionsCount if not bTerminated else None,
       "secure" if oSelf.__o0SSLContext else None,
+      "%d/%d TLS sessions resumed" % (oSelf.uResumedTLSSessionsCount, uTLSHandshakesCount) if uTLSHandshakesCount else None,
+      "min. %d idle" % oSelf.__uMinIdleConnections if oSelf.__uMinIdleConnections else None,
       "terminated" if bTerminated else
           "stopping" if oSelf.__bStopping else None,
     ] if s];
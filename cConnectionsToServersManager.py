@@ -0,0 +1,374 @@
+import time, urllib.parse;
+
+from mHTTPProtocol import cURL;
+from mMultiThreading import cLock;
+from mNotProvided import (
+  fxGetFirstProvidedValue,
+  zNotProvided,
+);
+
+from .cConnectionsToServerPool import cConnectionsToServerPool;
+from .cMetrics import cMetrics;
+from .mExceptions import cMaximumNumberOfConnectionsToServerReachedException;
+from .mOptionalDebugOutput import (
+  fShowDebugOutput,
+  gbShowDebugOutput,
+  ShowDebugOutput,
+);
+
+gnDeadlockTimeoutInSeconds = 1; # We're not doing anything time consuming, so this should suffice.
+gu0DefaultMaxNumberOfConnections = 256;
+guDefaultMaxNumberOfPools = 100;
+duDefaultPortNumber_by_sbLowerProtocol = {
+  b"http": 80,
+  b"https": 443,
+};
+
+def ftxGetOrigin(sbProtocol, sbHost, u0PortNumber):
+  # Returns the key used to look up the pool for an origin: the lowercase
+  # protocol and host and the port number, which is the default port number
+  # for the protocol if none is provided.
+  sbLowerProtocol = sbProtocol.lower();
+  assert sbLowerProtocol in duDefaultPortNumber_by_sbLowerProtocol, \
+      "Unsupported protocol %s" % repr(sbProtocol);
+  return (
+    sbLowerProtocol,
+    sbHost.lower(),
+    u0PortNumber if u0PortNumber is not None else duDefaultPortNumber_by_sbLowerProtocol[sbLowerProtocol],
+  );
+
+class cConnectionsToServersManager(object):
+  # Thread-safe manager of `cConnectionsToServerPool` instances for any number
+  # of servers. A pool is created for each origin (protocol, host and port
+  # number) the first time a request is sent to it. The number of pools and
+  # the number of connections used by all of them together are limited:
+  # - if there are more pools than uzMaxNumberOfPools, the least recently used
+  #   pools that are not handling requests are stopped and forgotten.
+  # - if sending a request may require a new connection while the maximum
+  #   number of connections is reached, idle connections to other servers are
+  #   closed, least recently used pool first. If there are none, the request
+  #   waits for another request to complete if bWaitForFreeConnection is True,
+  #   or a max-connections-reached exception is thrown if not.
+  # Every in-flight request is counted as one connection, so connections that
+  # the pools create by themselves (see `uMinIdleConnections`) may exceed the
+  # maximum.
+  # Additional arguments are passed to every pool, e.g. o0zDNSCache or
+  # o0HTTPCache.
+  @ShowDebugOutput
+  def __init__(oSelf,
+    *,
+    u0zMaxNumberOfConnections = zNotProvided,
+    u0zMaxNumberOfConnectionsToServer = zNotProvided,
+    uzMaxNumberOfPools = zNotProvided,
+    o0SSLContext = None,
+    bWaitForFreeConnection = False,
+    **dxPoolArguments,
+  ):
+    oSelf.__u0MaxNumberOfConnections = fxGetFirstProvidedValue(u0zMaxNumberOfConnections, gu0DefaultMaxNumberOfConnections);
+    oSelf.__u0zMaxNumberOfConnectionsToServer = u0zMaxNumberOfConnectionsToServer;
+    oSelf.__uMaxNumberOfPools = fxGetFirstProvidedValue(uzMaxNumberOfPools, guDefaultMaxNumberOfPools);
+    assert oSelf.__uMaxNumberOfPools > 0, \
+        "uzMaxNumberOfPools must be at least 1";
+    # The SSL context is only used for "https" origins.
+    oSelf.__o0SSLContext = o0SSLContext;
+    oSelf.__bWaitForFreeConnection = bWaitForFreeConnection;
+    oSelf.__dxPoolArguments = dxPoolArguments;
+  
+    oSelf.__oPropertiesLock = cLock(
+      "%s.__oPropertiesLock" % oSelf.__class__.__name__,
+      n0DeadlockTimeoutInSeconds = gnDeadlockTimeoutInSeconds
+    );
+    # Pools are kept in the order in which they were last used, so the least
+    # recently used pool is first.
+    oSelf.__doPool_by_txOrigin = {};
+    oSelf.__duActiveRequestsCount_by_oPool = {};
+    oSelf.__uActiveRequestsCount = 0;
+    # Pools that we stopped, until they have terminated.
+    oSelf.__aoStoppingPools = [];
+    # Requests waiting for a free connection each have a locked lock in this
+    # list, which is unlocked when another request completes (first-in,
+    # first-out).
+    oSelf.__aoWaitingForConnectionLocks = [];
+    oSelf.__bStopping = False;
+    oSelf.oMetrics = cMetrics();
+    oSelf.oMetrics.fAddGauge("pools", lambda: oSelf.uPoolsCount);
+    oSelf.oMetrics.fAddGauge("connections", lambda: oSelf.uConnectionsCount);
+    oSelf.oMetrics.fAddGauge("active requests", lambda: oSelf.__uActiveRequestsCount);
+    oSelf.oMetrics.fAddGauge("requests waiting for connection", lambda: len(oSelf.__aoWaitingForConnectionLocks));
+  
+  @property
+  def uPoolsCount(oSelf):
+    return len(oSelf.__doPool_by_txOrigin);
+  
+  @property
+  def aoPools(oSelf):
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      return list(oSelf.__doPool_by_txOrigin.values());
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+  
+  @property
+  def uConnectionsCount(oSelf):
+    return sum(oPool.uConnectionsCount for oPool in oSelf.aoPools);
+  
+  @property
+  def uIdleConnectionsCount(oSelf):
+    return sum(oPool.uIdleConnectionsCount for oPool in oSelf.aoPools);
+  
+  @property
+  def bTerminated(oSelf):
+    return oSelf.__bStopping and all(oPool.bTerminated for oPool in oSelf.__faoGetAllPools());
+  
+  def __faoGetAllPools(oSelf):
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      oSelf.__aoStoppingPools = [oPool for oPool in oSelf.__aoStoppingPools if not oPool.bTerminated];
+      return list(oSelf.__doPool_by_txOrigin.values()) + oSelf.__aoStoppingPools;
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+  
+  def fo0GetPoolForURL(oSelf, oURL):
+    # Returns the pool for the origin of the URL, creating it if needed, or
+    # None if we are stopping.
+    return oSelf.__fo0GetPoolForOrigin(ftxGetOrigin(oURL.sbProtocol, oURL.sbHost, oURL.uPortNumber));
+  
+  @ShowDebugOutput
+  def __fo0GetPoolForOrigin(oSelf, txOrigin):
+    aoEvictedPools = [];
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      if oSelf.__bStopping:
+        return None;
+      o0Pool = oSelf.__doPool_by_txOrigin.pop(txOrigin, None);
+      if o0Pool is None:
+        (sbLowerProtocol, sbLowerHost, uPortNumber) = txOrigin;
+        o0Pool = cConnectionsToServerPool(
+          cURL(sbLowerProtocol, sbLowerHost, uPortNumber),
+          u0zMaxNumberOfConnectionsToServer = oSelf.__u0zMaxNumberOfConnectionsToServer,
+          o0SSLContext = oSelf.__o0SSLContext if sbLowerProtocol == b"https" else None,
+          bWaitForFreeConnection = oSelf.__bWaitForFreeConnection,
+          **oSelf.__dxPoolArguments,
+        );
+        oSelf.oMetrics.fAddToCounter("pools created");
+        aoEvictedPools = oSelf.__faoEvictLeastRecentlyUsedPools(oSelf.__uMaxNumberOfPools - 1);
+      # (Re-)adding the pool makes it the most recently used.
+      oSelf.__doPool_by_txOrigin[txOrigin] = o0Pool;
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+    for oEvictedPool in aoEvictedPools:
+      if gbShowDebugOutput:
+        fShowDebugOutput(oSelf, "Stopping least recently used pool %s." % oEvictedPool);
+      oEvictedPool.fStop();
+    return o0Pool;
+  
+  def __faoEvictLeastRecentlyUsedPools(oSelf, uMaxNumberOfPools):
+    # Must be called while holding the properties lock. Removes pools that are
+    # not handling requests, least recently used first, until there are no more
+    # than the given number left. Returns the removed pools, which the caller
+    # must stop after releasing the lock.
+    aoEvictedPools = [];
+    for (txOrigin, oPool) in list(oSelf.__doPool_by_txOrigin.items()):
+      if len(oSelf.__doPool_by_txOrigin) <= uMaxNumberOfPools:
+        break;
+      if oSelf.__duActiveRequestsCount_by_oPool.get(oPool) or oPool.uConnectionsCount > oPool.uIdleConnectionsCount:
+        continue; # In use.
+      del oSelf.__doPool_by_txOrigin[txOrigin];
+      aoEvictedPools.append(oPool);
+      oSelf.__aoStoppingPools.append(oPool);
+    oSelf.oMetrics.fAddToCounter("pools evicted", len(aoEvictedPools));
+    return aoEvictedPools;
+  
+  @ShowDebugOutput
+  def fo0SendRequestAndReceiveResponse(oSelf,
+    oRequest,
+    *,
+    o0URL = None,
+    n0zConnectTimeoutInSeconds = zNotProvided,
+    n0zSecureTimeoutInSeconds = zNotProvided,
+    n0zTransactionTimeoutInSeconds = zNotProvided,
+    u0zMaxStartLineSize = zNotProvided,
+    u0zMaxHeaderLineSize = zNotProvided,
+    u0zMaxNumberOfHeaders = zNotProvided,
+    u0zMaxBodySize = zNotProvided,
+    u0zMaxChunkSize = zNotProvided,
+    u0zMaxNumberOfChunks = zNotProvided,
+    u0MaxNumberOfChunksBeforeDisconnecting = None, # disconnect and return response once this many chunks are received.
+    x0BodySource = None, # Read the request body from this while it is sent (see cConnection.fSendRequest).
+    bDecodeBody = False, # Ask for an encoded (compressed) body and decode it (see cConnection.foReceiveResponse).
+  ):
+    # Send a request to the server for the URL and receive a response using the
+    # pool for its origin. If no URL is provided, the request must use an
+    # absolute URL (e.g. "GET http://example.com/ HTTP/1.1").
+    # Returns None if we are stopping.
+    # Can throw a max-connections-reached exception.
+    if o0URL is not None:
+      txOrigin = ftxGetOrigin(o0URL.sbProtocol, o0URL.sbHost, o0URL.uPortNumber);
+    else:
+      oURLParts = urllib.parse.urlsplit(oRequest.sbURL);
+      assert oURLParts.scheme and oURLParts.hostname, \
+          "Cannot determine the server for request with URL %s; please provide o0URL" % repr(oRequest.sbURL);
+      txOrigin = ftxGetOrigin(oURLParts.scheme, oURLParts.hostname, oURLParts.port);
+    o0Pool = oSelf.__fo0GetPoolAndStartRequest(txOrigin);
+    if o0Pool is None:
+      return None;
+    oPool = o0Pool;
+    try:
+      return oPool.fo0SendRequestAndReceiveResponse(
+        oRequest,
+        n0zConnectTimeoutInSeconds = n0zConnectTimeoutInSeconds,
+        n0zSecureTimeoutInSeconds = n0zSecureTimeoutInSeconds,
+        n0zTransactionTimeoutInSeconds = n0zTransactionTimeoutInSeconds,
+        u0zMaxStartLineSize = u0zMaxStartLineSize,
+        u0zMaxHeaderLineSize = u0zMaxHeaderLineSize,
+        u0zMaxNumberOfHeaders = u0zMaxNumberOfHeaders,
+        u0zMaxBodySize = u0zMaxBodySize,
+        u0zMaxChunkSize = u0zMaxChunkSize,
+        u0zMaxNumberOfChunks = u0zMaxNumberOfChunks,
+        u0MaxNumberOfChunksBeforeDisconnecting = u0MaxNumberOfChunksBeforeDisconnecting,
+        x0BodySource = x0BodySource,
+        bDecodeBody = bDecodeBody,
+      );
+    finally:
+      oSelf.__fEndRequest(oPool);
+  
+  def __fo0GetPoolAndStartRequest(oSelf, txOrigin):
+    # Returns the pool for the origin once the request can use a connection, or
+    # None if we are stopping. The request is counted as active in the pool,
+    # so it is not evicted, until `__fEndRequest` is called.
+    # Can throw a max-connections-reached exception.
+    n0WaitStartTime = None;
+    while 1:
+      o0Pool = oSelf.__fo0GetPoolForOrigin(txOrigin);
+      if o0Pool is None:
+        return None;
+      oPool = o0Pool;
+      o0PoolWithIdleConnections = None;
+      o0WaitingForConnectionLock = None;
+      oSelf.__oPropertiesLock.fAcquire();
+      try:
+        if oSelf.__bStopping:
+          return None;
+        if oSelf.__doPool_by_txOrigin.get(txOrigin) is not oPool:
+          continue; # The pool was evicted after we got it; get a new one.
+        # If the pool has an idle connection, the request can use it without
+        # adding a connection. Otherwise, we need room for a new one.
+        if (
+          oPool.uIdleConnectionsCount > 0
+          or oSelf.__u0MaxNumberOfConnections is None
+          or oSelf.__fuGetUsedConnectionsCount() < oSelf.__u0MaxNumberOfConnections
+        ):
+          oSelf.__uActiveRequestsCount += 1;
+          oSelf.__duActiveRequestsCount_by_oPool[oPool] = oSelf.__duActiveRequestsCount_by_oPool.get(oPool, 0) + 1;
+          if n0WaitStartTime is not None:
+            oSelf.oMetrics.fRecordDuration("global checkout wait time", time.time() - n0WaitStartTime);
+          return oPool;
+        # Make room by closing an idle connection to another server, least
+        # recently used pool first.
+        for oOtherPool in oSelf.__doPool_by_txOrigin.values():
+          if oOtherPool.uIdleConnectionsCount > 0:
+            o0PoolWithIdleConnections = oOtherPool;
+            break;
+        else:
+          if not oSelf.__bWaitForFreeConnection:
+            oSelf.oMetrics.fAddToCounter("requests refused");
+            raise cMaximumNumberOfConnectionsToServerReachedException(
+              "Maximum number of connections to all servers reached.",
+              dxDetails = {
+                "bServerIsAProxy": False,
+                "uMaxNumberOfConnections": oSelf.__u0MaxNumberOfConnections,
+                "uActiveRequestsCount": oSelf.__uActiveRequestsCount,
+              },
+            );
+          o0WaitingForConnectionLock = cLock(
+            "%s.__oWaitingForConnectionLock" % oSelf.__class__.__name__,
+            bLocked = True,
+          );
+          oSelf.__aoWaitingForConnectionLocks.append(o0WaitingForConnectionLock);
+      finally:
+        oSelf.__oPropertiesLock.fRelease();
+      if o0PoolWithIdleConnections:
+        if o0PoolWithIdleConnections.fuCloseIdleConnections(1):
+          oSelf.oMetrics.fAddToCounter("idle connections closed to make room");
+        continue;
+      fShowDebugOutput("Waiting for a free connection...");
+      if n0WaitStartTime is None:
+        n0WaitStartTime = time.time();
+      o0WaitingForConnectionLock.fbWait(None);
+  
+  def __fuGetUsedConnectionsCount(oSelf):
+    # Must be called while holding the properties lock. Every active request
+    # uses one connection; idle connections in all pools are used as well.
+    return oSelf.__uActiveRequestsCount + sum(
+      oPool.uIdleConnectionsCount
+      for oPool in oSelf.__doPool_by_txOrigin.values()
+    );
+  
+  def __fEndRequest(oSelf, oPool):
+    o0WaitingForConnectionLock = None;
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      oSelf.__uActiveRequestsCount -= 1;
+      uActiveRequestsCount = oSelf.__duActiveRequestsCount_by_oPool[oPool] - 1;
+      if uActiveRequestsCount:
+        oSelf.__duActiveRequestsCount_by_oPool[oPool] = uActiveRequestsCount;
+      else:
+        del oSelf.__duActiveRequestsCount_by_oPool[oPool];
+      if oSelf.__aoWaitingForConnectionLocks:
+        o0WaitingForConnectionLock = oSelf.__aoWaitingForConnectionLocks.pop(0);
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+    # The waiting request can now close the idle connection this request left
+    # behind (if any) and use its slot.
+    if o0WaitingForConnectionLock:
+      o0WaitingForConnectionLock.fRelease();
+  
+  @ShowDebugOutput
+  def fStop(oSelf):
+    aoPools = oSelf.__faoStopAndGetAllPools();
+    for oPool in aoPools:
+      oPool.fStop();
+  
+  @ShowDebugOutput
+  def fTerminate(oSelf):
+    aoPools = oSelf.__faoStopAndGetAllPools();
+    for oPool in aoPools:
+      oPool.fTerminate();
+  
+  def __faoStopAndGetAllPools(oSelf):
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      oSelf.__bStopping = True;
+      aoWaitingForConnectionLocks = oSelf.__aoWaitingForConnectionLocks;
+      oSelf.__aoWaitingForConnectionLocks = [];
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+    # Nobody should wait for a connection anymore.
+    for oWaitingForConnectionLock in aoWaitingForConnectionLocks:
+      oWaitingForConnectionLock.fRelease();
+    return oSelf.__faoGetAllPools();
+  
+  @ShowDebugOutput
+  def fbWait(oSelf, n0TimeoutInSeconds):
+    # Returns True if all pools have terminated within the timeout.
+    n0EndTime = time.time() + n0TimeoutInSeconds if n0TimeoutInSeconds is not None else None;
+    for oPool in oSelf.__faoGetAllPools():
+      if not oPool.fbWait(max(0, n0EndTime - time.time()) if n0EndTime is not None else None):
+        return False;
+    return True;
+  
+  def fasGetDetails(oSelf):
+    return [s for s in [
+      "%d pools" % oSelf.uPoolsCount,
+      "%d connections" % oSelf.uConnectionsCount,
+      "%d active requests" % oSelf.__uActiveRequestsCount if oSelf.__uActiveRequestsCount else None,
+      "max. %d connections" % oSelf.__u0MaxNumberOfConnections if oSelf.__u0MaxNumberOfConnections is not None else None,
+      "stopping" if oSelf.__bStopping else None,
+    ] if s];
+  
+  def __repr__(oSelf):
+    sModuleName = ".".join(oSelf.__class__.__module__.split(".")[:-1]);
+    return "<%s.%s#%X|%s>" % (sModuleName, oSelf.__class__.__name__, id(oSelf), "|".join(oSelf.fasGetDetails()));
+  
+  def __str__(oSelf):
+    return "%s#%X{%s}" % (oSelf.__class__.__name__, id(oSelf), ", ".join(oSelf.fasGetDetails()));
@@ -0,0 +1,254 @@
+import zlib;
+
+try: # brotli is optional; "br" encoded bodies are only accepted if it is installed.
+  import brotli;
+except ModuleNotFoundError as oException:
+  if oException.args[0] != "No module named 'brotli'":
+    raise;
+  brotli = None;
+else:
+  # Older versions of brotli cannot limit the size of the output produced from
+  # the input they are given, so a small body could decode to an arbitrarily
+  # large one before we can check its size. We only use versions that can.
+  try:
+    brotli.Decompressor().process(b"", output_buffer_limit = 1);
+  except TypeError:
+    brotli = None;
+
+from mHTTPProtocol import cInvalidMessageException;
+
+from .mOptionalDebugOutput import (
+  fShowDebugOutput,
+  ShowDebugOutput,
+);
+
+gasbSupportedLowerEncodings = [b"gzip", b"x-gzip", b"deflate"] + ([b"br"] if brotli else []);
+# Value of the "Accept-Encoding" header we send if we can decode the body.
+gsbAcceptEncodingHeaderValue = b", ".join(sbEncoding for sbEncoding in gasbSupportedLowerEncodings if sbEncoding != b"x-gzip");
+
+class cContentDecoder(object):
+  # Removes the "Content-Encoding" from a body incrementally, while it is being
+  # read, so the encoded body never needs to be in memory completely. If the
+  # decoded body is larger than u0MaxDecodedSize, an invalid message exception
+  # is thrown as soon as this is detected, so a small compressed body cannot
+  # be used to exhaust memory.
+  # Create an instance using `fo0CreateForHeaders`, call `fsbDecode` for each
+  # part of the body and `fsbFinish` once the entire body has been decoded.
+  @classmethod
+  def fo0CreateForHeaders(cClass,
+    o0Headers,
+    *,
+    u0MaxDecodedSize,
+    o0Connection = None,
+  ):
+    # Returns None if the body does not need to be decoded, or if it uses an
+    # encoding we do not support, in which case it is left as-is.
+    if o0Headers is None:
+      return None;
+    asbLowerEncodings = [];
+    for sbHeaderLine in o0Headers.fasbSerializeLines():
+      (sbName, sbValue) = (sbHeaderLine.split(b":", 1) + [b""])[:2];
+      if sbName.strip().lower() == b"content-encoding":
+        asbLowerEncodings += [
+          sbEncoding.strip().lower()
+          for sbEncoding in sbValue.split(b",")
+          if sbEncoding.strip().lower() not in [b"", b"identity"]
+        ];
+    if not asbLowerEncodings:
+      return None;
+    for sbLowerEncoding in asbLowerEncodings:
+      if sbLowerEncoding not in gasbSupportedLowerEncodings:
+        fShowDebugOutput("Content encoding %s is not supported; body will not be decoded." % repr(sbLowerEncoding));
+        return None;
+    return cClass(asbLowerEncodings, u0MaxDecodedSize, o0Connection);
+  
+  def __init__(oSelf, asbLowerEncodings, u0MaxDecodedSize, o0Connection = None):
+    # Encodings are listed in the order in which they were applied, so they
+    # must be removed in reverse order.
+    oSelf.asbLowerEncodings = asbLowerEncodings;
+    oSelf.__asbLowerEncodingsToRemove = asbLowerEncodings[::-1];
+    oSelf.__u0MaxDecodedSize = u0MaxDecodedSize;
+    oSelf.__o0Connection = o0Connection;
+    # Decompressors are created once the first data is decoded, as we need to
+    # look at it to find out what kind of "deflate" data we are dealing with.
+    oSelf.__ao0Decompressors = [None] * len(asbLowerEncodings);
+    # We keep track of the output size of each step, so we can stop before
+    # any of them produces more data than allowed.
+    oSelf.__auDecodedSizes = [0] * len(asbLowerEncodings);
+    # Input that each step has not decoded yet, and whether it may have output
+    # that it has not returned yet, because the size of its output is limited.
+    oSelf.__asbPendingInputData = [b""] * len(asbLowerEncodings);
+    oSelf.__abStepMayHavePendingOutput = [False] * len(asbLowerEncodings);
+    oSelf.uEncodedSize = 0;
+  
+  @property
+  def uDecodedSize(oSelf):
+    return oSelf.__auDecodedSizes[-1];
+  
+  @ShowDebugOutput
+  def fsbDecode(oSelf, sbData, u0MaxOutputSize = None):
+    # Returns the decoded data for the next part of the body, which may be
+    # empty if the decoder needs more data. If u0MaxOutputSize is provided, at
+    # most that many bytes are returned and the decoder holds on to the input
+    # it has not decoded yet: call this method again without data until it
+    # returns an empty string before providing more data. This keeps memory
+    # use bounded even if a small part of the body decodes to a lot of data.
+    # The brotli decoder can return somewhat more than u0MaxOutputSize bytes.
+    # Can throw an invalid message exception.
+    oSelf.uEncodedSize += len(sbData);
+    oSelf.__asbPendingInputData[0] += sbData;
+    uLastIndex = len(oSelf.__asbLowerEncodingsToRemove) - 1;
+    if u0MaxOutputSize is not None:
+      return oSelf.__fsbDecodeStep(uLastIndex, u0MaxOutputSize);
+    asbDecodedData = [];
+    while 1:
+      sbDecodedData = oSelf.__fsbDecodeStep(uLastIndex, None);
+      if not sbDecodedData:
+        return b"".join(asbDecodedData);
+      asbDecodedData.append(sbDecodedData);
+  
+  @ShowDebugOutput
+  def fsbFinish(oSelf):
+    # Returns any decoded data that the decoders were still holding on to and
+    # checks that the encoded body was complete.
+    # Can throw an invalid message exception.
+    sbData = b"";
+    for uIndex in range(len(oSelf.__asbLowerEncodingsToRemove)):
+      oSelf.__asbPendingInputData[uIndex] += sbData;
+      asbDecodedData = [];
+      while oSelf.__fbStepHasPendingData(uIndex):
+        asbDecodedData.append(oSelf.__fsbDecodeStepPendingData(uIndex, None));
+      o0Decompressor = oSelf.__ao0Decompressors[uIndex];
+      if o0Decompressor is None:
+        # Nothing was decoded in this step; an empty body is a valid encoding
+        # of an empty body.
+        sbData = b"".join(asbDecodedData);
+        continue;
+      if oSelf.__asbLowerEncodingsToRemove[uIndex] == b"br":
+        bComplete = o0Decompressor.is_finished();
+      else:
+        sbFlushedData = o0Decompressor.flush();
+        oSelf.__fAddDecodedSize(uIndex, len(sbFlushedData));
+        asbDecodedData.append(sbFlushedData);
+        bComplete = o0Decompressor.eof;
+      if not bComplete:
+        raise cInvalidMessageException(
+          "The encoded body was truncated.",
+          o0Connection = oSelf.__o0Connection,
+          dxDetails = {"sbContentEncoding": oSelf.__asbLowerEncodingsToRemove[uIndex], "uEncodedSize": oSelf.uEncodedSize},
+        );
+      sbData = b"".join(asbDecodedData);
+    return sbData;
+  
+  def __fsbDecodeStep(oSelf, uIndex, u0MaxOutputSize):
+    # Returns the next output of a step, decoding the input it is holding on
+    # to or, if there is none, the next output of the previous step. Returns an
+    # empty string if the step needs more input than is available.
+    while 1:
+      while oSelf.__fbStepHasPendingData(uIndex):
+        sbDecodedData = oSelf.__fsbDecodeStepPendingData(uIndex, u0MaxOutputSize);
+        if sbDecodedData:
+          return sbDecodedData;
+      if uIndex == 0:
+        return b"";
+      sbInputData = oSelf.__fsbDecodeStep(uIndex - 1, u0MaxOutputSize);
+      if not sbInputData:
+        return b"";
+      oSelf.__asbPendingInputData[uIndex] = sbInputData;
+  
+  def __fbStepHasPendingData(oSelf, uIndex):
+    return len(oSelf.__asbPendingInputData[uIndex]) > 0 or oSelf.__abStepMayHavePendingOutput[uIndex];
+  
+  def __fsbDecodeStepPendingData(oSelf, uIndex, u0MaxOutputSize):
+    sbData = oSelf.__asbPendingInputData[uIndex];
+    oSelf.__asbPendingInputData[uIndex] = b"";
+    oSelf.__abStepMayHavePendingOutput[uIndex] = False;
+    sbLowerEncoding = oSelf.__asbLowerEncodingsToRemove[uIndex];
+    o0Decompressor = oSelf.__ao0Decompressors[uIndex];
+    if o0Decompressor is None:
+      if not sbData:
+        return b"";
+      o0Decompressor = oSelf.__ao0Decompressors[uIndex] = oSelf.__foCreateDecompressor(sbLowerEncoding, sbData);
+    oDecompressor = o0Decompressor;
+    # Ask for one byte more than allowed, so we can detect output that is too
+    # large without ever producing more than that.
+    u0MaxLength = u0MaxOutputSize;
+    if oSelf.__u0MaxDecodedSize is not None:
+      uMaxLengthForBodySize = oSelf.__u0MaxDecodedSize - oSelf.__auDecodedSizes[uIndex] + 1;
+      u0MaxLength = uMaxLengthForBodySize if u0MaxLength is None else min(u0MaxLength, uMaxLengthForBodySize);
+    try:
+      if sbLowerEncoding == b"br":
+        if u0MaxLength is None:
+          sbDecodedData = oDecompressor.process(sbData);
+        else:
+          sbDecodedData = oDecompressor.process(sbData, output_buffer_limit = u0MaxLength);
+        # Input that was not decoded is kept by the decompressor; we must ask
+        # for its output before we can provide more input. If the output was
+        # limited, it may also still hold output after it can accept more input.
+        # Note that the limit only stops the output from growing further, so
+        # the output can be somewhat larger than the limit.
+        oSelf.__abStepMayHavePendingOutput[uIndex] = (
+          not oDecompressor.can_accept_more_data()
+          or (u0MaxLength is not None and len(sbDecodedData) >= u0MaxLength)
+        );
+      else:
+        if oDecompressor.eof and sbData:
+          # A gzip body can consist of multiple "members", each of which is
+          # a complete gzip stream. Any other data after the end is invalid.
+          if sbLowerEncoding == b"deflate":
+            raise cInvalidMessageException(
+              "The encoded body contained data after the end.",
+              o0Connection = oSelf.__o0Connection,
+              dxDetails = {"sbContentEncoding": sbLowerEncoding, "uEncodedSize": oSelf.uEncodedSize},
+            );
+          oDecompressor = oSelf.__ao0Decompressors[uIndex] = oSelf.__foCreateDecompressor(sbLowerEncoding, sbData);
+        sbDecodedData = oDecompressor.decompress(sbData, u0MaxLength or 0);
+        oSelf.__asbPendingInputData[uIndex] = oDecompressor.unconsumed_tail or oDecompressor.unused_data;
+        # If the output was limited, the decompressor may still hold output
+        # for input it has already consumed.
+        oSelf.__abStepMayHavePendingOutput[uIndex] = u0MaxLength is not None and len(sbDecodedData) == u0MaxLength;
+    except (zlib.error, getattr(brotli, "error", zlib.error)) as oException:
+      raise cInvalidMessageException(
+        "The encoded body could not be decoded.",
+        o0Connection = oSelf.__o0Connection,
+        dxDetails = {"sbContentEncoding": sbLowerEncoding, "uEncodedSize": oSelf.uEncodedSize, "sError": str(oException)},
+      );
+    oSelf.__fAddDecodedSize(uIndex, len(sbDecodedData));
+    return sbDecodedData;
+  
+  @staticmethod
+  def __foCreateDecompressor(sbLowerEncoding, sbFirstData):
+    if sbLowerEncoding == b"br":
+      return brotli.Decompressor();
+    if sbLowerEncoding == b"deflate":
+      # "deflate" should be a zlib stream, but some servers send raw deflate
+      # data instead. A zlib stream starts with a two byte header that uses the
+      # deflate method (8) and is a multiple of 31.
+      bIsZlibStream = len(sbFirstData) < 2 or (
+        sbFirstData[0] & 0x0F == 8 and ((sbFirstData[0] << 8) | sbFirstData[1]) % 31 == 0
+      );
+      return zlib.decompressobj(zlib.MAX_WBITS if bIsZlibStream else -zlib.MAX_WBITS);
+    return zlib.decompressobj(16 + zlib.MAX_WBITS); # gzip
+  
+  def __fAddDecodedSize(oSelf, uIndex, uSize):
+    oSelf.__auDecodedSizes[uIndex] += uSize;
+    if oSelf.__u0MaxDecodedSize is not None and oSelf.__auDecodedSizes[uIndex] > oSelf.__u0MaxDecodedSize:
+      raise cInvalidMessageException(
+        "The decoded body was larger than the maximum accepted.",
+        o0Connection = oSelf.__o0Connection,
+        dxDetails = {"uMaxBodySize": oSelf.__u0MaxDecodedSize, "uMinimumBodySize": oSelf.__auDecodedSizes[uIndex]},
+      );
+  
+  def fasGetDetails(oSelf):
+    return [s for s in [
+      "encoding: %s" % ", ".join(str(sbEncoding, "ascii", "replace") for sbEncoding in oSelf.asbLowerEncodings),
+      "%d -> %d bytes" % (oSelf.uEncodedSize, oSelf.uDecodedSize),
+      "max: %d bytes" % oSelf.__u0MaxDecodedSize if oSelf.__u0MaxDecodedSize is not None else None,
+    ] if s];
+  
+  def __repr__(oSelf):
+    sModuleName = ".".join(oSelf.__class__.__module__.split(".")[:-1]);
+    return "<%s.%s#%X|%s>" % (sModuleName, oSelf.__class__.__name__, id(oSelf), "|".join(oSelf.fasGetDetails()));
+  
+  def __str__(oSelf):
+    return "%s#%X{%s}" % (oSelf.__class__.__name__, id(oSelf), ", ".join(oSelf.fasGetDetails()));
@@ -0,0 +1,126 @@
+import zlib;
+
+from .mOptionalDebugOutput import (
+  fShowDebugOutput,
+  ShowDebugOutput,
+);
+
+# The encodings we can apply, in order of preference when a client accepts more
+# than one of them equally.
+gasbSupportedLowerEncodings = [b"gzip", b"deflate"];
+guDefaultCompressionLevel = 6; # zlib's default: a good trade-off between CPU and bandwidth.
+# Bodies of these media types are usually compressed already, so compressing
+# them again costs CPU for little or no gain. The exceptions are compressible.
+gasbLowerMediaTypePrefixesThatAreNotCompressed = [
+  b"image/", b"audio/", b"video/", b"font/woff",
+  b"application/gzip", b"application/x-gzip", b"application/zip", b"application/x-bzip2",
+  b"application/x-xz", b"application/x-7z-compressed", b"application/x-rar-compressed",
+  b"application/zstd", b"application/pdf", b"application/octet-stream",
+];
+gasbLowerMediaTypesThatAreCompressedAnyway = [b"image/svg+xml", b"image/bmp", b"image/x-icon"];
+
+def fasbGetLowerHeaderValues(oHeaders, sbLowerName):
+  # Returns the comma separated values of all headers with the given name.
+  asbLowerValues = [];
+  for sbHeaderLine in oHeaders.fasbSerializeLines():
+    (sbName, sbValue) = (sbHeaderLine.split(b":", 1) + [b""])[:2];
+    if sbName.strip().lower() == sbLowerName:
+      asbLowerValues += [sbPart.strip().lower() for sbPart in sbValue.split(b",") if sbPart.strip()];
+  return asbLowerValues;
+
+class cContentEncoder(object):
+  # Compresses a body incrementally while it is being sent, so the compressed
+  # body never needs to be in memory completely.
+  # Use `fsb0GetEncodingAcceptedByRequest` to find out which encoding to use,
+  # then create an instance and call `fsbEncode` for each part of the body and
+  # `fsbFinish` once the entire body has been encoded, or use `fiterEncode`.
+  @staticmethod
+  def fsb0GetEncodingAcceptedByRequest(oRequest):
+    # Returns the supported encoding with the highest "q" value in the
+    # request's "Accept-Encoding" header, or None if there is none.
+    # A request without an "Accept-Encoding" header gets no encoding, as
+    # some clients cannot handle them.
+    dnQuality_by_sbLowerEncoding = {};
+    for sbLowerValue in fasbGetLowerHeaderValues(oRequest.oHeaders, b"accept-encoding"):
+      asbParts = [sbPart.strip() for sbPart in sbLowerValue.split(b";")];
+      nQuality = 1;
+      for sbParameter in asbParts[1:]:
+        if sbParameter.startswith(b"q="):
+          try:
+            nQuality = float(sbParameter[2:]);
+          except ValueError:
+            nQuality = 0; # Invalid; ignore this encoding.
+      dnQuality_by_sbLowerEncoding[b"gzip" if asbParts[0] == b"x-gzip" else asbParts[0]] = nQuality;
+    sb0BestEncoding = None;
+    nBestQuality = 0;
+    for sbLowerEncoding in gasbSupportedLowerEncodings:
+      nQuality = dnQuality_by_sbLowerEncoding.get(sbLowerEncoding, dnQuality_by_sbLowerEncoding.get(b"*", 0));
+      if nQuality > nBestQuality:
+        (sb0BestEncoding, nBestQuality) = (sbLowerEncoding, nQuality);
+    return sb0BestEncoding;
+  
+  @staticmethod
+  def fbIsCompressibleMediaType(sb0ContentType):
+    if sb0ContentType is None:
+      return True;
+    sbLowerMediaType = sb0ContentType.split(b";", 1)[0].strip().lower();
+    if sbLowerMediaType in gasbLowerMediaTypesThatAreCompressedAnyway:
+      return True;
+    return not any(
+      sbLowerMediaType.startswith(sbLowerMediaTypePrefix)
+      for sbLowerMediaTypePrefix in gasbLowerMediaTypePrefixesThatAreNotCompressed
+    );
+  
+  def __init__(oSelf, sbLowerEncoding, uCompressionLevel = guDefaultCompressionLevel):
+    assert sbLowerEncoding in gasbSupportedLowerEncodings, \
+        "Unsupported encoding %s" % repr(sbLowerEncoding);
+    assert 0 <= uCompressionLevel <= 9, \
+        "uCompressionLevel must be between 0 and 9, not %d" % uCompressionLevel;
+    oSelf.sbLowerEncoding = sbLowerEncoding;
+    oSelf.uCompressionLevel = uCompressionLevel;
+    oSelf.__oCompressor = zlib.compressobj(
+      uCompressionLevel,
+      zlib.DEFLATED,
+      16 + zlib.MAX_WBITS if sbLowerEncoding == b"gzip" else zlib.MAX_WBITS,
+    );
+    oSelf.uDecodedSize = 0;
+    oSelf.uEncodedSize = 0;
+  
+  def fsbEncode(oSelf, sbData):
+    # Returns the encoded data for the next part of the body, which may be
+    # empty if the compressor is waiting for more data.
+    oSelf.uDecodedSize += len(sbData);
+    sbEncodedData = oSelf.__oCompressor.compress(sbData);
+    oSelf.uEncodedSize += len(sbEncodedData);
+    return sbEncodedData;
+  
+  def fsbFinish(oSelf):
+    sbEncodedData = oSelf.__oCompressor.flush();
+    oSelf.uEncodedSize += len(sbEncodedData);
+    return sbEncodedData;
+  
+  @ShowDebugOutput
+  def fiterEncode(oSelf, iterBodyChunks):
+    # Yields the encoded body for the body chunks, skipping empty parts.
+    for sbBodyChunk in iterBodyChunks:
+      sbEncodedData = oSelf.fsbEncode(sbBodyChunk);
+      if sbEncodedData:
+        yield sbEncodedData;
+    sbEncodedData = oSelf.fsbFinish();
+    if sbEncodedData:
+      yield sbEncodedData;
+    fShowDebugOutput(oSelf, "Encoded %d bytes body as %d bytes." % (oSelf.uDecodedSize, oSelf.uEncodedSize));
+  
+  def fasGetDetails(oSelf):
+    return [s for s in [
+      "encoding: %s" % str(oSelf.sbLowerEncoding, "ascii", "strict"),
+      "level: %d" % oSelf.uCompressionLevel,
+      "%d -> %d bytes" % (oSelf.uDecodedSize, oSelf.uEncodedSize),
+    ] if s];
+  
+  def __repr__(oSelf):
+    sModuleName = ".".join(oSelf.__class__.__module__.split(".")[:-1]);
+    return "<%s.%s#%X|%s>" % (sModuleName, oSelf.__class__.__name__, id(oSelf), "|".join(oSelf.fasGetDetails()));
+  
+  def __str__(oSelf):
+    return "%s#%X{%s}" % (oSelf.__class__.__name__, id(oSelf), ", ".join(oSelf.fasGetDetails()));
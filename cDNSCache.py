@@ -0,0 +1,222 @@
+import ipaddress, socket, time;
+
+from mMultiThreading import cLock;
+from mNotProvided import (
+  fxGetFirstProvidedValue,
+  zNotProvided,
+);
+
+from .cMetrics import cMetrics;
+from .mExceptions import cDNSUnknownHostnameException;
+from .mOptionalDebugOutput import (
+  fShowDebugOutput,
+  ShowDebugOutput,
+);
+
+gnDeadlockTimeoutInSeconds = 1; # We're not doing anything time consuming, so this should suffice.
+# getaddrinfo does not tell us the TTL of the DNS records, so we use our own:
+gnDefaultTTLInSeconds = 60;
+gnDefaultNegativeTTLInSeconds = 5;
+guDefaultMaxNumberOfEntries = 1000;
+
+class cDNSCache(object):
+  # Thread-safe cache of the IP addresses that hostnames resolve to.
+  # Failed lookups are cached as well, for a shorter time. If a hostname is
+  # looked up by multiple threads at the same time, only one of them does the
+  # lookup and the others wait for and use its result.
+  # One instance is shared by all connections pools in a process by default
+  # (see `foGetDefault`).
+  o0Default = None;
+  __oDefaultLock = cLock(
+    "cDNSCache.__oDefaultLock",
+    n0DeadlockTimeoutInSeconds = gnDeadlockTimeoutInSeconds
+  );
+  
+  @classmethod
+  def foGetDefault(cClass):
+    # If two threads call this at the same time before the default instance
+    # exists, they could each create one and pools would end up using
+    # different caches. The lock makes sure only one instance is ever created.
+    o0Default = cClass.o0Default;
+    if o0Default is not None:
+      return o0Default;
+    cDNSCache.__oDefaultLock.fAcquire();
+    try:
+      if cClass.o0Default is None:
+        cClass.o0Default = cClass();
+      return cClass.o0Default;
+    finally:
+      cDNSCache.__oDefaultLock.fRelease();
+  
+  def __init__(oSelf,
+    *,
+    nzTTLInSeconds = zNotProvided,
+    nzNegativeTTLInSeconds = zNotProvided,
+    uzMaxNumberOfEntries = zNotProvided,
+  ):
+    oSelf.__nTTLInSeconds = fxGetFirstProvidedValue(nzTTLInSeconds, gnDefaultTTLInSeconds);
+    oSelf.__nNegativeTTLInSeconds = fxGetFirstProvidedValue(nzNegativeTTLInSeconds, gnDefaultNegativeTTLInSeconds);
+    oSelf.__uMaxNumberOfEntries = fxGetFirstProvidedValue(uzMaxNumberOfEntries, guDefaultMaxNumberOfEntries);
+    oSelf.__oPropertiesLock = cLock(
+      "%s.__oPropertiesLock" % oSelf.__class__.__name__,
+      n0DeadlockTimeoutInSeconds = gnDeadlockTimeoutInSeconds
+    );
+    # Each entry is a tuple with the time it expires, the IP addresses (or
+    # None if the lookup failed), the canonical name and the exception (or
+    # None if the lookup succeeded). Entries are kept in the order in which
+    # they were added, so the oldest can be removed when there are too many.
+    oSelf.__dtxEntry_by_sbLowerHostname = {};
+    # A locked lock for each hostname that is being looked up; it is unlocked
+    # when the lookup completes.
+    oSelf.__doLookupLock_by_sbLowerHostname = {};
+    oSelf.oMetrics = cMetrics();
+  
+  @property
+  def uEntriesCount(oSelf):
+    return len(oSelf.__dtxEntry_by_sbLowerHostname);
+  
+  @ShowDebugOutput
+  def fasbGetIPAddresses(oSelf,
+    sbHostname,
+    *,
+    f0ResolvingHostnameCallback = None,
+    f0ResolvingHostnameFailedCallback = None,
+    f0HostnameResolvedToIPAddressCallback = None,
+  ):
+    # Returns the IP addresses the hostname resolves to, from the cache if
+    # possible. The callbacks are only called if the hostname is looked up by
+    # this thread; they are called with the same arguments as those of
+    # cConnection.foConnectTo.
+    # Can throw a DNS unknown hostname exception.
+    try:
+      ipaddress.ip_address(str(sbHostname, "ascii", "strict"));
+    except (UnicodeDecodeError, ValueError):
+      pass; # Not an IP address.
+    else:
+      return [sbHostname]; # IP addresses do not need to be resolved.
+    sbLowerHostname = sbHostname.lower();
+    while 1:
+      oSelf.__oPropertiesLock.fAcquire();
+      try:
+        tx0Entry = oSelf.__dtxEntry_by_sbLowerHostname.get(sbLowerHostname);
+        if tx0Entry is not None and tx0Entry[0] <= time.time():
+          del oSelf.__dtxEntry_by_sbLowerHostname[sbLowerHostname];
+          tx0Entry = None;
+        o0LookupLock = None;
+        bLookUp = False;
+        if tx0Entry is None:
+          o0LookupLock = oSelf.__doLookupLock_by_sbLowerHostname.get(sbLowerHostname);
+          if o0LookupLock is None:
+            o0LookupLock = oSelf.__doLookupLock_by_sbLowerHostname[sbLowerHostname] = cLock(
+              "%s.__oLookupLock" % oSelf.__class__.__name__,
+              bLocked = True,
+            );
+            bLookUp = True;
+      finally:
+        oSelf.__oPropertiesLock.fRelease();
+      if tx0Entry is not None:
+        (nExpiryTime, a0sbIPAddresses, sCanonicalName, o0Exception) = tx0Entry;
+        if o0Exception is not None:
+          oSelf.oMetrics.fAddToCounter("DNS cache negative hits");
+          # Raising the same exception again would add to its traceback every
+          # time, so we raise a new one.
+          raise o0Exception.__class__(o0Exception.sMessage, dxDetails = o0Exception.dxDetails);
+        oSelf.oMetrics.fAddToCounter("DNS cache hits");
+        return a0sbIPAddresses[:];
+      if bLookUp:
+        oSelf.oMetrics.fAddToCounter("DNS cache misses");
+        try:
+          return oSelf.__fasbLookUp(
+            sbHostname,
+            sbLowerHostname,
+            f0ResolvingHostnameCallback,
+            f0ResolvingHostnameFailedCallback,
+            f0HostnameResolvedToIPAddressCallback,
+          );
+        finally:
+          oSelf.__oPropertiesLock.fAcquire();
+          try:
+            del oSelf.__doLookupLock_by_sbLowerHostname[sbLowerHostname];
+          finally:
+            oSelf.__oPropertiesLock.fRelease();
+          o0LookupLock.fRelease();
+      # Another thread is looking up this hostname; wait for it to finish and
+      # use the cached result. If the lookup did not produce a result that
+      # could be cached, we will look it up ourselves.
+      fShowDebugOutput(oSelf, "Waiting for another thread to look up %s..." % repr(sbHostname));
+      oSelf.oMetrics.fAddToCounter("DNS cache shared lookups");
+      o0LookupLock.fbWait(None);
+  
+  def __fasbLookUp(oSelf,
+    sbHostname,
+    sbLowerHostname,
+    f0ResolvingHostnameCallback,
+    f0ResolvingHostnameFailedCallback,
+    f0HostnameResolvedToIPAddressCallback,
+  ):
+    if f0ResolvingHostnameCallback:
+      f0ResolvingHostnameCallback(sbHostname);
+    try:
+      atxAddressInfo = socket.getaddrinfo(
+        str(sbHostname, "ascii", "strict"),
+        None,
+        type = socket.SOCK_STREAM,
+        flags = socket.AI_CANONNAME,
+      );
+    except (socket.gaierror, UnicodeDecodeError) as oGetAddressInfoException:
+      oException = cDNSUnknownHostnameException(
+        "The hostname could not be resolved to an IP address.",
+        dxDetails = {"sbHostname": sbHostname, "sError": str(oGetAddressInfoException)},
+      );
+      oSelf.__fAddEntry(sbLowerHostname, oSelf.__nNegativeTTLInSeconds, None, None, oException);
+      if f0ResolvingHostnameFailedCallback:
+        f0ResolvingHostnameFailedCallback(sbHostname, oException);
+      raise oException;
+    asbIPAddresses = [];
+    sCanonicalName = atxAddressInfo[0][3] or str(sbHostname, "ascii", "strict");
+    for (iFamily, iType, iProtocol, sIgnoredCanonicalName, txSocketAddress) in atxAddressInfo:
+      sbIPAddress = bytes(txSocketAddress[0], "ascii", "strict");
+      if sbIPAddress not in asbIPAddresses:
+        asbIPAddresses.append(sbIPAddress);
+    oSelf.__fAddEntry(sbLowerHostname, oSelf.__nTTLInSeconds, asbIPAddresses, sCanonicalName, None);
+    if f0HostnameResolvedToIPAddressCallback:
+      for sbIPAddress in asbIPAddresses:
+        f0HostnameResolvedToIPAddressCallback(sbHostname, sbIPAddress, sCanonicalName);
+    return asbIPAddresses;
+  
+  def __fAddEntry(oSelf, sbLowerHostname, nTTLInSeconds, a0sbIPAddresses, s0CanonicalName, o0Exception):
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      oSelf.__dtxEntry_by_sbLowerHostname.pop(sbLowerHostname, None);
+      while len(oSelf.__dtxEntry_by_sbLowerHostname) >= oSelf.__uMaxNumberOfEntries:
+        # Remove the oldest entry.
+        del oSelf.__dtxEntry_by_sbLowerHostname[next(iter(oSelf.__dtxEntry_by_sbLowerHostname))];
+      oSelf.__dtxEntry_by_sbLowerHostname[sbLowerHostname] = (
+        time.time() + nTTLInSeconds,
+        a0sbIPAddresses,
+        s0CanonicalName,
+        o0Exception,
+      );
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+  
+  def fClear(oSelf):
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      oSelf.__dtxEntry_by_sbLowerHostname.clear();
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+  
+  def fasGetDetails(oSelf):
+    return [s for s in [
+      "%d entries" % oSelf.uEntriesCount,
+      "TTL: %ss" % oSelf.__nTTLInSeconds,
+      "negative TTL: %ss" % oSelf.__nNegativeTTLInSeconds,
+    ] if s];
+  
+  def __repr__(oSelf):
+    sModuleName = ".".join(oSelf.__class__.__module__.split(".")[:-1]);
+    return "<%s.%s#%X|%s>" % (sModuleName, oSelf.__class__.__name__, id(oSelf), "|".join(oSelf.fasGetDetails()));
+  
+  def __str__(oSelf):
+    return "%s#%X{%s}" % (oSelf.__class__.__name__, id(oSelf), ", ".join(oSelf.fasGetDetails()));
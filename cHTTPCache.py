@@ -0,0 +1,665 @@
+import email.utils, hashlib, json, os, time;
+
+from mHTTPProtocol import (
+  cHeaders,
+  cResponse,
+);
+from mMultiThreading import cLock;
+from mNotProvided import (
+  fxGetFirstProvidedValue,
+  zNotProvided,
+);
+
+from .cContentEncoder import fasbGetLowerHeaderValues;
+from .cMetrics import cMetrics;
+from .mOptionalDebugOutput import (
+  fShowDebugOutput,
+  gbShowDebugOutput,
+  ShowDebugOutput,
+);
+
+gnDeadlockTimeoutInSeconds = 1; # We're not doing anything time consuming, so this should suffice.
+guDefaultMaxSizeInBytes = 64*1000*1000;
+guDefaultMaxDiskSizeInBytes = 1000*1000*1000;
+# Responses with these status codes can be stored (RFC 9110 section 15.1 calls
+# them "heuristically cacheable"); we do not store partial (206) responses.
+gauStorableStatusCodes = [200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501];
+# If a response has no explicit expiration time, it is considered fresh for
+# this fraction of the time since it was last modified (RFC 9111 section
+# 4.2.2), but never for longer than the maximum.
+gnHeuristicFreshnessLifetimeFraction = 0.1;
+gnMaxHeuristicFreshnessLifetimeInSeconds = 24 * 60 * 60;
+# Requests using these methods do not change anything on the server; a
+# successful response to a request using any other method invalidates the
+# cached response for its URL (RFC 9111 section 4.4).
+gasbSafeMethods = [b"GET", b"HEAD", b"OPTIONS", b"TRACE"];
+# These headers in a "304 Not Modified" response do not replace those of the
+# stored response, as they describe the (empty) body of the 304 response.
+gasbLowerHeaderNamesNotUpdatedByNotModifiedResponse = [b"content-length", b"content-encoding", b"transfer-encoding"];
+# If the response to a request for a URL could not be stored, requests for that
+# URL are not collapsed for this long, so they can be sent in parallel.
+gnUncacheableURLTimeoutInSeconds = 10;
+
+def fdsb0GetLowerCacheControlDirectives(oHeaders):
+  # Returns a dict with the value of each directive in the "Cache-Control"
+  # headers (None for directives without a value, e.g. "no-store").
+  dsb0Value_by_sbLowerDirective = {};
+  for sbLowerDirective in fasbGetLowerHeaderValues(oHeaders, b"cache-control"):
+    (sbName, sb0Value) = (sbLowerDirective.split(b"=", 1) + [None])[:2];
+    dsb0Value_by_sbLowerDirective[sbName.strip()] = sb0Value.strip().strip(b'"') if sb0Value is not None else None;
+  return dsb0Value_by_sbLowerDirective;
+
+def fn0GetDeltaSeconds(sb0Value):
+  try:
+    return max(0, int(sb0Value));
+  except (TypeError, ValueError):
+    return None;
+
+def fsb0GetHeaderValue(oHeaders, sbLowerName):
+  # Returns the value of the last header with the given name, unmodified.
+  sb0Value = None;
+  for sbHeaderLine in oHeaders.fasbSerializeLines():
+    (sbName, sbValue) = (sbHeaderLine.split(b":", 1) + [b""])[:2];
+    if sbName.strip().lower() == sbLowerName:
+      sb0Value = sbValue.strip();
+  return sb0Value;
+
+def fn0GetHeaderDateTime(oHeaders, sbLowerName):
+  sb0Value = fsb0GetHeaderValue(oHeaders, sbLowerName);
+  if sb0Value is None:
+    return None;
+  try:
+    return email.utils.parsedate_to_datetime(str(sb0Value, "latin1")).timestamp();
+  except (TypeError, ValueError, IndexError):
+    return None;
+
+def fuGetStatusCode(oResponse):
+  # The start line is "HTTP/x.y <status code> <reason phrase>".
+  return int(oResponse.fsbSerializeStartLine().split(b" ", 2)[1]);
+
+def foCopyMessage(oMessage, a0sbHeaderLines = None):
+  # Returns a copy of the message, optionally with other headers.
+  oCopy = oMessage.__class__(
+    o0zHeaders = cHeaders.foDeserializeLines(
+      a0sbHeaderLines if a0sbHeaderLines is not None else oMessage.oHeaders.fasbSerializeLines()
+    ),
+    **oMessage.fdxDeserializeStartLine(oMessage.fsbSerializeStartLine()),
+  );
+  oCopy.fSetBody(oMessage.sbBody);
+  return oCopy;
+
+class cHTTPCache(object):
+  # Thread-safe cache of responses to GET requests that follows the rules for a
+  # shared cache in RFC 9111: responses are stored if their "Cache-Control"
+  # headers allow it, reused while they are fresh according to "Cache-Control",
+  # "Expires" or their "Last-Modified" header, and revalidated using a
+  # conditional request ("If-None-Match"/"If-Modified-Since") once they are
+  # stale. Responses are kept in memory in least-recently-used order, up to a
+  # maximum total size. If a folder is provided, responses are also stored on
+  # disk, where they are found once they have been removed from memory or
+  # after the process restarts.
+  # If multiple threads request the same URL at the same time and there is no
+  # fresh response for it, only one request is sent to the server; the other
+  # threads wait for it and use its response if it can be stored. If it cannot,
+  # they all send their own request in parallel, and requests for that URL are
+  # not collapsed for a short time.
+  # See `cConnectionsToServerPool`'s o0HTTPCache argument.
+  def __init__(oSelf,
+    *,
+    uzMaxSizeInBytes = zNotProvided,
+    s0DiskCacheFolderPath = None,
+    uzMaxDiskSizeInBytes = zNotProvided,
+  ):
+    oSelf.__uMaxSizeInBytes = fxGetFirstProvidedValue(uzMaxSizeInBytes, guDefaultMaxSizeInBytes);
+    oSelf.__s0DiskCacheFolderPath = s0DiskCacheFolderPath;
+    oSelf.__uMaxDiskSizeInBytes = fxGetFirstProvidedValue(uzMaxDiskSizeInBytes, guDefaultMaxDiskSizeInBytes);
+    oSelf.__oPropertiesLock = cLock(
+      "%s.__oPropertiesLock" % oSelf.__class__.__name__,
+      n0DeadlockTimeoutInSeconds = gnDeadlockTimeoutInSeconds
+    );
+    # Entries are kept in the order in which they were last used, so the least
+    # recently used can be removed when the cache is too large. Each entry is
+    # a dict (see `__fdx0CreateEntry`).
+    oSelf.__ddxEntry_by_sbKey = {};
+    oSelf.__uSizeInBytes = 0;
+    # A locked lock for each URL for which a request is being sent; it is
+    # unlocked when the response has been received.
+    oSelf.__doRequestLock_by_sbKey = {};
+    # The time until which requests for each URL for which the response could
+    # not be stored are not collapsed, in the order in which they expire.
+    oSelf.__dnUncacheableUntilTime_by_sbKey = {};
+    # The size of each file in the disk cache, in the order in which they were
+    # last used.
+    oSelf.__duSizeInBytes_by_sFileName = {};
+    oSelf.__uDiskSizeInBytes = 0;
+    if s0DiskCacheFolderPath is not None:
+      os.makedirs(s0DiskCacheFolderPath, exist_ok = True);
+      atxFiles = [];
+      for oDirEntry in os.scandir(s0DiskCacheFolderPath):
+        if oDirEntry.is_file() and oDirEntry.name.endswith(".cache"):
+          oStat = oDirEntry.stat();
+          atxFiles.append((oStat.st_mtime, oDirEntry.name, oStat.st_size));
+      for (nModifiedTime, sFileName, uSizeInBytes) in sorted(atxFiles):
+        oSelf.__duSizeInBytes_by_sFileName[sFileName] = uSizeInBytes;
+        oSelf.__uDiskSizeInBytes += uSizeInBytes;
+    oSelf.oMetrics = cMetrics();
+    oSelf.oMetrics.fAddGauge("HTTP cache entries", lambda: oSelf.uEntriesCount);
+    oSelf.oMetrics.fAddGauge("HTTP cache size in bytes", lambda: oSelf.uSizeInBytes);
+  
+  @property
+  def uEntriesCount(oSelf):
+    return len(oSelf.__ddxEntry_by_sbKey);
+  
+  @property
+  def uSizeInBytes(oSelf):
+    return oSelf.__uSizeInBytes;
+  
+  @property
+  def uDiskSizeInBytes(oSelf):
+    return oSelf.__uDiskSizeInBytes;
+  
+  @property
+  def n0HitRatio(oSelf):
+    # The fraction of GET requests that were answered without the server
+    # sending the response body, including those that were revalidated.
+    duValue_by_sCounterName = oSelf.oMetrics.fdxGetSnapshot()["dxCounters"];
+    uHitsCount = (
+      duValue_by_sCounterName.get("HTTP cache hits", 0) +
+      duValue_by_sCounterName.get("HTTP cache revalidated hits", 0)
+    );
+    uLookupsCount = uHitsCount + duValue_by_sCounterName.get("HTTP cache misses", 0);
+    return uHitsCount / uLookupsCount if uLookupsCount else None;
+  
+  @property
+  def uBytesSaved(oSelf):
+    # The total size of the response bodies that the server did not need to
+    # send because a cached response was used.
+    return oSelf.oMetrics.fdxGetSnapshot()["dxCounters"].get("HTTP cache bytes saved", 0);
+  
+  @staticmethod
+  def fsbGetKey(oServerBaseURL, oRequest):
+    sbRequestTarget = oRequest.fsbSerializeStartLine().split(b" ")[1];
+    if not sbRequestTarget.startswith(b"/"):
+      return sbRequestTarget; # Absolute form.
+    return oServerBaseURL.sbBase + sbRequestTarget;
+  
+  @ShowDebugOutput
+  def fo0GetResponse(oSelf,
+    oServerBaseURL,
+    oRequest,
+    fo0SendRequestAndReceiveResponse,
+  ):
+    # Returns a response to the request from the cache if possible, or the
+    # response returned by fo0SendRequestAndReceiveResponse(oRequest) (which
+    # can return None) otherwise. The response returned is always a copy, so
+    # the caller can modify it.
+    sbKey = oSelf.fsbGetKey(oServerBaseURL, oRequest);
+    if oRequest.sbMethod != b"GET":
+      o0Response = fo0SendRequestAndReceiveResponse(oRequest);
+      if (
+        o0Response is not None and oRequest.sbMethod not in gasbSafeMethods
+        and 200 <= fuGetStatusCode(o0Response) < 400
+      ):
+        oSelf.fRemove(sbKey);
+      return o0Response;
+    dsb0RequestCacheControl_by_sbLowerDirective = fdsb0GetLowerCacheControlDirectives(oRequest.oHeaders);
+    if (
+      b"no-store" in dsb0RequestCacheControl_by_sbLowerDirective
+      or fsb0GetHeaderValue(oRequest.oHeaders, b"range") is not None
+    ):
+      return fo0SendRequestAndReceiveResponse(oRequest);
+    # The request can ask us not to use stored responses that are older than
+    # a given age, or not to use them without revalidation at all.
+    n0RequestMaxAgeInSeconds = (
+      0 if b"no-cache" in dsb0RequestCacheControl_by_sbLowerDirective else
+      fn0GetDeltaSeconds(dsb0RequestCacheControl_by_sbLowerDirective.get(b"max-age"))
+    );
+    n0WaitForOtherRequestStartTime = None;
+    while 1:
+      dx0Entry = oSelf.__fdx0GetEntry(sbKey, oRequest);
+      if dx0Entry is not None and oSelf.__fbEntryIsFresh(dx0Entry, n0RequestMaxAgeInSeconds):
+        oSelf.oMetrics.fAddToCounter("HTTP cache hits");
+        oSelf.oMetrics.fAddToCounter("HTTP cache bytes saved", len(dx0Entry["oResponse"].sbBody));
+        if gbShowDebugOutput:
+          fShowDebugOutput(oSelf, "Using cached response for %s." % repr(sbKey));
+        return oSelf.__foGetResponseForEntry(dx0Entry);
+      if (
+        n0WaitForOtherRequestStartTime is not None and dx0Entry is not None
+        and dx0Entry["nResponseTime"] >= n0WaitForOtherRequestStartTime
+      ):
+        # The response was received or revalidated by the request we waited
+        # for, so it can be used even if it must be revalidated before use.
+        oSelf.oMetrics.fAddToCounter("HTTP cache hits");
+        oSelf.oMetrics.fAddToCounter("HTTP cache bytes saved", len(dx0Entry["oResponse"].sbBody));
+        return oSelf.__foGetResponseForEntry(dx0Entry);
+      if n0WaitForOtherRequestStartTime is not None or oSelf.__fbURLIsUncacheable(sbKey):
+        # The response to the request we waited for (or a recent request) could
+        # not be stored, so there is no point in waiting for others.
+        if gbShowDebugOutput:
+          fShowDebugOutput(oSelf, "Sending request for uncacheable %s without waiting for other threads." % repr(sbKey));
+        return oSelf.__fo0SendRequestAndStoreResponse(
+          sbKey,
+          oRequest,
+          dx0Entry,
+          fo0SendRequestAndReceiveResponse,
+        );
+      oSelf.__oPropertiesLock.fAcquire();
+      try:
+        o0RequestLock = oSelf.__doRequestLock_by_sbKey.get(sbKey);
+        bSendRequest = o0RequestLock is None;
+        if bSendRequest:
+          o0RequestLock = oSelf.__doRequestLock_by_sbKey[sbKey] = cLock(
+            "%s.__oRequestLock" % oSelf.__class__.__name__,
+            bLocked = True,
+          );
+      finally:
+        oSelf.__oPropertiesLock.fRelease();
+      if bSendRequest:
+        try:
+          return oSelf.__fo0SendRequestAndStoreResponse(
+            sbKey,
+            oRequest,
+            dx0Entry,
+            fo0SendRequestAndReceiveResponse,
+          );
+        finally:
+          oSelf.__oPropertiesLock.fAcquire();
+          try:
+            del oSelf.__doRequestLock_by_sbKey[sbKey];
+          finally:
+            oSelf.__oPropertiesLock.fRelease();
+          o0RequestLock.fRelease();
+      # Another thread is sending a request for this URL; wait for it to finish
+      # and use the cached response. If its response could not be stored, we
+      # will send a request ourselves, in parallel with any other waiters.
+      if gbShowDebugOutput:
+        fShowDebugOutput(oSelf, "Waiting for another thread to request %s..." % repr(sbKey));
+      oSelf.oMetrics.fAddToCounter("HTTP cache collapsed requests");
+      n0WaitForOtherRequestStartTime = time.time();
+      o0RequestLock.fbWait(None);
+  
+  def __fo0SendRequestAndStoreResponse(oSelf,
+    sbKey,
+    oRequest,
+    dx0Entry,
+    fo0SendRequestAndReceiveResponse,
+  ):
+    oRequestToSend = oRequest;
+    if dx0Entry is not None:
+      # Ask the server to respond with "304 Not Modified" if the stored
+      # response can still be used.
+      oStoredHeaders = dx0Entry["oResponse"].oHeaders;
+      asbConditionalHeaderLines = [];
+      sb0ETag = fsb0GetHeaderValue(oStoredHeaders, b"etag");
+      if sb0ETag is not None:
+        asbConditionalHeaderLines.append(b"If-None-Match: " + sb0ETag);
+      sb0LastModified = fsb0GetHeaderValue(oStoredHeaders, b"last-modified");
+      if sb0LastModified is not None:
+        asbConditionalHeaderLines.append(b"If-Modified-Since: " + sb0LastModified);
+      if asbConditionalHeaderLines:
+        oRequestToSend = foCopyMessage(oRequest, [
+          sbHeaderLine
+          for sbHeaderLine in oRequest.oHeaders.fasbSerializeLines()
+          if sbHeaderLine.split(b":", 1)[0].strip().lower() not in [b"if-none-match", b"if-modified-since"]
+        ] + asbConditionalHeaderLines);
+        oSelf.oMetrics.fAddToCounter("HTTP cache revalidations");
+      else:
+        dx0Entry = None; # The stored response cannot be revalidated.
+    nRequestTime = time.time();
+    o0Response = fo0SendRequestAndReceiveResponse(oRequestToSend);
+    nResponseTime = time.time();
+    if o0Response is None:
+      return None;
+    oResponse = o0Response;
+    if dx0Entry is not None and fuGetStatusCode(oResponse) == 304:
+      if gbShowDebugOutput:
+        fShowDebugOutput(oSelf, "Cached response for %s was revalidated." % repr(sbKey));
+      oSelf.oMetrics.fAddToCounter("HTTP cache revalidated hits");
+      oStoredResponse = dx0Entry["oResponse"];
+      oSelf.oMetrics.fAddToCounter("HTTP cache bytes saved", len(oStoredResponse.sbBody));
+      # Headers in the 304 response replace those of the stored response.
+      asbLowerUpdatedHeaderNames = [
+        sbHeaderLine.split(b":", 1)[0].strip().lower()
+        for sbHeaderLine in oResponse.oHeaders.fasbSerializeLines()
+      ];
+      oUpdatedResponse = foCopyMessage(oStoredResponse, [
+        sbHeaderLine
+        for sbHeaderLine in oStoredResponse.oHeaders.fasbSerializeLines()
+        if (
+          sbHeaderLine.split(b":", 1)[0].strip().lower() not in asbLowerUpdatedHeaderNames
+          or sbHeaderLine.split(b":", 1)[0].strip().lower() in gasbLowerHeaderNamesNotUpdatedByNotModifiedResponse
+        )
+      ] + [
+        sbHeaderLine
+        for sbHeaderLine in oResponse.oHeaders.fasbSerializeLines()
+        if sbHeaderLine.split(b":", 1)[0].strip().lower() not in gasbLowerHeaderNamesNotUpdatedByNotModifiedResponse
+      ]);
+      dx0UpdatedEntry = oSelf.__fdx0CreateEntry(oRequest, oUpdatedResponse, nRequestTime, nResponseTime);
+      if dx0UpdatedEntry is None:
+        oSelf.fRemove(sbKey);
+        oSelf.__fSetURLIsUncacheable(sbKey, True);
+        return oUpdatedResponse;
+      oSelf.__fSetURLIsUncacheable(sbKey, False);
+      oSelf.__fStoreEntry(sbKey, dx0UpdatedEntry);
+      return oSelf.__foGetResponseForEntry(dx0UpdatedEntry);
+    oSelf.oMetrics.fAddToCounter("HTTP cache misses");
+    dx0NewEntry = oSelf.__fdx0CreateEntry(oRequest, oResponse, nRequestTime, nResponseTime);
+    oSelf.__fSetURLIsUncacheable(sbKey, dx0NewEntry is None);
+    if dx0NewEntry is not None:
+      oSelf.__fStoreEntry(sbKey, dx0NewEntry);
+      # We keep our own copy, as the caller may modify the response.
+      return foCopyMessage(oResponse);
+    return oResponse;
+  
+  def __fbURLIsUncacheable(oSelf, sbKey):
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      n0UncacheableUntilTime = oSelf.__dnUncacheableUntilTime_by_sbKey.get(sbKey);
+      return n0UncacheableUntilTime is not None and n0UncacheableUntilTime > time.time();
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+  
+  def __fSetURLIsUncacheable(oSelf, sbKey, bUncacheable):
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      oSelf.__dnUncacheableUntilTime_by_sbKey.pop(sbKey, None);
+      nCurrentTime = time.time();
+      if bUncacheable:
+        oSelf.__dnUncacheableUntilTime_by_sbKey[sbKey] = nCurrentTime + gnUncacheableURLTimeoutInSeconds;
+      # Forget URLs for which the timeout has expired; as they all have the same
+      # timeout, these are the first in the dict.
+      while oSelf.__dnUncacheableUntilTime_by_sbKey:
+        sbOldestKey = next(iter(oSelf.__dnUncacheableUntilTime_by_sbKey));
+        if oSelf.__dnUncacheableUntilTime_by_sbKey[sbOldestKey] > nCurrentTime:
+          break;
+        del oSelf.__dnUncacheableUntilTime_by_sbKey[sbOldestKey];
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+  
+  @staticmethod
+  def __fdx0CreateEntry(oRequest, oResponse, nRequestTime, nResponseTime):
+    # Returns an entry for the response, or None if it cannot be stored.
+    uStatusCode = fuGetStatusCode(oResponse);
+    if uStatusCode not in gauStorableStatusCodes:
+      return None;
+    oHeaders = oResponse.oHeaders;
+    dsb0RequestCacheControl_by_sbLowerDirective = fdsb0GetLowerCacheControlDirectives(oRequest.oHeaders);
+    dsb0ResponseCacheControl_by_sbLowerDirective = fdsb0GetLowerCacheControlDirectives(oHeaders);
+    if (
+      b"no-store" in dsb0RequestCacheControl_by_sbLowerDirective
+      or b"no-store" in dsb0ResponseCacheControl_by_sbLowerDirective
+      or b"private" in dsb0ResponseCacheControl_by_sbLowerDirective # We are a shared cache.
+    ):
+      return None;
+    if fsb0GetHeaderValue(oRequest.oHeaders, b"authorization") is not None and not any(
+      sbLowerDirective in dsb0ResponseCacheControl_by_sbLowerDirective
+      for sbLowerDirective in [b"public", b"s-maxage", b"must-revalidate"]
+    ):
+      return None; # RFC 9111 section 3.5.
+    asbLowerVaryHeaderNames = fasbGetLowerHeaderValues(oHeaders, b"vary");
+    if b"*" in asbLowerVaryHeaderNames:
+      return None;
+    # Calculate the age of the response when we received it (RFC 9111 section
+    # 4.2.3) and how long it is fresh (section 4.2.1).
+    n0DateTime = fn0GetHeaderDateTime(oHeaders, b"date");
+    nApparentAgeInSeconds = max(0, nResponseTime - n0DateTime) if n0DateTime is not None else 0;
+    nAgeInSeconds = fn0GetDeltaSeconds(fsb0GetHeaderValue(oHeaders, b"age")) or 0;
+    nCorrectedInitialAgeInSeconds = max(nApparentAgeInSeconds, nAgeInSeconds + (nResponseTime - nRequestTime));
+    # A shared cache uses "s-maxage" rather than "max-age" if both are present.
+    n0FreshnessLifetimeInSeconds = fn0GetDeltaSeconds(dsb0ResponseCacheControl_by_sbLowerDirective.get(b"s-maxage"));
+    if n0FreshnessLifetimeInSeconds is None:
+      n0FreshnessLifetimeInSeconds = fn0GetDeltaSeconds(dsb0ResponseCacheControl_by_sbLowerDirective.get(b"max-age"));
+    if n0FreshnessLifetimeInSeconds is None and fsb0GetHeaderValue(oHeaders, b"expires") is not None:
+      # An invalid date means the response has already expired.
+      n0ExpiresDateTime = fn0GetHeaderDateTime(oHeaders, b"expires");
+      n0FreshnessLifetimeInSeconds = max(0,
+        n0ExpiresDateTime - (n0DateTime if n0DateTime is not None else nResponseTime)
+      ) if n0ExpiresDateTime is not None else 0;
+    if n0FreshnessLifetimeInSeconds is None:
+      n0LastModifiedDateTime = fn0GetHeaderDateTime(oHeaders, b"last-modified");
+      n0FreshnessLifetimeInSeconds = min(
+        gnMaxHeuristicFreshnessLifetimeInSeconds,
+        max(0, ((n0DateTime or nResponseTime) - n0LastModifiedDateTime) * gnHeuristicFreshnessLifetimeFraction),
+      ) if n0LastModifiedDateTime is not None else 0;
+    bCanBeRevalidated = (
+      fsb0GetHeaderValue(oHeaders, b"etag") is not None
+      or fsb0GetHeaderValue(oHeaders, b"last-modified") is not None
+    );
+    if n0FreshnessLifetimeInSeconds == 0 and not bCanBeRevalidated:
+      return None; # It would never be used.
+    return {
+      "oResponse": oResponse,
+      "nResponseTime": nResponseTime,
+      "nCorrectedInitialAgeInSeconds": nCorrectedInitialAgeInSeconds,
+      "nFreshnessLifetimeInSeconds": n0FreshnessLifetimeInSeconds,
+      # "no-cache" means the response can be stored but must be revalidated
+      # before it is used.
+      "bMustBeRevalidated": b"no-cache" in dsb0ResponseCacheControl_by_sbLowerDirective,
+      # The values of the request headers named in the response's "Vary"
+      # header; the response can only be used for requests with the same values.
+      "dsbVaryHeaderValue_by_sbLowerName": dict(
+        (sbLowerName, b", ".join(fasbGetLowerHeaderValues(oRequest.oHeaders, sbLowerName)))
+        for sbLowerName in asbLowerVaryHeaderNames
+      ),
+      "uSizeInBytes": len(oResponse.fsbSerializeStartLine()) + len(oResponse.sbBody) + sum(
+        len(sbHeaderLine) + 2 for sbHeaderLine in oHeaders.fasbSerializeLines()
+      ),
+    };
+  
+  @staticmethod
+  def __fnGetCurrentAgeInSeconds(dxEntry):
+    return dxEntry["nCorrectedInitialAgeInSeconds"] + (time.time() - dxEntry["nResponseTime"]);
+  
+  @staticmethod
+  def __fbEntryIsFresh(dxEntry, n0RequestMaxAgeInSeconds):
+    if dxEntry["bMustBeRevalidated"]:
+      return False;
+    nCurrentAgeInSeconds = cHTTPCache.__fnGetCurrentAgeInSeconds(dxEntry);
+    if n0RequestMaxAgeInSeconds is not None and nCurrentAgeInSeconds > n0RequestMaxAgeInSeconds:
+      return False;
+    return nCurrentAgeInSeconds < dxEntry["nFreshnessLifetimeInSeconds"];
+  
+  @staticmethod
+  def __foGetResponseForEntry(dxEntry):
+    # Returns a copy of the stored response with an "Age" header.
+    oResponse = dxEntry["oResponse"];
+    return foCopyMessage(oResponse, [
+      sbHeaderLine
+      for sbHeaderLine in oResponse.oHeaders.fasbSerializeLines()
+      if sbHeaderLine.split(b":", 1)[0].strip().lower() != b"age"
+    ] + [b"Age: %d" % cHTTPCache.__fnGetCurrentAgeInSeconds(dxEntry)]);
+  
+  def __fdx0GetEntry(oSelf, sbKey, oRequest):
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      dx0Entry = oSelf.__ddxEntry_by_sbKey.pop(sbKey, None);
+      if dx0Entry is not None:
+        oSelf.__ddxEntry_by_sbKey[sbKey] = dx0Entry; # Now the most recently used.
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+    if dx0Entry is None and oSelf.__s0DiskCacheFolderPath is not None:
+      dx0Entry = oSelf.__fdx0ReadEntryFromDisk(sbKey);
+      if dx0Entry is not None:
+        oSelf.__fStoreEntryInMemory(sbKey, dx0Entry);
+    if dx0Entry is None:
+      return None;
+    for (sbLowerName, sbValue) in dx0Entry["dsbVaryHeaderValue_by_sbLowerName"].items():
+      if b", ".join(fasbGetLowerHeaderValues(oRequest.oHeaders, sbLowerName)) != sbValue:
+        return None;
+    return dx0Entry;
+  
+  def __fStoreEntry(oSelf, sbKey, dxEntry):
+    oSelf.__fStoreEntryInMemory(sbKey, dxEntry);
+    if oSelf.__s0DiskCacheFolderPath is not None:
+      oSelf.__fWriteEntryToDisk(sbKey, dxEntry);
+  
+  def __fStoreEntryInMemory(oSelf, sbKey, dxEntry):
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      dx0OldEntry = oSelf.__ddxEntry_by_sbKey.pop(sbKey, None);
+      if dx0OldEntry is not None:
+        oSelf.__uSizeInBytes -= dx0OldEntry["uSizeInBytes"];
+      if dxEntry["uSizeInBytes"] > oSelf.__uMaxSizeInBytes:
+        return; # Too large to keep in memory.
+      while oSelf.__ddxEntry_by_sbKey and oSelf.__uSizeInBytes + dxEntry["uSizeInBytes"] > oSelf.__uMaxSizeInBytes:
+        # Remove the least recently used entry.
+        oSelf.__uSizeInBytes -= oSelf.__ddxEntry_by_sbKey.pop(next(iter(oSelf.__ddxEntry_by_sbKey)))["uSizeInBytes"];
+      oSelf.__ddxEntry_by_sbKey[sbKey] = dxEntry;
+      oSelf.__uSizeInBytes += dxEntry["uSizeInBytes"];
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+  
+  def fRemove(oSelf, sbKey):
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      dx0Entry = oSelf.__ddxEntry_by_sbKey.pop(sbKey, None);
+      if dx0Entry is not None:
+        oSelf.__uSizeInBytes -= dx0Entry["uSizeInBytes"];
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+    if oSelf.__s0DiskCacheFolderPath is not None:
+      oSelf.__fRemoveFilesFromDisk([oSelf.__fsGetFileName(sbKey)]);
+  
+  def fClear(oSelf):
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      oSelf.__ddxEntry_by_sbKey.clear();
+      oSelf.__uSizeInBytes = 0;
+      asFileNames = list(oSelf.__duSizeInBytes_by_sFileName.keys());
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+    if oSelf.__s0DiskCacheFolderPath is not None:
+      oSelf.__fRemoveFilesFromDisk(asFileNames);
+  
+  # Disk cache: each response is stored in a file named after the hash of its
+  # key. The file starts with a line of JSON containing the key, the start
+  # line, headers and other details of the entry, followed by the body.
+  @staticmethod
+  def __fsGetFileName(sbKey):
+    return hashlib.sha256(sbKey).hexdigest() + ".cache";
+  
+  @ShowDebugOutput
+  def __fWriteEntryToDisk(oSelf, sbKey, dxEntry):
+    oResponse = dxEntry["oResponse"];
+    sbFileContent = json.dumps({
+      "sKey": str(sbKey, "latin1"),
+      "sStartLine": str(oResponse.fsbSerializeStartLine(), "latin1"),
+      "asHeaderLines": [str(sbHeaderLine, "latin1") for sbHeaderLine in oResponse.oHeaders.fasbSerializeLines()],
+      "nResponseTime": dxEntry["nResponseTime"],
+      "nCorrectedInitialAgeInSeconds": dxEntry["nCorrectedInitialAgeInSeconds"],
+      "nFreshnessLifetimeInSeconds": dxEntry["nFreshnessLifetimeInSeconds"],
+      "bMustBeRevalidated": dxEntry["bMustBeRevalidated"],
+      "dsVaryHeaderValue_by_sLowerName": dict(
+        (str(sbLowerName, "latin1"), str(sbValue, "latin1"))
+        for (sbLowerName, sbValue) in dxEntry["dsbVaryHeaderValue_by_sbLowerName"].items()
+      ),
+    }).encode("ascii") + b"\n" + oResponse.sbBody;
+    if len(sbFileContent) > oSelf.__uMaxDiskSizeInBytes:
+      return;
+    sFileName = oSelf.__fsGetFileName(sbKey);
+    sFilePath = os.path.join(oSelf.__s0DiskCacheFolderPath, sFileName);
+    # Write to a temporary file first, so other threads and processes never
+    # read a partially written file.
+    sTemporaryFilePath = "%s.%d.%X.tmp" % (sFilePath, os.getpid(), id(dxEntry));
+    try:
+      with open(sTemporaryFilePath, "wb") as oFile:
+        oFile.write(sbFileContent);
+      os.replace(sTemporaryFilePath, sFilePath);
+    except OSError as oException:
+      fShowDebugOutput(oSelf, "Cannot write %s: %s" % (sFilePath, oException));
+      try:
+        os.remove(sTemporaryFilePath);
+      except OSError:
+        pass;
+      return;
+    asFileNamesToRemove = [];
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      oSelf.__uDiskSizeInBytes -= oSelf.__duSizeInBytes_by_sFileName.pop(sFileName, 0);
+      oSelf.__duSizeInBytes_by_sFileName[sFileName] = len(sbFileContent);
+      oSelf.__uDiskSizeInBytes += len(sbFileContent);
+      # Remove the least recently used files until the disk cache is small enough.
+      uDiskSizeInBytesAfterRemoval = oSelf.__uDiskSizeInBytes;
+      for (sOldFileName, uOldFileSizeInBytes) in oSelf.__duSizeInBytes_by_sFileName.items():
+        if uDiskSizeInBytesAfterRemoval <= oSelf.__uMaxDiskSizeInBytes:
+          break;
+        asFileNamesToRemove.append(sOldFileName);
+        uDiskSizeInBytesAfterRemoval -= uOldFileSizeInBytes;
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+    if asFileNamesToRemove:
+      oSelf.__fRemoveFilesFromDisk(asFileNamesToRemove);
+  
+  @ShowDebugOutput
+  def __fdx0ReadEntryFromDisk(oSelf, sbKey):
+    sFileName = oSelf.__fsGetFileName(sbKey);
+    sFilePath = os.path.join(oSelf.__s0DiskCacheFolderPath, sFileName);
+    try:
+      with open(sFilePath, "rb") as oFile:
+        sbFileContent = oFile.read();
+    except OSError:
+      return None;
+    try:
+      (sbDetails, sbBody) = sbFileContent.split(b"\n", 1);
+      dxDetails = json.loads(sbDetails);
+      if dxDetails["sKey"] != str(sbKey, "latin1"):
+        return None; # Another key with the same hash; very unlikely.
+      asbHeaderLines = [bytes(sHeaderLine, "latin1") for sHeaderLine in dxDetails["asHeaderLines"]];
+      oResponse = cResponse(
+        o0zHeaders = cHeaders.foDeserializeLines(asbHeaderLines),
+        **cResponse.fdxDeserializeStartLine(bytes(dxDetails["sStartLine"], "latin1")),
+      );
+      oResponse.fSetBody(sbBody);
+      dxEntry = {
+        "oResponse": oResponse,
+        "nResponseTime": dxDetails["nResponseTime"],
+        "nCorrectedInitialAgeInSeconds": dxDetails["nCorrectedInitialAgeInSeconds"],
+        "nFreshnessLifetimeInSeconds": dxDetails["nFreshnessLifetimeInSeconds"],
+        "bMustBeRevalidated": dxDetails["bMustBeRevalidated"],
+        "dsbVaryHeaderValue_by_sbLowerName": dict(
+          (bytes(sLowerName, "latin1"), bytes(sValue, "latin1"))
+          for (sLowerName, sValue) in dxDetails["dsVaryHeaderValue_by_sLowerName"].items()
+        ),
+        "uSizeInBytes": len(sbFileContent),
+      };
+    except (ValueError, KeyError, TypeError):
+      fShowDebugOutput(oSelf, "Cannot read %s: invalid file." % sFilePath);
+      return None;
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      # Now the most recently used file.
+      u0SizeInBytes = oSelf.__duSizeInBytes_by_sFileName.pop(sFileName, None);
+      if u0SizeInBytes is not None:
+        oSelf.__duSizeInBytes_by_sFileName[sFileName] = u0SizeInBytes;
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+    return dxEntry;
+  
+  def __fRemoveFilesFromDisk(oSelf, asFileNames):
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      for sFileName in asFileNames:
+        oSelf.__uDiskSizeInBytes -= oSelf.__duSizeInBytes_by_sFileName.pop(sFileName, 0);
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+    for sFileName in asFileNames:
+      try:
+        os.remove(os.path.join(oSelf.__s0DiskCacheFolderPath, sFileName));
+      except OSError:
+        pass; # Already removed.
+  
+  def fasGetDetails(oSelf):
+    n0HitRatio = oSelf.n0HitRatio;
+    return [s for s in [
+      "%d entries" % oSelf.uEntriesCount,
+      "%d/%d bytes" % (oSelf.__uSizeInBytes, oSelf.__uMaxSizeInBytes),
+      "disk: %d/%d bytes" % (oSelf.__uDiskSizeInBytes, oSelf.__uMaxDiskSizeInBytes) if oSelf.__s0DiskCacheFolderPath is not None else None,
+      "hit ratio: %d%%" % (n0HitRatio * 100) if n0HitRatio is not None else None,
+    ] if s];
+  
+  def __repr__(oSelf):
+    sModuleName = ".".join(oSelf.__class__.__module__.split(".")[:-1]);
+    return "<%s.%s#%X|%s>" % (sModuleName, oSelf.__class__.__name__, id(oSelf), "|".join(oSelf.fasGetDetails()));
+  
+  def __str__(oSelf):
+    return "%s#%X{%s}" % (oSelf.__class__.__name__, id(oSelf), ", ".join(oSelf.fasGetDetails()));
@@ -0,0 +1,210 @@
+import bisect, re;
+
+from mMultiThreading import cLock;
+from mNotProvided import (
+  fxGetFirstProvidedValue,
+  zNotProvided,
+);
+
+gnDeadlockTimeoutInSeconds = 1; # We're not doing anything time consuming, so this should suffice.
+# Upper bounds of the buckets in duration histograms; durations larger than the
+# last value are only counted in the implicit "+Inf" bucket.
+ganDefaultHistogramBucketUpperBoundsInSeconds = (
+  0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+);
+grNonPrometheusNameCharacters = re.compile(r"[^a-zA-Z0-9_]+");
+
+def fAddRawData(duValue_by_sCounterName, dxHistogram_by_sName, duAddedValue_by_sCounterName, dxAddedHistogram_by_sName):
+  for (sName, uValue) in duAddedValue_by_sCounterName.items():
+    duValue_by_sCounterName[sName] = duValue_by_sCounterName.get(sName, 0) + uValue;
+  for (sName, (auAddedBucketCounts, nAddedSumInSeconds, uAddedCount)) in dxAddedHistogram_by_sName.items():
+    xHistogram = dxHistogram_by_sName.get(sName);
+    if xHistogram is None:
+      dxHistogram_by_sName[sName] = [list(auAddedBucketCounts), nAddedSumInSeconds, uAddedCount];
+    else:
+      xHistogram[0] = [uBucketCount + uAddedBucketCount for (uBucketCount, uAddedBucketCount) in zip(xHistogram[0], auAddedBucketCounts)];
+      xHistogram[1] += nAddedSumInSeconds;
+      xHistogram[2] += uAddedCount;
+
+class cMetrics(object):
+  # Counters and duration histograms that are updated by connections and
+  # connections pools as they are used. Updating them does not fire events or
+  # call callbacks, so they can be used to observe performance without the
+  # overhead of handling "read bytes" and "wrote bytes" events.
+  # A cMetrics instance can have children, the metrics of which are added to
+  # its own when a snapshot is made; a connections pool uses this to aggregate
+  # the metrics of all its connections. Updates are only applied to the child,
+  # so connections do not contend for the lock of the pool's metrics. When a
+  # child is removed, the metrics it collected are added to the parent's own.
+  # Gauges are functions that return a value; they are only called when a
+  # snapshot is made.
+  def __init__(oSelf,
+    *,
+    anzHistogramBucketUpperBoundsInSeconds = zNotProvided,
+  ):
+    oSelf.__anHistogramBucketUpperBoundsInSeconds = tuple(fxGetFirstProvidedValue(
+      anzHistogramBucketUpperBoundsInSeconds,
+      ganDefaultHistogramBucketUpperBoundsInSeconds,
+    ));
+    oSelf.__oPropertiesLock = cLock(
+      "%s.__oPropertiesLock" % oSelf.__class__.__name__,
+      n0DeadlockTimeoutInSeconds = gnDeadlockTimeoutInSeconds
+    );
+    oSelf.__duValue_by_sCounterName = {};
+    # The histogram for each name is a list with the number of durations in
+    # each bucket (not cumulative; the last one is "+Inf"), their sum and count.
+    oSelf.__dxHistogram_by_sName = {};
+    oSelf.__dfxGetValue_by_sGaugeName = {};
+    oSelf.__aoChildren = [];
+  
+  def fAddChild(oSelf, oChild):
+    assert oChild.__anHistogramBucketUpperBoundsInSeconds == oSelf.__anHistogramBucketUpperBoundsInSeconds, \
+        "Cannot aggregate histograms with different buckets";
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      oSelf.__aoChildren.append(oChild);
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+  
+  def fRemoveChild(oSelf, oChild):
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      oSelf.__aoChildren.remove(oChild);
+      # The child's lock is acquired while ours is held; children never acquire
+      # the lock of their parent, so this cannot deadlock.
+      fAddRawData(oSelf.__duValue_by_sCounterName, oSelf.__dxHistogram_by_sName, *oChild.__ftxGetRawData());
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+  
+  def fAddToCounter(oSelf, sName, uValue = 1):
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      oSelf.__duValue_by_sCounterName[sName] = oSelf.__duValue_by_sCounterName.get(sName, 0) + uValue;
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+  
+  def fRecordDuration(oSelf, sName, nDurationInSeconds):
+    uBucketIndex = bisect.bisect_left(oSelf.__anHistogramBucketUpperBoundsInSeconds, nDurationInSeconds);
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      xHistogram = oSelf.__dxHistogram_by_sName.get(sName);
+      if xHistogram is None:
+        xHistogram = oSelf.__dxHistogram_by_sName[sName] = [
+          [0] * (len(oSelf.__anHistogramBucketUpperBoundsInSeconds) + 1),
+          0, # sum
+          0, # count
+        ];
+      xHistogram[0][uBucketIndex] += 1;
+      xHistogram[1] += nDurationInSeconds;
+      xHistogram[2] += 1;
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+  
+  def fAddGauge(oSelf, sName, fxGetValue):
+    oSelf.__dfxGetValue_by_sGaugeName[sName] = fxGetValue;
+  
+  def __ftxGetRawData(oSelf):
+    # Returns copies of the counters and histograms, including those of all
+    # children.
+    duValue_by_sCounterName = {};
+    dxHistogram_by_sName = {};
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      fAddRawData(duValue_by_sCounterName, dxHistogram_by_sName, oSelf.__duValue_by_sCounterName, oSelf.__dxHistogram_by_sName);
+      for oChild in oSelf.__aoChildren:
+        fAddRawData(duValue_by_sCounterName, dxHistogram_by_sName, *oChild.__ftxGetRawData());
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+    return (duValue_by_sCounterName, dxHistogram_by_sName);
+  
+  def fdxGetSnapshot(oSelf):
+    # Returns a dict with the current value of all counters and gauges and,
+    # for each histogram, the cumulative number of durations at or below each
+    # bucket's upper bound, their sum and count.
+    (duValue_by_sCounterName, dxHistogram_by_sName) = oSelf.__ftxGetRawData();
+    ddxHistogram_by_sName = {};
+    for (sName, (auBucketCounts, nSumInSeconds, uCount)) in dxHistogram_by_sName.items():
+      auCumulativeBucketCounts = [];
+      uCumulativeCount = 0;
+      for uBucketCount in auBucketCounts:
+        uCumulativeCount += uBucketCount;
+        auCumulativeBucketCounts.append(uCumulativeCount);
+      ddxHistogram_by_sName[sName] = {
+        "anBucketUpperBoundsInSeconds": list(oSelf.__anHistogramBucketUpperBoundsInSeconds) + [float("inf")],
+        "auCumulativeBucketCounts": auCumulativeBucketCounts,
+        "nSumInSeconds": nSumInSeconds,
+        "uCount": uCount,
+      };
+    return {
+      "dxCounters": duValue_by_sCounterName,
+      "dxGauges": {
+        sName: fxGetValue()
+        for (sName, fxGetValue) in list(oSelf.__dfxGetValue_by_sGaugeName.items())
+      },
+      "dxHistograms": ddxHistogram_by_sName,
+    };
+  
+  def fsGetPrometheusText(oSelf, sPrefix = "mhttpconnection", dsLabels = {}):
+    # Returns the snapshot in the Prometheus text exposition format. Names are
+    # converted to lower case, with underscores instead of spaces.
+    dxSnapshot = oSelf.fdxGetSnapshot();
+    def fsGetName(sName, sSuffix):
+      return grNonPrometheusNameCharacters.sub("_", "%s_%s%s" % (sPrefix, sName, sSuffix)).lower();
+    def fsGetLabels(dsAdditionalLabels = {}):
+      dsAllLabels = dict(dsLabels, **dsAdditionalLabels);
+      if not dsAllLabels:
+        return "";
+      return "{%s}" % ",".join(
+        '%s="%s"' % (sLabelName, str(sLabelValue).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for (sLabelName, sLabelValue) in dsAllLabels.items()
+      );
+    def fsFormatNumber(nValue):
+      return "+Inf" if nValue == float("inf") else repr(nValue);
+    asLines = [];
+    for (sName, uValue) in sorted(dxSnapshot["dxCounters"].items()):
+      sPrometheusName = fsGetName(sName, "_total");
+      asLines += [
+        "# TYPE %s counter" % sPrometheusName,
+        "%s%s %d" % (sPrometheusName, fsGetLabels(), uValue),
+      ];
+    for (sName, xValue) in sorted(dxSnapshot["dxGauges"].items()):
+      sPrometheusName = fsGetName(sName, "");
+      asLines += [
+        "# TYPE %s gauge" % sPrometheusName,
+        "%s%s %s" % (sPrometheusName, fsGetLabels(), fsFormatNumber(xValue)),
+      ];
+    for (sName, dxHistogram) in sorted(dxSnapshot["dxHistograms"].items()):
+      sPrometheusName = fsGetName(sName, "_seconds");
+      asLines.append("# TYPE %s histogram" % sPrometheusName);
+      for (nUpperBoundInSeconds, uCumulativeCount) in zip(
+        dxHistogram["anBucketUpperBoundsInSeconds"],
+        dxHistogram["auCumulativeBucketCounts"],
+      ):
+        asLines.append("%s_bucket%s %d" % (sPrometheusName, fsGetLabels({"le": fsFormatNumber(nUpperBoundInSeconds)}), uCumulativeCount));
+      asLines += [
+        "%s_sum%s %s" % (sPrometheusName, fsGetLabels(), repr(dxHistogram["nSumInSeconds"])),
+        "%s_count%s %d" % (sPrometheusName, fsGetLabels(), dxHistogram["uCount"]),
+      ];
+    return "".join("%s\n" % sLine for sLine in asLines);
+  
+  def fasGetDetails(oSelf):
+    oSelf.__oPropertiesLock.fAcquire();
+    try:
+      uNumberOfCounters = len(oSelf.__duValue_by_sCounterName);
+      uNumberOfHistograms = len(oSelf.__dxHistogram_by_sName);
+      uNumberOfChildren = len(oSelf.__aoChildren);
+    finally:
+      oSelf.__oPropertiesLock.fRelease();
+    return [s for s in [
+      "%d counters" % uNumberOfCounters,
+      "%d histograms" % uNumberOfHistograms,
+      "%d gauges" % len(oSelf.__dfxGetValue_by_sGaugeName) if oSelf.__dfxGetValue_by_sGaugeName else None,
+      "%d children" % uNumberOfChildren if uNumberOfChildren else None,
+    ] if s];
+  
+  def __repr__(oSelf):
+    sModuleName = ".".join(oSelf.__class__.__module__.split(".")[:-1]);
+    return "<%s.%s#%X|%s>" % (sModuleName, oSelf.__class__.__name__, id(oSelf), "|".join(oSelf.fasGetDetails()));
+  
+  def __str__(oSelf):
+    return "%s#%X{%s}" % (oSelf.__class__.__name__, id(oSelf), ", ".join(oSelf.fasGetDetails()));
@@ -0,0 +1,324 @@
+import multiprocessing, multiprocessing.connection, os, socket, time;
+
+from mMultiThreading import (
+  cLock,
+  cThread,
+  cWithCallbacks,
+);
+from mNotProvided import (
+  fxGetFirstProvidedValue,
+  zNotProvided,
+);
+
+from .cServer import cServer;
+from .mOptionalDebugOutput import (
+  fShowDebugOutput,
+  ShowDebugOutput,
+);
+
+gnDeadlockTimeoutInSeconds = 1; # We're not doing anything time consuming, so this should suffice.
+gsbDefaultHostname = b"127.0.0.1";
+guDefaultPortNumber = 80;
+gn0DefaultDrainTimeoutInSeconds = 10;
+# A process that exits sooner than this after it was started is not restarted
+# right away, so a process that crashes on start-up does not use all CPU.
+gnMinimumProcessLifetimeBeforeRestartInSeconds = 1;
+gnSupervisorPollIntervalInSeconds = 0.5;
+# Worker processes are started using "spawn" on all OSes: forking a process
+# that runs other threads (e.g. our supervisor thread) can deadlock the child.
+goMultiProcessingContext = multiprocessing.get_context("spawn");
+
+def foCreateBoundPythonSocket(sbHostname, uPortNumber, bReusePort):
+  # Create a socket that is bound to the given host and port. If bReusePort is
+  # True, other sockets can listen on the same port, and the OS distributes
+  # new connections between them.
+  oPythonSocket = socket.socket(socket.AF_INET6 if b":" in sbHostname else socket.AF_INET, socket.SOCK_STREAM);
+  try:
+    oPythonSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1);
+    if bReusePort:
+      oPythonSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1);
+    oPythonSocket.bind((str(sbHostname, "ascii", "strict"), uPortNumber));
+  except:
+    oPythonSocket.close();
+    raise;
+  return oPythonSocket;
+
+def fRunServerProcess(
+  fxRequestHandler,
+  o0ListeningPythonSocket,
+  sbHostname,
+  uPortNumber,
+  oStopConnection,
+  dxServerArguments,
+  n0DrainTimeoutInSeconds,
+):
+  # This runs in a worker process. If o0ListeningPythonSocket is None, we
+  # create our own socket on the same port using SO_REUSEPORT.
+  if o0ListeningPythonSocket is not None:
+    oListeningPythonSocket = o0ListeningPythonSocket;
+  else:
+    oListeningPythonSocket = foCreateBoundPythonSocket(sbHostname, uPortNumber, bReusePort = True);
+    oListeningPythonSocket.listen();
+  oServer = cServer(
+    fxRequestHandler,
+    o0ListeningPythonSocket = oListeningPythonSocket,
+    **dxServerArguments
+  );
+  # Wait until we are told to stop, or until the supervisor process is gone.
+  try:
+    oStopConnection.recv();
+  except EOFError:
+    pass;
+  # Drain: stop accepting connections and let requests that are being handled
+  # complete, up to the drain timeout.
+  oServer.fStop();
+  if not oServer.fbWait(n0DrainTimeoutInSeconds):
+    oServer.fTerminate();
+    oServer.fbWait(n0DrainTimeoutInSeconds);
+
+# Runs a cServer in each of a number of worker processes, so requests can be
+# handled by more than one CPU core. The processes accept connections on the
+# same port: either each has its own socket using SO_REUSEPORT, in which case
+# the OS distributes connections between them, or they all share a socket
+# created by this process. A supervisor thread restarts worker processes that
+# exit unexpectedly. `fStop` lets the worker processes complete the requests
+# they are handling before they exit.
+# fxRequestHandler is called in the worker processes, so it must be something
+# that can be pickled, such as a function defined at module level.
+class cMultiProcessServer(cWithCallbacks):
+  @ShowDebugOutput
+  def __init__(oSelf,
+    fxRequestHandler,
+    *,
+    sbzHostname = zNotProvided,
+    uzPortNumber = zNotProvided,
+    uzNumberOfProcesses = zNotProvided,
+    bzReusePort = zNotProvided,
+    n0zDrainTimeoutInSeconds = zNotProvided,
+    uzMaxNumberOfWorkerThreads = zNotProvided,
+    n0zIdleTimeoutInSeconds = zNotProvided,
+    n0zTransactionTimeoutInSeconds = zNotProvided,
+    bzCompressResponses = zNotProvided,
+    uzCompressionLevel = zNotProvided,
+  ):
+    oSelf.__fxRequestHandler = fxRequestHandler;
+    oSelf.__sbHostname = fxGetFirstProvidedValue(sbzHostname, gsbDefaultHostname);
+    oSelf.__uNumberOfProcesses = fxGetFirstProvidedValue(uzNumberOfProcesses, os.cpu_count() or 1);
+    assert oSelf.__uNumberOfProcesses > 0, \
+        "uzNumberOfProcesses must be at least 1, not %d" % oSelf.__uNumberOfProcesses;
+    # SO_REUSEPORT is not available on all OSes (e.g. Windows).
+    oSelf.__bReusePort = fxGetFirstProvidedValue(bzReusePort, hasattr(socket, "SO_REUSEPORT"));
+    oSelf.__n0DrainTimeoutInSeconds = fxGetFirstProvidedValue(n0zDrainTimeoutInSeconds, gn0DefaultDrainTimeoutInSeconds);
+    # Only arguments that were provided are passed to the worker processes.
+    oSelf.__dxServerArguments = dict(
+      (sName, xValue)
+      for (sName, xValue) in (
+        ("uzMaxNumberOfWorkerThreads", uzMaxNumberOfWorkerThreads),
+        ("n0zIdleTimeoutInSeconds", n0zIdleTimeoutInSeconds),
+        ("n0zTransactionTimeoutInSeconds", n0zTransactionTimeoutInSeconds),
+        ("bzCompressResponses", bzCompressResponses),
+        ("uzCompressionLevel", uzCompressionLevel),
+      )
+      if xValue is not zNotProvided
+    );
+    # We always create a socket in this process, so we know which port is
+    # used if the OS picks one (uzPortNumber = 0). If SO_REUSEPORT is used,
+    # this socket only reserves the port and does not listen: the worker
+    # processes create their own sockets.
+    oSelf.__oListeningPythonSocket = foCreateBoundPythonSocket(
+      oSelf.__sbHostname,
+      fxGetFirstProvidedValue(uzPortNumber, guDefaultPortNumber),
+      oSelf.__bReusePort,
+    );
+    if not oSelf.__bReusePort:
+      oSelf.__oListeningPythonSocket.listen();
+    oSelf.__uPortNumber = oSelf.__oListeningPythonSocket.getsockname()[1];
+  
+    oSelf.__oPropertyLock = cLock(
+      "%s.__oPropertyLock" % oSelf.__class__.__name__,
+      n0DeadlockTimeoutInSeconds = gnDeadlockTimeoutInSeconds
+    );
+    oSelf.__aoProcesses = [];
+    oSelf.__dnStartTime_by_oProcess = {};
+    # A process that crashes while it waits for a multiprocessing.Event can
+    # make setting that event hang, so each process gets its own pipe instead.
+    oSelf.__doStopConnection_by_oProcess = {};
+    oSelf.__uNumberOfRestartedProcesses = 0;
+    oSelf.__bStopping = False;
+    oSelf.__oTerminatedLock = cLock(
+      "%s.__oTerminatedLock" % oSelf.__class__.__name__,
+      bLocked = True
+    );
+  
+    oSelf.fAddEvents(
+      "started worker process",
+      "worker process exited",
+      "terminated",
+    );
+  
+    for uIndex in range(oSelf.__uNumberOfProcesses):
+      oSelf.__fStartProcess();
+    cThread(oSelf.__fSupervisorThread).fStart();
+  
+  @property
+  def sbHostname(oSelf):
+    return oSelf.__sbHostname;
+  
+  @property
+  def uPortNumber(oSelf):
+    return oSelf.__uPortNumber;
+  
+  @property
+  def bTerminated(oSelf):
+    return not oSelf.__oTerminatedLock.bLocked;
+  
+  @property
+  def uProcessesCount(oSelf):
+    return len(oSelf.__aoProcesses);
+  
+  @property
+  def uNumberOfRestartedProcesses(oSelf):
+    return oSelf.__uNumberOfRestartedProcesses;
+  
+  def __fStartProcess(oSelf):
+    (oStopReceiveConnection, oStopSendConnection) = goMultiProcessingContext.Pipe(duplex = False);
+    oProcess = goMultiProcessingContext.Process(
+      target = fRunServerProcess,
+      args = (
+        oSelf.__fxRequestHandler,
+        None if oSelf.__bReusePort else oSelf.__oListeningPythonSocket,
+        oSelf.__sbHostname,
+        oSelf.__uPortNumber,
+        oStopReceiveConnection,
+        oSelf.__dxServerArguments,
+        oSelf.__n0DrainTimeoutInSeconds,
+      ),
+      daemon = True,
+    );
+    oProcess.start();
+    oStopReceiveConnection.close();
+    oSelf.__oPropertyLock.fAcquire();
+    try:
+      oSelf.__aoProcesses.append(oProcess);
+      oSelf.__dnStartTime_by_oProcess[oProcess] = time.time();
+      oSelf.__doStopConnection_by_oProcess[oProcess] = oStopSendConnection;
+      bStopping = oSelf.__bStopping;
+    finally:
+      oSelf.__oPropertyLock.fRelease();
+    if bStopping:
+      # We started stopping while this process was being started.
+      oSelf.__fSendStopToProcess(oStopSendConnection);
+    fShowDebugOutput(oSelf, "Started worker process %d." % oProcess.pid);
+    oSelf.fFireCallbacks("started worker process", uProcessId = oProcess.pid);
+  
+  def __fStopAllProcesses(oSelf):
+    oSelf.__oPropertyLock.fAcquire();
+    try:
+      oSelf.__bStopping = True;
+      aoStopSendConnections = list(oSelf.__doStopConnection_by_oProcess.values());
+    finally:
+      oSelf.__oPropertyLock.fRelease();
+    for oStopSendConnection in aoStopSendConnections:
+      oSelf.__fSendStopToProcess(oStopSendConnection);
+  
+  @staticmethod
+  def __fSendStopToProcess(oStopSendConnection):
+    try:
+      oStopSendConnection.send(None);
+    except OSError:
+      pass; # The process has already exited, or the supervisor thread closed the connection.
+  
+  def __fSupervisorThread(oSelf):
+    while 1:
+      oSelf.__oPropertyLock.fAcquire();
+      try:
+        aoProcesses = oSelf.__aoProcesses[:];
+      finally:
+        oSelf.__oPropertyLock.fRelease();
+      if not aoProcesses:
+        break; # All processes have exited after we started stopping.
+      multiprocessing.connection.wait(
+        [oProcess.sentinel for oProcess in aoProcesses],
+        timeout = gnSupervisorPollIntervalInSeconds,
+      );
+      for oProcess in aoProcesses:
+        if oProcess.exitcode is None:
+          continue;
+        oSelf.__oPropertyLock.fAcquire();
+        try:
+          oSelf.__aoProcesses.remove(oProcess);
+          nStartTime = oSelf.__dnStartTime_by_oProcess.pop(oProcess);
+          oStopSendConnection = oSelf.__doStopConnection_by_oProcess.pop(oProcess);
+        finally:
+          oSelf.__oPropertyLock.fRelease();
+        fShowDebugOutput(oSelf, "Worker process %d exited with exit code %d." % (oProcess.pid, oProcess.exitcode));
+        oSelf.fFireCallbacks("worker process exited", uProcessId = oProcess.pid, iExitCode = oProcess.exitcode);
+        oProcess.close();
+        oStopSendConnection.close();
+        if oSelf.__bStopping:
+          continue;
+        nLifetimeInSeconds = time.time() - nStartTime;
+        if nLifetimeInSeconds < gnMinimumProcessLifetimeBeforeRestartInSeconds:
+          time.sleep(gnMinimumProcessLifetimeBeforeRestartInSeconds - nLifetimeInSeconds);
+        oSelf.__uNumberOfRestartedProcesses += 1;
+        oSelf.__fStartProcess();
+    oSelf.__oListeningPythonSocket.close();
+    oSelf.__oTerminatedLock.fRelease();
+    fShowDebugOutput("cMultiProcessServer terminated.");
+    oSelf.fFireCallbacks("terminated");
+  
+  @ShowDebugOutput
+  def fStop(oSelf):
+    # Let all worker processes complete the requests they are handling and
+    # exit. Worker processes that have not exited after the drain timeout are
+    # terminated.
+    if oSelf.__bStopping:
+      return fShowDebugOutput("Already stopping");
+    fShowDebugOutput("Stopping...");
+    oSelf.__fStopAllProcesses();
+    if oSelf.__n0DrainTimeoutInSeconds is not None:
+      # The worker processes terminate their server after the drain timeout;
+      # this is in case they do not exit after that.
+      cThread(oSelf.__fTerminateProcessesAfterTimeout, oSelf.__n0DrainTimeoutInSeconds * 2).fStart();
+  
+  def __fTerminateProcessesAfterTimeout(oSelf, nTimeoutInSeconds):
+    if not oSelf.fbWait(nTimeoutInSeconds):
+      oSelf.fTerminate();
+  
+  @ShowDebugOutput
+  def fTerminate(oSelf):
+    if oSelf.bTerminated:
+      return fShowDebugOutput("Already terminated");
+    fShowDebugOutput("Terminating...");
+    oSelf.__fStopAllProcesses();
+    oSelf.__oPropertyLock.fAcquire();
+    try:
+      aoProcesses = oSelf.__aoProcesses[:];
+    finally:
+      oSelf.__oPropertyLock.fRelease();
+    for oProcess in aoProcesses:
+      try:
+        oProcess.terminate();
+      except ValueError:
+        pass; # The supervisor thread closed it after it exited.
+  
+  @ShowDebugOutput
+  def fbWait(oSelf, bTimeoutInSeconds):
+    return oSelf.__oTerminatedLock.fbWait(bTimeoutInSeconds);
+  
+  def fasGetDetails(oSelf):
+    bTerminated = oSelf.bTerminated;
+    return [s for s in [
+      "%s:%d" % (str(oSelf.__sbHostname, "ascii", "strict"), oSelf.__uPortNumber),
+      "%d processes" % oSelf.uProcessesCount if not bTerminated else None,
+      "SO_REUSEPORT" if oSelf.__bReusePort else None,
+      "terminated" if bTerminated else
+          "stopping" if oSelf.__bStopping else None,
+    ] if s];
+  
+  def __repr__(oSelf):
+    sModuleName = ".".join(oSelf.__class__.__module__.split(".")[:-1]);
+    return "<%s.%s#%X|%s>" % (sModuleName, oSelf.__class__.__name__, id(oSelf), "|".join(oSelf.fasGetDetails()));
+  
+  def __str__(oSelf):
+    return "%s#%X{%s}" % (oSelf.__class__.__name__, id(oSelf), ", ".join(oSelf.fasGetDetails()));
@@ -0,0 +1,15 @@
+class cSSLContextWithSession(object):
+  # Wraps an ssl.SSLContext so that connections that asyncio secures with it
+  # try to resume the given TLS session. asyncio does not let us provide a
+  # session, but it creates the SSL object for a connection by calling
+  # `wrap_bio` on the context, so we can provide it there. Everything else is
+  # forwarded to the wrapped context.
+  def __init__(oSelf, oSSLContext, oSSLSession):
+    oSelf.__oSSLContext = oSSLContext;
+    oSelf.__oSSLSession = oSSLSession;
+  
+  def wrap_bio(oSelf, *txArguments, **dxArguments):
+    return oSelf.__oSSLContext.wrap_bio(*txArguments, session = oSelf.__oSSLSession, **dxArguments);
+  
+  def __getattr__(oSelf, sName):
+    return getattr(oSelf.__oSSLContext, sName);
@@ -0,0 +1,450 @@
+import queue, selectors, socket, time;
+
+from mHTTPProtocol import cInvalidMessageException;
+from mMultiThreading import (
+  cLock,
+  cThread,
+);
+from mNotProvided import (
+  fxGetFirstProvidedValue,
+  zNotProvided,
+);
+from mTCPIPConnection import (
+  cTCPIPConnectionShutdownException,
+  cTCPIPConnectionDisconnectedException,
+);
+
+from .cConnection import cConnection;
+from .cConnectionAcceptor import cConnectionAcceptor;
+from .cWithLazyCallbacks import cWithLazyCallbacks;
+from .mOptionalDebugOutput import (
+  fShowDebugOutput,
+  ShowDebugOutput,
+);
+
+gnDeadlockTimeoutInSeconds = 1; # We're not doing anything time consuming, so this should suffice.
+guDefaultMaxNumberOfWorkerThreads = 32;
+gn0DefaultIdleTimeoutInSeconds = 60;
+
+# A HTTP server on top of cConnectionAcceptor. Requests are handled by a fixed
+# number of worker threads, which call `fxRequestHandler(oServer, oConnection,
+# oRequest)` and send the response it returns. Connections are kept alive
+# between requests unless the request or response has a "Connection: close"
+# header. While a connection is idle, it does not hold a worker thread: it is
+# watched by a single selector thread, which hands it to a worker once a new
+# request arrives, or disconnects it once it has been idle for longer than
+# n0zIdleTimeoutInSeconds.
+# Instead of creating a cConnectionAcceptor, the server can accept connections
+# on a listening socket that is provided by the caller, which allows multiple
+# processes to accept connections on the same port (see cMultiProcessServer).
+# If bzCompressResponses is True, response bodies are compressed while they are
+# sent if the client accepts this (see cConnection.fSendResponse).
+class cServer(cWithLazyCallbacks):
+  @ShowDebugOutput
+  def __init__(oSelf,
+    fxRequestHandler,
+    *,
+    sbzHostname = zNotProvided,
+    uzPortNumber = zNotProvided,
+    o0SSLContext = None,
+    o0ListeningPythonSocket = None,
+    uzMaxNumberOfWorkerThreads = zNotProvided,
+    n0zIdleTimeoutInSeconds = zNotProvided,
+    n0zTransactionTimeoutInSeconds = zNotProvided,
+    bzCompressResponses = zNotProvided,
+    uzCompressionLevel = zNotProvided,
+  ):
+    oSelf.__fxRequestHandler = fxRequestHandler;
+    oSelf.__uMaxNumberOfWorkerThreads = fxGetFirstProvidedValue(uzMaxNumberOfWorkerThreads, guDefaultMaxNumberOfWorkerThreads);
+    assert oSelf.__uMaxNumberOfWorkerThreads > 0, \
+        "uzMaxNumberOfWorkerThreads must be at least 1, not %d" % oSelf.__uMaxNumberOfWorkerThreads;
+    oSelf.__n0IdleTimeoutInSeconds = fxGetFirstProvidedValue(n0zIdleTimeoutInSeconds, gn0DefaultIdleTimeoutInSeconds);
+    oSelf.__n0TransactionTimeoutInSeconds = fxGetFirstProvidedValue(n0zTransactionTimeoutInSeconds, cConnection.n0DefaultTransactionTimeoutInSeconds);
+    oSelf.__bCompressResponses = fxGetFirstProvidedValue(bzCompressResponses, False);
+    oSelf.__uCompressionLevel = fxGetFirstProvidedValue(uzCompressionLevel, cConnection.uDefaultCompressionLevel);
+  
+    oSelf.__oPropertyLock = cLock(
+      "%s.__oPropertyLock" % oSelf.__class__.__name__,
+      n0DeadlockTimeoutInSeconds = gnDeadlockTimeoutInSeconds
+    );
+    oSelf.__aoConnections = []; # All connections that have not terminated.
+    # Connections that are ready to be handled by a worker thread; a None
+    # value tells a worker thread to stop.
+    oSelf.__oReadyConnectionsQueue = queue.Queue();
+    # Connections that should be watched by the selector thread. Only the
+    # selector thread can safely (un)register connections with the selector,
+    # so other threads add them to this list and wake it.
+    oSelf.__aoConnectionsToBeWatched = [];
+    oSelf.__oSelector = selectors.DefaultSelector();
+    (oSelf.__oWakeSelectorReceiveSocket, oSelf.__oWakeSelectorSendSocket) = socket.socketpair();
+    oSelf.__oWakeSelectorReceiveSocket.setblocking(False);
+    oSelf.__oWakeSelectorSendSocket.setblocking(False);
+    oSelf.__oSelector.register(oSelf.__oWakeSelectorReceiveSocket, selectors.EVENT_READ);
+    # The connections that are being watched by the selector thread, in the
+    # order in which they became idle, with their socket's file number and the
+    # time at which they time out. Since they all have the same timeout, the
+    # first one always times out first. Only used by the selector thread.
+    oSelf.__dtxFileNumberAndTimeout_by_oWatchedConnection = {};
+    oSelf.__uRunningThreadsCount = 0;
+    oSelf.__bStopping = False;
+    oSelf.__oTerminatedLock = cLock(
+      "%s.__oTerminatedLock" % oSelf.__class__.__name__,
+      bLocked = True
+    );
+  
+    oSelf.fAddEvents(
+      "accepted connection from client",
+      "terminated connection from client",
+      "idle connection from client timed out",
+  
+      "received request from client",
+      "request handler exception",
+      "sent response to client",
+      "handling connection from client failed",
+  
+      "terminated"
+    );
+  
+    oSelf.__o0ListeningPythonSocket = o0ListeningPythonSocket;
+    if o0ListeningPythonSocket is None:
+      # Connections accepted before the threads are started will be handled
+      # once they are.
+      oSelf.__o0ConnectionAcceptor = cConnectionAcceptor(
+        fNewConnectionHandler = oSelf.__fHandleNewConnection,
+        sbzHostname = sbzHostname,
+        uzPortNumber = uzPortNumber,
+        o0SSLContext = o0SSLContext,
+      );
+      oSelf.__o0ConnectionAcceptor.fAddCallback("terminated", oSelf.__fHandleTerminatedCallbackFromConnectionAcceptor);
+    else:
+      assert sbzHostname is zNotProvided and uzPortNumber is zNotProvided, \
+          "sbzHostname and uzPortNumber cannot be provided with o0ListeningPythonSocket";
+      # Securing accepted connections is done by cConnectionAcceptor.
+      assert o0SSLContext is None, \
+          "o0SSLContext cannot be provided with o0ListeningPythonSocket";
+      oSelf.__o0ConnectionAcceptor = None;
+      # New connections are accepted by the selector thread.
+      o0ListeningPythonSocket.setblocking(False);
+      oSelf.__oSelector.register(o0ListeningPythonSocket, selectors.EVENT_READ);
+    for uIndex in range(oSelf.__uMaxNumberOfWorkerThreads):
+      oSelf.__fStartThread(oSelf.__fWorkerThread);
+    oSelf.__fStartThread(oSelf.__fIdleConnectionsSelectorThread);
+  
+  @property
+  def o0ConnectionAcceptor(oSelf):
+    return oSelf.__o0ConnectionAcceptor;
+  
+  @property
+  def bTerminated(oSelf):
+    return not oSelf.__oTerminatedLock.bLocked;
+  
+  @property
+  def uConnectionsCount(oSelf):
+    return len(oSelf.__aoConnections);
+  
+  @property
+  def uReadyConnectionsCount(oSelf):
+    # The number of connections with a request that are waiting for a worker thread.
+    return oSelf.__oReadyConnectionsQueue.qsize();
+  
+  def __fStartThread(oSelf, fThread):
+    oSelf.__oPropertyLock.fAcquire();
+    try:
+      oSelf.__uRunningThreadsCount += 1;
+    finally:
+      oSelf.__oPropertyLock.fRelease();
+    cThread(oSelf.__fRunThread, fThread).fStart();
+  
+  def __fRunThread(oSelf, fThread):
+    try:
+      fThread();
+    finally:
+      oSelf.__oPropertyLock.fAcquire();
+      try:
+        oSelf.__uRunningThreadsCount -= 1;
+      finally:
+        oSelf.__oPropertyLock.fRelease();
+      oSelf.__fReportTerminatedIfNothingIsRunning();
+  
+  @ShowDebugOutput
+  def __fHandleNewConnection(oSelf, oConnectionAcceptor, oConnection):
+    oSelf.__oPropertyLock.fAcquire();
+    try:
+      bStopping = oSelf.__bStopping;
+      if not bStopping:
+        oSelf.__aoConnections.append(oConnection);
+    finally:
+      oSelf.__oPropertyLock.fRelease();
+    if bStopping:
+      oConnection.fDisconnect();
+      return;
+    oConnection.fAddCallback("terminated", oSelf.__fHandleTerminatedCallbackFromConnection);
+    oSelf.fFireCallbacks("accepted connection from client", oConnection = oConnection);
+    # The client may not send a request right away, so we wait for that
+    # without holding a worker thread.
+    oSelf.__fWatchIdleConnection(oConnection);
+  
+  @ShowDebugOutput
+  def __fHandleTerminatedCallbackFromConnection(oSelf, oConnection):
+    oSelf.__oPropertyLock.fAcquire();
+    try:
+      oSelf.__aoConnections.remove(oConnection);
+    finally:
+      oSelf.__oPropertyLock.fRelease();
+    oSelf.fFireCallbacks("terminated connection from client", oConnection = oConnection);
+  
+  @ShowDebugOutput
+  def __fHandleTerminatedCallbackFromConnectionAcceptor(oSelf, oConnectionAcceptor):
+    oSelf.__fReportTerminatedIfNothingIsRunning();
+  
+  def __fWatchIdleConnection(oSelf, oConnection):
+    oSelf.__oPropertyLock.fAcquire();
+    try:
+      oSelf.__aoConnectionsToBeWatched.append(oConnection);
+    finally:
+      oSelf.__oPropertyLock.fRelease();
+    oSelf.__fWakeSelectorThread();
+  
+  def __fWakeSelectorThread(oSelf):
+    try:
+      oSelf.__oWakeSelectorSendSocket.send(b"\0");
+    except (BlockingIOError, OSError):
+      pass; # It is already awake, or we are terminating.
+  
+  def __fIdleConnectionsSelectorThread(oSelf):
+    dtxFileNumberAndTimeout_by_oWatchedConnection = oSelf.__dtxFileNumberAndTimeout_by_oWatchedConnection;
+    while not oSelf.__bStopping:
+      for oConnection in oSelf.__faoGetConnectionsToBeWatched():
+        oSelf.__fStartWatchingConnection(oConnection);
+      # Wait until a connection becomes readable or the first one times out.
+      n0FirstTimeout = next(iter(dtxFileNumberAndTimeout_by_oWatchedConnection.values()), (None, None))[1];
+      atoKeyAndEvents = oSelf.__oSelector.select(
+        max(0, n0FirstTimeout - time.time()) if n0FirstTimeout is not None else None
+      );
+      for (oKey, uEvents) in atoKeyAndEvents:
+        if oKey.fileobj is oSelf.__oWakeSelectorReceiveSocket:
+          try:
+            oSelf.__oWakeSelectorReceiveSocket.recv(4096);
+          except BlockingIOError:
+            pass;
+          continue;
+        if oKey.fileobj is oSelf.__o0ListeningPythonSocket:
+          oSelf.__fAcceptNewConnections();
+          continue;
+        oConnection = oKey.data;
+        oSelf.__fStopWatchingConnection(oConnection);
+        # Either there is a new request, or the connection was closed; the
+        # worker thread handles both.
+        oSelf.__oReadyConnectionsQueue.put(oConnection);
+      nNow = time.time();
+      for (oConnection, (uFileNumber, n0Timeout)) in list(dtxFileNumberAndTimeout_by_oWatchedConnection.items()):
+        if n0Timeout is None or n0Timeout > nNow:
+          break;
+        oSelf.__fStopWatchingConnection(oConnection);
+        fShowDebugOutput(oSelf, "Idle connection timed out: %s." % oConnection);
+        oSelf.fFireCallbacks("idle connection from client timed out", oConnection = oConnection);
+        oConnection.fDisconnect();
+    # We are stopping: idle connections can be disconnected.
+    for oConnection in list(dtxFileNumberAndTimeout_by_oWatchedConnection.keys()) + oSelf.__faoGetConnectionsToBeWatched():
+      oConnection.fDisconnect();
+    oSelf.__oSelector.close();
+    if oSelf.__o0ListeningPythonSocket is not None:
+      oSelf.__o0ListeningPythonSocket.close();
+    oSelf.__oWakeSelectorReceiveSocket.close();
+    oSelf.__oWakeSelectorSendSocket.close();
+  
+  def __fAcceptNewConnections(oSelf):
+    # Only called by the selector thread. Other processes may be accepting
+    # connections on the same socket, so there may be none left to accept.
+    while not oSelf.__bStopping:
+      try:
+        (oPythonSocket, txRemoteAddress) = oSelf.__o0ListeningPythonSocket.accept();
+      except (BlockingIOError, InterruptedError):
+        return;
+      except OSError as oException:
+        fShowDebugOutput(oSelf, "Cannot accept connection: %s." % oException);
+        return;
+      oPythonSocket.setblocking(True);
+      oSelf.__fHandleNewConnection(None, cConnection(oPythonSocket, bCreatedLocally = False));
+  
+  def __faoGetConnectionsToBeWatched(oSelf):
+    oSelf.__oPropertyLock.fAcquire();
+    try:
+      aoConnectionsToBeWatched = oSelf.__aoConnectionsToBeWatched;
+      oSelf.__aoConnectionsToBeWatched = [];
+    finally:
+      oSelf.__oPropertyLock.fRelease();
+    return aoConnectionsToBeWatched;
+  
+  def __fStartWatchingConnection(oSelf, oConnection):
+    # Only called by the selector thread.
+    try:
+      uFileNumber = oConnection.oPythonSocket.fileno();
+    except OSError:
+      return; # The socket was closed, which means the connection terminated.
+    if uFileNumber == -1:
+      return; # The socket was closed, which means the connection terminated.
+    try:
+      oSelf.__oSelector.register(uFileNumber, selectors.EVENT_READ, oConnection);
+    except KeyError:
+      # The file number is still registered for a connection that terminated
+      # while it was idle, after which the OS reused it for this connection.
+      oSelf.__fStopWatchingConnection(oSelf.__oSelector.get_key(uFileNumber).data);
+      oSelf.__oSelector.register(uFileNumber, selectors.EVENT_READ, oConnection);
+    oSelf.__dtxFileNumberAndTimeout_by_oWatchedConnection[oConnection] = (
+      uFileNumber,
+      time.time() + oSelf.__n0IdleTimeoutInSeconds if oSelf.__n0IdleTimeoutInSeconds is not None else None,
+    );
+  
+  def __fStopWatchingConnection(oSelf, oConnection):
+    # Only called by the selector thread.
+    (uFileNumber, n0Timeout) = oSelf.__dtxFileNumberAndTimeout_by_oWatchedConnection.pop(oConnection);
+    try:
+      oKey = oSelf.__oSelector.get_key(uFileNumber);
+    except KeyError:
+      return;
+    # If the connection terminated, its file number may have been reused.
+    if oKey.data is oConnection:
+      oSelf.__oSelector.unregister(uFileNumber);
+  
+  def __fWorkerThread(oSelf):
+    while 1:
+      o0Connection = oSelf.__oReadyConnectionsQueue.get();
+      if o0Connection is None:
+        return; # We are stopping.
+      oConnection = o0Connection;
+      try:
+        bKeepAlive = oSelf.__fbHandleRequestsOnConnection(oConnection);
+      except Exception as oException:
+        # Any exception we do not expect (e.g. because the request handler did
+        # not return a response) would otherwise stop this worker thread for
+        # good, until there are none left to handle requests.
+        oSelf.fFireCallbacks("handling connection from client failed", oConnection = oConnection, oException = oException);
+        oConnection.fTerminate();
+        continue;
+      if bKeepAlive:
+        if oSelf.__bStopping:
+          oConnection.fDisconnect();
+        else:
+          oSelf.__fWatchIdleConnection(oConnection);
+  
+  @ShowDebugOutput
+  def __fbHandleRequestsOnConnection(oSelf, oConnection):
+    # Handle requests until the connection is idle or closed.
+    # Returns True if the connection should be kept alive.
+    while 1:
+      if oSelf.__bStopping:
+        oConnection.fDisconnect();
+        return False;
+      try:
+        oConnection.fStartTransaction(n0TimeoutInSeconds = oSelf.__n0TransactionTimeoutInSeconds);
+      except (cTCPIPConnectionShutdownException, cTCPIPConnectionDisconnectedException):
+        return False;
+      try:
+        try:
+          oRequest = oConnection.foReceiveRequest();
+        except (cTCPIPConnectionShutdownException, cTCPIPConnectionDisconnectedException, cInvalidMessageException) as oException:
+          fShowDebugOutput(oSelf, "Cannot receive request on %s: %s." % (oConnection, oException));
+          return False; # foReceiveRequest has terminated the connection.
+        oSelf.fFireCallbacks("received request from client", oConnection = oConnection, oRequest = oRequest);
+        try:
+          oResponse = oSelf.__fxRequestHandler(oSelf, oConnection, oRequest);
+        except Exception as oException:
+          oSelf.fFireCallbacks("request handler exception", oConnection = oConnection, oRequest = oRequest, oException = oException);
+          oConnection.fTerminate();
+          return False;
+        try:
+          oConnection.fSendResponse(
+            oResponse,
+            bCompressBody = oSelf.__bCompressResponses,
+            uzCompressionLevel = oSelf.__uCompressionLevel,
+          );
+        except (cTCPIPConnectionShutdownException, cTCPIPConnectionDisconnectedException):
+          return False; # fSendResponse has terminated the connection.
+        oSelf.fFireCallbacks("sent response to client", oConnection = oConnection, oRequest = oRequest, oResponse = oResponse);
+      finally:
+        if oConnection.bInTransaction:
+          oConnection.fEndTransaction();
+      if oRequest.fbHasConnectionCloseHeader() or oResponse.fbHasConnectionCloseHeader():
+        oConnection.fDisconnect();
+        return False;
+      try:
+        if not oConnection.fbBytesAreAvailableForReading():
+          return True;
+      except (cTCPIPConnectionShutdownException, cTCPIPConnectionDisconnectedException):
+        return False;
+      # The client has already sent another request (pipelining): handle it.
+  
+  @ShowDebugOutput
+  def __fReportTerminatedIfNothingIsRunning(oSelf):
+    if not oSelf.__bStopping:
+      return;
+    oSelf.__oPropertyLock.fAcquire();
+    try:
+      if oSelf.__uRunningThreadsCount > 0 or (
+        oSelf.__o0ConnectionAcceptor is not None and not oSelf.__o0ConnectionAcceptor.bTerminated
+      ):
+        return;
+      if not oSelf.__oTerminatedLock.bLocked:
+        return; # Already terminated
+      oSelf.__oTerminatedLock.fRelease();
+    finally:
+      oSelf.__oPropertyLock.fRelease();
+    fShowDebugOutput("cServer terminated.");
+    oSelf.fFireCallbacks("terminated");
+  
+  def __fStopThreads(oSelf):
+    oSelf.__fWakeSelectorThread();
+    for uIndex in range(oSelf.__uMaxNumberOfWorkerThreads):
+      oSelf.__oReadyConnectionsQueue.put(None);
+  
+  @ShowDebugOutput
+  def fStop(oSelf):
+    # Stop accepting connections and disconnect idle connections; requests
+    # that are being handled are completed first.
+    if oSelf.__bStopping:
+      return fShowDebugOutput("Already stopping");
+    fShowDebugOutput("Stopping...");
+    oSelf.__bStopping = True;
+    if oSelf.__o0ConnectionAcceptor is not None:
+      oSelf.__o0ConnectionAcceptor.fStop();
+    oSelf.__fStopThreads();
+    oSelf.__fReportTerminatedIfNothingIsRunning();
+  
+  @ShowDebugOutput
+  def fTerminate(oSelf):
+    if oSelf.bTerminated:
+      return fShowDebugOutput("Already terminated");
+    fShowDebugOutput("Terminating...");
+    oSelf.__bStopping = True;
+    if oSelf.__o0ConnectionAcceptor is not None:
+      oSelf.__o0ConnectionAcceptor.fTerminate();
+    oSelf.__oPropertyLock.fAcquire();
+    try:
+      aoConnections = oSelf.__aoConnections[:];
+    finally:
+      oSelf.__oPropertyLock.fRelease();
+    for oConnection in aoConnections:
+      oConnection.fTerminate();
+    oSelf.__fStopThreads();
+    oSelf.__fReportTerminatedIfNothingIsRunning();
+  
+  @ShowDebugOutput
+  def fbWait(oSelf, bTimeoutInSeconds):
+    return oSelf.__oTerminatedLock.fbWait(bTimeoutInSeconds);
+  
+  def fasGetDetails(oSelf):
+    bTerminated = oSelf.bTerminated;
+    return [s for s in [
+      "%d connections" % oSelf.uConnectionsCount if not bTerminated else None,
+      "%d worker threads" % oSelf.__uMaxNumberOfWorkerThreads,
+      "terminated" if bTerminated else
+          "stopping" if oSelf.__bStopping else None,
+    ] if s];
+  
+  def __repr__(oSelf):
+    sModuleName = ".".join(oSelf.__class__.__module__.split(".")[:-1]);
+    return "<%s.%s#%X|%s>" % (sModuleName, oSelf.__class__.__name__, id(oSelf), "|".join(oSelf.fasGetDetails()));
+  
+  def __str__(oSelf):
+    return "%s#%X{%s}" % (oSelf.__class__.__name__, id(oSelf), ", ".join(oSelf.fasGetDetails()));
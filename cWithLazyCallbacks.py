@@ -0,0 +1,38 @@
+from mMultiThreading import cWithCallbacks;
+
+class cWithLazyCallbacks(cWithCallbacks):
+  # cWithCallbacks that keeps track of the events for which callbacks have been
+  # added, so firing an event that has no callbacks costs no more than a set
+  # lookup. Callbacks that are removed later are not tracked; the only effect
+  # of that is that firing their event is no longer this cheap.
+  # Sub-classes can override fHandleFirstCallbackAddedForEvent to do work that
+  # is only needed once someone is interested in an event (e.g. forward it from
+  # other objects).
+  # This is replaced rather than modified, so it can be read without a lock.
+  __asEventNamesWithCallbacks = frozenset();
+  
+  def fAddCallback(oSelf, sEventName, *txArguments, **dxArguments):
+    super().fAddCallback(sEventName, *txArguments, **dxArguments);
+    oSelf.__fRecordCallbackAddedForEvent(sEventName);
+  
+  def fAddCallbacks(oSelf, dfCallback_by_sEventName, *txArguments, **dxArguments):
+    super().fAddCallbacks(dfCallback_by_sEventName, *txArguments, **dxArguments);
+    for sEventName in dfCallback_by_sEventName:
+      oSelf.__fRecordCallbackAddedForEvent(sEventName);
+  
+  def __fRecordCallbackAddedForEvent(oSelf, sEventName):
+    if sEventName in oSelf.__asEventNamesWithCallbacks:
+      return;
+    oSelf.__asEventNamesWithCallbacks = oSelf.__asEventNamesWithCallbacks | {sEventName};
+    oSelf.fHandleFirstCallbackAddedForEvent(sEventName);
+  
+  def fbHasCallbacksForEvent(oSelf, sEventName):
+    return sEventName in oSelf.__asEventNamesWithCallbacks;
+  
+  def fHandleFirstCallbackAddedForEvent(oSelf, sEventName):
+    pass;
+  
+  def fFireCallbacks(oSelf, sEventName, *txArguments, **dxArguments):
+    if sEventName not in oSelf.__asEventNamesWithCallbacks:
+      return;
+    super().fFireCallbacks(sEventName, *txArguments, **dxArguments);
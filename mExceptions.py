@@ -1,3 +1,5 @@
+from mTCPIPConnection import cTCPIPDNSUnknownHostnameException;
+
 class cConnectionException(Exception):
   def __init__(oSelf, sMessage, *, o0Connection = None, dxDetails = None):
     assert isinstance(dxDetails, dict), \
@@ -17,14 +19,29 @@ class cConnectionException(Exception):
   def __repr__(oSelf):
     return "<%s.%s %s>" % (oSelf.__class__.__module__, oSelf.__class__.__name__, oSelf);
 
+class cBodySourceSizeMismatchException(cConnectionException):
+  pass;
+
+# Thrown by cDNSCache; it is also a cTCPIPDNSUnknownHostnameException, so code
+# that handles the exception thrown by mTCPIPConnection when it resolves a
+# hostname itself also handles this one.
+class cDNSUnknownHostnameException(cConnectionException, cTCPIPDNSUnknownHostnameException):
+  pass;
+
 class cMaximumNumberOfConnectionsToServerReachedException(cConnectionException):
   pass;
 
 class cConnectionOutOfBandDataException(cConnectionException):
   pass;
 
+class cConnectionShutdownException(cConnectionException):
+  pass;
+
 __all__ = [
+  "cBodySourceSizeMismatchException",
   "cConnectionException",
   "cConnectionOutOfBandDataException",
+  "cConnectionShutdownException",
+  "cDNSUnknownHostnameException",
   "cMaximumNumberOfConnectionsToServerReachedException",
 ];
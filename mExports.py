@@ -1,17 +1,39 @@
+from .cAsyncConnection import cAsyncConnection;
+from .cAsyncConnectionsToServerPool import cAsyncConnectionsToServerPool;
 from .cConnection import cConnection;
 from .cConnectionAcceptor import cConnectionAcceptor;
 from .cConnectionsToServerPool import cConnectionsToServerPool;
+from .cConnectionsToServersManager import cConnectionsToServersManager;
+from .cDNSCache import cDNSCache;
+from .cHTTPCache import cHTTPCache;
+from .cMetrics import cMetrics;
+from .cMultiProcessServer import cMultiProcessServer;
+from .cServer import cServer;
 from .mExceptions import (
+  cBodySourceSizeMismatchException,
   cConnectionException,
   cConnectionOutOfBandDataException,
+  cConnectionShutdownException,
+  cDNSUnknownHostnameException,
   cMaximumNumberOfConnectionsToServerReachedException,
 );
 
 __all__ = [
+  "cAsyncConnection",
+  "cAsyncConnectionsToServerPool",
+  "cBodySourceSizeMismatchException",
   "cConnection",
   "cConnectionAcceptor",
   "cConnectionException",
   "cConnectionOutOfBandDataException",
+  "cConnectionShutdownException",
   "cConnectionsToServerPool",
+  "cConnectionsToServersManager",
+  "cDNSCache",
+  "cDNSUnknownHostnameException",
+  "cHTTPCache",
   "cMaximumNumberOfConnectionsToServerReachedException",
+  "cMetrics",
+  "cMultiProcessServer",
+  "cServer",
 ];
\ No newline at end of file
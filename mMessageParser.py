@@ -0,0 +1,387 @@
+from mHTTPProtocol import (
+  cHeaders,
+  cInvalidMessageException,
+);
+
+from .mOptionalDebugOutput import (
+  fShowDebugOutput,
+  gbShowDebugOutput,
+);
+
+# The functions in this module parse HTTP messages without doing any I/O
+# themselves, so cConnection and cAsyncConnection can share them: they are
+# generators that yield the operations they need performed and are sent the
+# result of each operation. The caller performs the operations using blocking
+# or asyncio I/O until the generator returns its result.
+# Operations are tuples that start with one of these values:
+# (guReadUntilMarker, sbMarker, u0MaxNumberOfBytes) -> the bytes up to and
+#     including the marker, or None if the marker was not found within the
+#     maximum number of bytes, in which case nothing is read.
+guReadUntilMarker = 1;
+# (guReadBufferedData,) -> all bytes that have been buffered but not read yet.
+guReadBufferedData = 2;
+# (guReadBytes, uNumberOfBytes) -> exactly that many bytes.
+guReadBytes = 3;
+# (guReadBytesUntilShutdown, uNumberOfBytes) -> (sbBytes, bShutdown): that many
+#     bytes, or fewer if the connection was shut down by the remote first.
+guReadBytesUntilShutdown = 4;
+# (guBodyPart, sbBodyPart) -> None: the next part of the message body.
+guBodyPart = 5;
+
+# The start line and headers are only read at once if they are no larger than
+# this; larger ones are read line by line (see
+# `fiterParseStartLineAndHeadersAtOnce`).
+guMaxHeadSizeToReadAtOnce = 64*1024;
+# Bodies that are read until the connection is shut down are read in parts of
+# this size if no read size is provided.
+guDefaultReadSize = 64*1024;
+
+def fiterParseStartLineAndHeaders(
+  cMessage,
+  *,
+  u0MaxStartLineSize,
+  u0MaxHeaderLineSize,
+  u0MaxNumberOfHeaders,
+  o0Connection = None,
+):
+  # Parse the start line and headers of a HTTP message.
+  # Returns the start line arguments for the cMessage constructor and the
+  # headers (or None if there are none).
+  # Can throw an invalid message exception.
+  t0xStartLineArgumentsAndHeaders = yield from fiterParseStartLineAndHeadersAtOnce(
+    cMessage,
+    u0MaxStartLineSize = u0MaxStartLineSize,
+    u0MaxHeaderLineSize = u0MaxHeaderLineSize,
+    u0MaxNumberOfHeaders = u0MaxNumberOfHeaders,
+    o0Connection = o0Connection,
+  );
+  if t0xStartLineArgumentsAndHeaders is not None:
+    return t0xStartLineArgumentsAndHeaders;
+  fShowDebugOutput("Reading start line...");
+  sb0StartLineCRLF = yield (guReadUntilMarker, b"\r\n", u0MaxStartLineSize);
+  if sb0StartLineCRLF is None:
+    sbStartLine = yield (guReadBufferedData,);
+    raise cInvalidMessageException(
+      "The start line was too large.",
+      o0Connection = o0Connection,
+      dxDetails = {"sbStartLine": sbStartLine, "u0MaxStartLineSize": u0MaxStartLineSize},
+    );
+  dxConstructorStartLineArguments = cMessage.fdxDeserializeStartLine(sb0StartLineCRLF[:-2]);
+  fShowDebugOutput("Reading headers...");
+  asbHeaderLines = [];
+  while 1:
+    sb0HeaderLineCRLF = yield (guReadUntilMarker, b"\r\n", u0MaxHeaderLineSize);
+    if sb0HeaderLineCRLF is None:
+      sbHeaderLine = yield (guReadBufferedData,);
+      raise cInvalidMessageException(
+        "A header line was too large.",
+        o0Connection = o0Connection,
+        dxDetails = {"sbHeaderLine": sbHeaderLine, "u0MaxHeaderLineSize": u0MaxHeaderLineSize},
+      );
+    sbHeaderLine = sb0HeaderLineCRLF[:-2];
+    if len(sbHeaderLine) == 0:
+      break; # Empty line == end of headers
+    if u0MaxNumberOfHeaders is not None and len(asbHeaderLines) == u0MaxNumberOfHeaders:
+      raise cInvalidMessageException(
+        "The number of headers was larger than the maximum accepted.",
+        o0Connection = o0Connection,
+        dxDetails = {"uMaxNumberOfHeaders": u0MaxNumberOfHeaders},
+      );
+    asbHeaderLines.append(sbHeaderLine);
+  return (
+    dxConstructorStartLineArguments,
+    cHeaders.foDeserializeLines(asbHeaderLines) if asbHeaderLines else None,
+  );
+
+def fiterParseStartLineAndHeadersAtOnce(
+  cMessage,
+  *,
+  u0MaxStartLineSize,
+  u0MaxHeaderLineSize,
+  u0MaxNumberOfHeaders,
+  o0Connection = None,
+):
+  # Reading the start line and each header line separately means scanning
+  # the buffer and copying data once for every line. Instead, we read up to
+  # the empty line that ends the headers at once and split that into lines,
+  # then check the size of each line and the number of headers.
+  # This is only done if the limits set a maximum size for all of it. We also
+  # never look further than guMaxHeadSizeToReadAtOnce bytes for the end of
+  # the headers, so we buffer at most that much more data than we would
+  # reading line by line (which would detect a line that is too large as soon
+  # as its maximum size is buffered). If the end of the headers is not found
+  # within that size, nothing is read and None is returned; the caller should
+  # then read line by line to enforce the limits.
+  # Returns the start line arguments for the cMessage constructor and the
+  # headers (or None if there are none), or None.
+  if u0MaxStartLineSize is None or u0MaxHeaderLineSize is None or u0MaxNumberOfHeaders is None:
+    return None;
+  # The start line and header lines each end with CRLF, followed by the
+  # CRLF of the empty line.
+  uMaxHeadSize = min(
+    u0MaxStartLineSize + u0MaxNumberOfHeaders * u0MaxHeaderLineSize + 2,
+    guMaxHeadSizeToReadAtOnce,
+  );
+  fShowDebugOutput("Reading start line and headers...");
+  sb0Head = yield (guReadUntilMarker, b"\r\n\r\n", uMaxHeadSize);
+  if sb0Head is None:
+    return None;
+  asbLines = sb0Head[:-4].split(b"\r\n");
+  sbStartLine = asbLines[0];
+  if len(sbStartLine) + 2 > u0MaxStartLineSize:
+    raise cInvalidMessageException(
+      "The start line was too large.",
+      o0Connection = o0Connection,
+      dxDetails = {"sbStartLine": sbStartLine, "u0MaxStartLineSize": u0MaxStartLineSize},
+    );
+  asbHeaderLines = asbLines[1:];
+  if len(asbHeaderLines) > u0MaxNumberOfHeaders:
+    raise cInvalidMessageException(
+      "The number of headers was larger than the maximum accepted.",
+      o0Connection = o0Connection,
+      dxDetails = {"uMaxNumberOfHeaders": u0MaxNumberOfHeaders},
+    );
+  for sbHeaderLine in asbHeaderLines:
+    if len(sbHeaderLine) + 2 > u0MaxHeaderLineSize:
+      raise cInvalidMessageException(
+        "A header line was too large.",
+        o0Connection = o0Connection,
+        dxDetails = {"sbHeaderLine": sbHeaderLine, "u0MaxHeaderLineSize": u0MaxHeaderLineSize},
+      );
+  fShowDebugOutput("Parsing start line and headers...");
+  return (
+    cMessage.fdxDeserializeStartLine(sbStartLine),
+    cHeaders.foDeserializeLines(asbHeaderLines) if asbHeaderLines else None,
+  );
+
+def fiterParseBody(
+  oMessage,
+  o0Headers,
+  *,
+  u0ReadSize,
+  bRemoveChunkedEncoding,
+  u0MaxBodySize,
+  u0MaxChunkSize,
+  u0MaxNumberOfChunks,
+  u0MaxNumberOfChunksBeforeDisconnecting = None,
+  u0MaxTrailerLineSize,
+  u0MaxChunkSizeCharacters,
+  o0Connection = None,
+):
+  # Parse the body of a HTTP message, yielding it in guBodyPart operations of
+  # at most u0ReadSize bytes each (or as large as possible if None). Chunked
+  # encoding is removed from the body if bRemoveChunkedEncoding is True.
+  # Returns None if the message has no body, True if the body was read
+  # completely or False if reading stopped after
+  # u0MaxNumberOfChunksBeforeDisconnecting chunks, in which case the caller
+  # must disconnect, as the rest of the body cannot be skipped.
+  # Can throw an invalid message exception.
+  if oMessage.fbHasChunkedEncodingHeader():
+    return (yield from fiterParseChunkedBody(
+      u0ReadSize = u0ReadSize,
+      bRemoveChunkedEncoding = bRemoveChunkedEncoding,
+      u0MaxBodySize = u0MaxBodySize,
+      u0MaxChunkSize = u0MaxChunkSize,
+      u0MaxNumberOfChunks = u0MaxNumberOfChunks,
+      u0MaxNumberOfChunksBeforeDisconnecting = u0MaxNumberOfChunksBeforeDisconnecting,
+      u0MaxTrailerLineSize = u0MaxTrailerLineSize,
+      u0MaxChunkSizeCharacters = u0MaxChunkSizeCharacters,
+      o0Connection = o0Connection,
+    ));
+  u0ContentLength = o0Headers and o0Headers.fu0GetContentLength(u0MaxBodySize);
+  if u0ContentLength is not None:
+    if gbShowDebugOutput:
+      fShowDebugOutput("Reading %d bytes message body..." % u0ContentLength);
+    uNumberOfBytesLeftInBody = u0ContentLength;
+    while uNumberOfBytesLeftInBody > 0:
+      sbBodyPart = yield (guReadBytes, uNumberOfBytesLeftInBody if u0ReadSize is None else min(u0ReadSize, uNumberOfBytesLeftInBody));
+      uNumberOfBytesLeftInBody -= len(sbBodyPart);
+      yield (guBodyPart, sbBodyPart);
+    return True;
+  if oMessage.bCanHaveBodyIfConnectionCloseHeaderIsPresent and \
+      o0Headers and oMessage.fbHasConnectionCloseHeader():
+    fShowDebugOutput("Reading message body until closed...");
+    uReadSize = u0ReadSize if u0ReadSize is not None else guDefaultReadSize;
+    uBodySize = 0;
+    bShutdown = False;
+    while not bShutdown:
+      # Try to read one byte more than allowed, so we can detect a body that is too large.
+      uNumberOfBytesToRead = uReadSize if u0MaxBodySize is None else min(uReadSize, u0MaxBodySize - uBodySize + 1);
+      (sbBodyPart, bShutdown) = yield (guReadBytesUntilShutdown, uNumberOfBytesToRead);
+      uBodySize += len(sbBodyPart);
+      if u0MaxBodySize is not None and uBodySize > u0MaxBodySize:
+        raise cInvalidMessageException(
+          "The body was larger than the maximum accepted.",
+          o0Connection = o0Connection,
+          dxDetails = {"uMaxBodySize": u0MaxBodySize, "uMinimumBodySize": uBodySize},
+        );
+      if sbBodyPart:
+        yield (guBodyPart, sbBodyPart);
+    if gbShowDebugOutput:
+      fShowDebugOutput("Message body is %d bytes." % uBodySize);
+    return True;
+  return None;
+
+def fiterParseChunkedBody(
+  *,
+  u0ReadSize,
+  bRemoveChunkedEncoding,
+  u0MaxBodySize,
+  u0MaxChunkSize,
+  u0MaxNumberOfChunks,
+  u0MaxNumberOfChunksBeforeDisconnecting,
+  u0MaxTrailerLineSize,
+  u0MaxChunkSizeCharacters,
+  o0Connection,
+):
+  # See `fiterParseBody`. The body parts are never concatenated here, as that
+  # would copy the body read so far for every chunk, which makes reading a
+  # body with many chunks quadratic in time.
+  fShowDebugOutput("Reading chunked message body...");
+  uChunkedBodySize = 0;
+  uTotalNumberOfBodyChunks = 0;
+  while 1:
+    if u0MaxNumberOfChunksBeforeDisconnecting is not None and uTotalNumberOfBodyChunks == u0MaxNumberOfChunksBeforeDisconnecting:
+      return False;
+    (sbChunkHeaderLineCRLF, uChunkSize) = yield from fiterParseChunkHeaderLine(
+      uTotalNumberOfBodyChunks,
+      uChunkedBodySize,
+      u0MaxBodySize = u0MaxBodySize,
+      u0MaxChunkSize = u0MaxChunkSize,
+      u0MaxNumberOfChunks = u0MaxNumberOfChunks,
+      u0MaxChunkSizeCharacters = u0MaxChunkSizeCharacters,
+      o0Connection = o0Connection,
+    );
+    uChunkedBodySize += len(sbChunkHeaderLineCRLF);
+    if not bRemoveChunkedEncoding:
+      yield (guBodyPart, sbChunkHeaderLineCRLF);
+    if uChunkSize == 0:
+      break; # end of chunked body
+    if gbShowDebugOutput:
+      fShowDebugOutput("Reading message body chunk #%d (%d bytes)..." % (uTotalNumberOfBodyChunks + 1, uChunkSize));
+    if u0ReadSize is None and not bRemoveChunkedEncoding:
+      # Read the chunk and the CRLF that follows it at once.
+      sbChunkCRLF = yield (guReadBytes, uChunkSize + 2);
+      if sbChunkCRLF[-2:] != b"\r\n":
+        raise cInvalidMessageException(
+          "A body chunk did not end with CRLF.",
+          o0Connection = o0Connection,
+          dxDetails = {"sbChunkCRLF": sbChunkCRLF},
+        );
+      yield (guBodyPart, sbChunkCRLF);
+    else:
+      uNumberOfBytesLeftInChunk = uChunkSize;
+      while uNumberOfBytesLeftInChunk > 0:
+        sbBodyPart = yield (guReadBytes, uNumberOfBytesLeftInChunk if u0ReadSize is None else min(u0ReadSize, uNumberOfBytesLeftInChunk));
+        uNumberOfBytesLeftInChunk -= len(sbBodyPart);
+        yield (guBodyPart, sbBodyPart);
+      sbCRLF = yield (guReadBytes, 2);
+      if sbCRLF != b"\r\n":
+        raise cInvalidMessageException(
+          "A body chunk did not end with CRLF.",
+          o0Connection = o0Connection,
+          dxDetails = {"sbCRLF": sbCRLF},
+        );
+      if not bRemoveChunkedEncoding:
+        yield (guBodyPart, sbCRLF);
+    uChunkedBodySize += uChunkSize + 2;
+    uTotalNumberOfBodyChunks += 1;
+  # Read the trailer lines
+  while 1:
+    u0MaxNumberOfBytesInTrailerLine = u0MaxTrailerLineSize;
+    bLimitedByTotalBodySize = u0MaxBodySize is not None and (
+      u0MaxTrailerLineSize is None or u0MaxBodySize - uChunkedBodySize < u0MaxTrailerLineSize
+    );
+    if bLimitedByTotalBodySize:
+      u0MaxNumberOfBytesInTrailerLine = u0MaxBodySize - uChunkedBodySize;
+    sb0TrailerLineCRLF = yield (guReadUntilMarker, b"\r\n", u0MaxNumberOfBytesInTrailerLine);
+    if sb0TrailerLineCRLF is None:
+      sbTrailerLine = yield (guReadBufferedData,);
+      if bLimitedByTotalBodySize:
+        raise cInvalidMessageException(
+          "The chunked body was larger than the maximum accepted.",
+          o0Connection = o0Connection,
+          dxDetails = {"uMaxBodySize": u0MaxBodySize, "uMinimumNumberOfBytesInBodyChunks": uChunkedBodySize + len(sbTrailerLine)},
+        );
+      raise cInvalidMessageException(
+        "A chunked body trailer line was larger than the maximum accepted.",
+        o0Connection = o0Connection,
+        dxDetails = {"uMaxTrailerLineSize": u0MaxTrailerLineSize, "uMinimumNumberOfBytesInTrailer": len(sbTrailerLine)},
+      );
+    uChunkedBodySize += len(sb0TrailerLineCRLF);
+    if not bRemoveChunkedEncoding:
+      yield (guBodyPart, sb0TrailerLineCRLF);
+    if sb0TrailerLineCRLF == b"\r\n":
+      # empty line means end of trailers.
+      return True;
+
+def fiterParseChunkHeaderLine(
+  uTotalNumberOfBodyChunks,
+  uChunkedBodySize,
+  *,
+  u0MaxBodySize,
+  u0MaxChunkSize,
+  u0MaxNumberOfChunks,
+  u0MaxChunkSizeCharacters,
+  o0Connection,
+):
+  # Parse a chunk header line and check the chunk against the limits.
+  # Returns the chunk header line (including CRLF) and the chunk size.
+  if u0MaxNumberOfChunks is not None and uTotalNumberOfBodyChunks == u0MaxNumberOfChunks:
+    raise cInvalidMessageException(
+      "The number of body chunks was larger than the maximum expected.",
+      o0Connection = o0Connection,
+      dxDetails = {"uMaxNumberOfChunks": u0MaxNumberOfChunks, "uMinimumNumberOfChunksInBody": u0MaxNumberOfChunks + 1},
+    );
+  # Read size in the chunk header
+  u0MaxChunkHeaderLineSize = u0MaxChunkSizeCharacters + 2 if u0MaxChunkSizeCharacters is not None else None;
+  u0MaxNumberOfBytesInChunkHeaderLine = u0MaxChunkHeaderLineSize;
+  bLimitedByTotalBodySize = u0MaxBodySize is not None and (
+    u0MaxChunkHeaderLineSize is None or u0MaxBodySize - uChunkedBodySize < u0MaxChunkHeaderLineSize
+  );
+  if bLimitedByTotalBodySize:
+    u0MaxNumberOfBytesInChunkHeaderLine = u0MaxBodySize - uChunkedBodySize;
+  sb0ChunkHeaderLineCRLF = yield (guReadUntilMarker, b"\r\n", u0MaxNumberOfBytesInChunkHeaderLine);
+  if sb0ChunkHeaderLineCRLF is None:
+    sbChunkHeaderLine = yield (guReadBufferedData,);
+    if bLimitedByTotalBodySize:
+      raise cInvalidMessageException(
+        "The chunked body was larger than the maximum accepted.",
+        o0Connection = o0Connection,
+        dxDetails = {"uMaxBodySize": u0MaxBodySize, "uMinimumNumberOfBytesInBodyChunks": uChunkedBodySize + len(sbChunkHeaderLine)},
+      );
+    raise cInvalidMessageException(
+      "A body chunk header line was larger than the maximum accepted.",
+      o0Connection = o0Connection,
+      dxDetails = {"uMaxChunkHeaderLineSize": u0MaxChunkHeaderLineSize, "uMinimumNumberOfBytesInChunkHeader": len(sbChunkHeaderLine)},
+    );
+  sbChunkHeaderLineCRLF = sb0ChunkHeaderLineCRLF;
+  uIndexOfExtensionSeparator = sbChunkHeaderLineCRLF.find(b";");
+  if uIndexOfExtensionSeparator != -1:
+    sbChunkSize = sbChunkHeaderLineCRLF[:uIndexOfExtensionSeparator];
+  else:
+    sbChunkSize = sbChunkHeaderLineCRLF[:-2];
+  try:
+    uChunkSize = int(sbChunkSize, 16);
+  except ValueError:
+    raise cInvalidMessageException(
+      "A body chunk header line contained an invalid character in the chunk size.",
+      o0Connection = o0Connection,
+      dxDetails = {"sb0ChunkHeaderLineCRLF": sbChunkHeaderLineCRLF},
+    );
+  if uChunkSize == 0:
+    return (sbChunkHeaderLineCRLF, uChunkSize); # end of chunked body
+  if u0MaxChunkSize is not None and uChunkSize > u0MaxChunkSize:
+    raise cInvalidMessageException(
+      "A body chunk was larger than the maximum accepted",
+      o0Connection = o0Connection,
+      dxDetails = {"uMaxChunkSize": u0MaxChunkSize, "uChunkSize": uChunkSize},
+    );
+  uMinimumChunkedBodySize = uChunkedBodySize + len(sbChunkHeaderLineCRLF) + uChunkSize + 5; # add 5 because we expect at least "\r\n0\r\n" after this chunk"
+  if u0MaxBodySize is not None and u0MaxBodySize < uMinimumChunkedBodySize:
+    raise cInvalidMessageException(
+      "The chunked body was larger than the maximum accepted.",
+      o0Connection = o0Connection,
+      dxDetails = {"uMaxBodySize": u0MaxBodySize, "uMinimumChunkedBodySize": uMinimumChunkedBodySize},
+    );
+  return (sbChunkHeaderLineCRLF, uChunkSize);
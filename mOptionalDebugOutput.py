@@ -0,0 +1,19 @@
+import os;
+
+# Debug output is shown using mDebugOutput if it is installed, unless the
+# MHTTPCONNECTION_NO_DEBUG_OUTPUT environment variable is set to a non-empty
+# value when this module is first imported (e.g. in production). If debug output
+# is not shown, `ShowDebugOutput` returns the function it decorates as-is, so
+# calls to it cost nothing extra, and gbShowDebugOutput is False, so code can
+# skip creating debug output messages in hot paths.
+gbShowDebugOutput = not os.environ.get("MHTTPCONNECTION_NO_DEBUG_OUTPUT");
+if gbShowDebugOutput:
+  try: # mDebugOutput use is Optional
+    from mDebugOutput import ShowDebugOutput, fShowDebugOutput;
+  except ModuleNotFoundError as oException:
+    if oException.args[0] != "No module named 'mDebugOutput'":
+      raise;
+    gbShowDebugOutput = False;
+if not gbShowDebugOutput:
+  ShowDebugOutput = lambda fx: fx; # NOP
+  fShowDebugOutput = lambda x, s0 = None: x; # NOP